@@ -0,0 +1,168 @@
+"""
+Feed of newly inserted mqtt_data records for push-based real-time updates.
+
+One MqttDataWatcher per server process follows inserts through a MongoDB
+change stream and hands each batch of new records to `on_records`. Change
+streams need a replica set (and do not work on time-series collections); in
+that case it falls back to polling, and only for the topics `topics()`
+currently reports as watched, so idle rooms cost no queries at all.
+"""
+import datetime
+import sys
+import threading
+import time
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from mqtt_records import STORED_AT_FIELD
+
+
+class MqttDataWatcher:
+    def __init__(self, collection, on_records, topics, topic_key="mqtt_topic", use_change_stream=True,
+                 poll_interval=0.25, overlap_s=5.0, batch_size=1000, max_backoff_s=5.0):
+        self.collection = collection
+        self.on_records = on_records
+        self.topics = topics
+        self.topic_key = topic_key
+        self.use_change_stream = use_change_stream
+        self.poll_interval = poll_interval
+        self.overlap = datetime.timedelta(seconds=overlap_s)
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff_s
+        self.mode = None  # "change_stream" or "poll" once running
+        self.delivered = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mqtt-data-watcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _deliver(self, records):
+        if records:
+            self.delivered += len(records)
+            try:
+                self.on_records(records)
+            except Exception as e:
+                print(f"⚠ Warning: change feed consumer failed: {e}", file=sys.stderr)
+
+    def _run(self):
+        if self.use_change_stream:
+            try:
+                self._watch()
+                return
+            except OperationFailure as e:
+                # standalone mongod, time-series collection, ...
+                print(f"Change streams unavailable ({e}); falling back to polling")
+        self._poll()
+
+    # -------------------- Change stream --------------------
+    def _watch(self):
+        resume_token = None
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        while not self._stopping.is_set():
+            try:
+                with self.collection.watch(pipeline, resume_after=resume_token, max_await_time_ms=500) as stream:
+                    if self.mode != "change_stream":
+                        self.mode = "change_stream"
+                        print("✓ Real-time feed: MongoDB change stream")
+                    while not self._stopping.is_set() and stream.alive:
+                        # try_next() waits up to max_await_time_ms; drain what has arrived as one batch
+                        records = []
+                        change = stream.try_next()
+                        while change is not None:
+                            records.append(change["fullDocument"])
+                            if len(records) >= self.batch_size:
+                                break
+                            change = stream.try_next()
+                        resume_token = stream.resume_token
+                        self._deliver(records)
+            except OperationFailure:
+                if self.mode is None:
+                    raise  # not supported at all: caller switches to polling
+                print("⚠ Warning: change stream interrupted; resuming", file=sys.stderr)
+                time.sleep(1)
+            except PyMongoError as e:
+                print(f"⚠ Warning: change stream error ({e}); resuming", file=sys.stderr)
+                time.sleep(1)
+
+    # -------------------- Polling fallback --------------------
+    def _poll(self):
+        """
+        Poll on (stored_at, _id), stored_at being stamped by every writer at
+        insert time (mqtt_records.stamp_stored). ts and _id are both set when
+        a document is built, so spill-log replays and slow pipeline batches
+        would land behind a cursor on either of them. The cursor trails by
+        `overlap` to absorb clock skew between writers and inserts still in
+        flight; already delivered _ids inside that window are skipped.
+        Documents from writers that do not stamp stored_at are matched on
+        _id (ts for time-series collections) over the same window. Failed
+        polls are retried after a delay doubling up to max_backoff_s,
+        keeping the cursor where it was.
+        """
+        self.mode = "poll"
+        print(f"✓ Real-time feed: polling every {self.poll_interval}s (no change streams)")
+        legacy_key = "ts" if self._is_timeseries() else "_id"
+        cursor_time = datetime.datetime.utcnow()
+        catch_up = None  # (stored_at, _id) of the last record of a full page: continue strictly after it
+        recent = {}      # _id -> time delivered
+        failures = 0
+        delay = self.poll_interval
+
+        while not self._stopping.wait(delay):
+            delay = self.poll_interval
+            topics = list(self.topics())
+            if not topics:
+                cursor_time = datetime.datetime.utcnow()
+                catch_up = None
+                recent.clear()
+                continue
+
+            query = {self.topic_key: {"$in": topics}}
+            if catch_up is not None:
+                stored_at, last_id = catch_up
+                query["$or"] = [
+                    {STORED_AT_FIELD: {"$gt": stored_at}},
+                    {STORED_AT_FIELD: stored_at, "_id": {"$gt": last_id}},
+                ]
+            else:
+                since = cursor_time - self.overlap
+                query["$or"] = [
+                    {STORED_AT_FIELD: {"$gte": since}},
+                    {STORED_AT_FIELD: {"$exists": False},
+                     legacy_key: {"$gte": since if legacy_key == "ts" else ObjectId.from_datetime(since)}},
+                ]
+            try:
+                found = list(self.collection.find(query)
+                             .sort([(STORED_AT_FIELD, 1), ("_id", 1)]).limit(self.batch_size))
+            except PyMongoError as e:
+                failures += 1
+                delay = min(self.poll_interval * 2 ** failures, self.max_backoff)
+                print(f"⚠ Warning: change feed poll failed ({e}); retrying in {delay:.2f}s", file=sys.stderr)
+                continue
+            failures = 0
+
+            now = datetime.datetime.utcnow()
+            records = [r for r in found if r["_id"] not in recent]
+            for record in records:
+                recent[record["_id"]] = now
+            recent = {k: t for k, t in recent.items() if now - t <= self.overlap * 2}
+            last = found[-1] if found else None
+            if len(found) >= self.batch_size and last.get(STORED_AT_FIELD) is not None:
+                catch_up = (last[STORED_AT_FIELD], last["_id"])
+                delay = 0
+            else:
+                # a full page of unstamped records cannot be paged past; they are the legacy best effort
+                catch_up = None
+                cursor_time = now
+            self._deliver(records)
+
+    def _is_timeseries(self):
+        try:
+            info = list(self.collection.database.list_collections(filter={"name": self.collection.name}))
+            return bool(info) and info[0].get("type") == "timeseries"
+        except PyMongoError:
+            return False
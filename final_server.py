@@ -1,37 +1,80 @@
+import os
 
-from flask import Flask, request, jsonify
+# Socket.IO server model: "threading" (one OS thread per connection, dev
+# default), "eventlet" or "gevent" (greenlets: thousands of idle viewers per
+# process). The green modes patch the standard library here, before pymongo
+# and threading are imported, so Mongo I/O and the broadcaster loops yield to
+# other connections instead of blocking them.
+SOCKETIO_ASYNC_MODE = os.getenv("SOCKETIO_ASYNC_MODE", "threading").lower()
+SOCKETIO_LOG        = os.getenv("SOCKETIO_LOG", "0").lower() in ("1", "true", "yes")
+# Several server nodes: a shared message queue (see socketio_bus) and, behind a
+# non-sticky balancer, websocket-only transports
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE", "")
+SOCKETIO_CHANNEL       = os.getenv("SOCKETIO_CHANNEL", "flask-socketio")
+SOCKETIO_TRANSPORTS    = [t.strip() for t in os.getenv("SOCKETIO_TRANSPORTS", "polling,websocket").split(",") if t.strip()]
+if SOCKETIO_ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+elif SOCKETIO_ASYNC_MODE == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit, disconnect
+from flask_socketio import SocketIO, emit, disconnect, join_room, leave_room
 from pymongo import MongoClient
 import bcrypt
 import jwt
 import datetime
-import os
 import socket
 import uuid
 from werkzeug.utils import secure_filename
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, ASCENDING, DESCENDING
 import math
 from bson import ObjectId
 import re
 import json
+import logging
 import threading
 import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from positioning import (
+    MIN_ANCHORS, POSITION_FILTER, RoomGeometryCache, TagTracker, anchor_list, anchor_positions, attach_position, parse_anchor_list, position_dict,
+    ranges_by_anchor, recompute_topic_positions, room_geometry, solve_fix, solve_fixes, stored_position,
+)
+from retention import ensure_retention_indexes, pick_history_tier, start_rollup_thread, topic_raw_days
+from latest_state import (
+    LATEST_STATE_COLLECTION, LATEST_STATE_SEED_MAX, LATEST_STATE_SEED_S, LATEST_STATE_SHARED, LatestState,
+)
+from change_feed import MqttDataWatcher
+from socketio_bus import socketio_queue_options
+import wire_format
+from mqtt_records import (
+    MQTT_DATA_COLLECTION, STORED_AT_FIELD, TAG_KEY, TIMESERIES_MODE, TOPIC_KEY,
+    IngestFilter, TopicSequencer, build_mqtt_doc, ensure_mqtt_data_collection, expand_ranges_batch,
+    flatten_record, is_range_frame, parse_device_ts, record_tag_ranges, stamp_stored,
+)
 
 
 
 
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})  # Allow CORS for WebSocket
 # Configure SocketIO to work with nginx proxy
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*", 
-    async_mode='threading',
-    logger=True,
-    engineio_logger=True,
+    async_mode=SOCKETIO_ASYNC_MODE,
+    logger=SOCKETIO_LOG,  # per-packet logging; far too slow to leave on in production
+    engineio_logger=SOCKETIO_LOG,
     ping_timeout=60,
-    ping_interval=25
+    ping_interval=25,
+    transports=SOCKETIO_TRANSPORTS,
+    **socketio_queue_options(SOCKETIO_MESSAGE_QUEUE, SOCKETIO_CHANNEL)
 )
 
 
@@ -81,7 +124,11 @@ db = client[DB_NAME]
 users_collection = db["users_auth"]
 enrollments_collection = db["enrolled_devices"]
 uuid_counter_collection = db["uuid_counter"]
-mqtt_data_collection = db["mqtt_data"]
+mqtt_data_collection = ensure_mqtt_data_collection(db, MQTT_DATA_COLLECTION)  # "mqtt_data", or time-series "uwb_ranges"
+ingest_filter = IngestFilter()  # drops repeated/over-rate range frames posted to this server
+sequencer = TopicSequencer()    # per-topic "seq" on records written by this server
+latest_state_collection = db[LATEST_STATE_COLLECTION]  # upserted by every writer when shared
+latest_state = LatestState(latest_state_collection if LATEST_STATE_SHARED else None)
 room_uploads_collection = db["room_uploads"]
 rooms_collection = db["rooms"]
 used_topics_collection = db["used_mqtt_topics"]  # Track all used topics permanently
@@ -200,128 +247,138 @@ def validate_7_digit_uuid(uuid_str):
     except ValueError:
         return False
 
-def three_point_calculation(x1, y1, x2, y2, r1, r2):
-    """Same as main.py three_point method"""
-    temp_x = 0.0
-    temp_y = 0.0
-    # 圆心距离 (distance between circle centers)
-    p2p = math.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
-
-    # 判断是否相交 (check if circles intersect)
-    if r1 + r2 <= p2p:
-        temp_x = x1 + (x2 - x1) * r1 / (r1 + r2)
-        temp_y = y1 + (y2 - y1) * r1 / (r1 + r2)
+def api_response(payload, status=200):
+    """
+    jsonify() for the hot read endpoints, or MessagePack / columnar MessagePack
+    when the Accept header asks for it (see wire_format). Errors stay JSON.
+    """
+    fmt = wire_format.negotiate(request.headers.get("Accept"))
+    if fmt == "json":
+        response = jsonify(payload)
     else:
-        dr = p2p / 2 + (r1 * r1 - r2 * r2) / (2 * p2p)
-        temp_x = x1 + (x2 - x1) * dr / p2p
-        temp_y = y1 + (y2 - y1) * dr / p2p
+        response = Response(wire_format.encode(payload, fmt), mimetype=wire_format.MIMETYPES[fmt])
+    response.status_code = status
+    response.headers["Vary"] = "Accept"
+    return response
+
+# Per-tag Kalman filter state (POSITION_FILTER=kalman), fed every stored frame
+# of a tracked topic by the change feed (_track_records) and read by
+# calculate_tag_positions
+tag_tracker = TagTracker() if POSITION_FILTER == "kalman" else None
+tracker_rooms = RoomGeometryCache(rooms_collection, ttl=5.0)
+
+
+def _latest_state_seed(mqtt_topic, since=None):
+    """
+    Latest-state loader (see LatestState.get). since=None: newest stored
+    record per (tag_id, device_id) of a topic, the key the store uses, among
+    the last LATEST_STATE_SEED_S of frames (at most LATEST_STATE_SEED_MAX),
+    plus the newest 100 frames for legacy records whose tag id only lives in
+    their "data" JSON (and tags idle for longer). Otherwise the frames
+    stored at or after `since`.
+    """
+    if since is not None:
+        return expand_ranges_batch(list(mqtt_data_collection.find(
+            {TOPIC_KEY: mqtt_topic, "ts": {"$gte": since}}
+        ).sort("ts", -1).limit(LATEST_STATE_SEED_MAX)))
+
+    window_start = datetime.datetime.utcnow() - datetime.timedelta(seconds=LATEST_STATE_SEED_S)
+    pipeline = [
+        {"$match": {TOPIC_KEY: mqtt_topic, "ts": {"$gte": window_start}}},
+        {"$sort": {"ts": -1}},
+        {"$limit": LATEST_STATE_SEED_MAX},
+        {"$group": {
+            "_id": {"tag_id": f"${TAG_KEY}", "device_id": "$device_id"},
+            "latest_data": {"$first": "$$ROOT"}
+        }},
+        {"$replaceRoot": {"newRoot": "$latest_data"}}
+    ]
+    records = list(mqtt_data_collection.aggregate(pipeline))
+    records += mqtt_data_collection.find({TOPIC_KEY: mqtt_topic}).sort("ts", -1).limit(100)
+    return expand_ranges_batch(records)
 
-    return temp_x, temp_y
 
-def calculate_tag_positions(mqtt_topic, room, email):
+def calculate_tag_positions(mqtt_topic, room, email, check_access=True):
     """
     Calculate tag positions from MQTT data.
     Returns tag_positions dict or None if error.
+    check_access=False skips the enrollment lookup for callers that already did it.
+    With POSITION_FILTER=kalman each entry also carries the tag's filtered
+    state ("kalman"), predicted to now.
     """
     # Validate access
-    user_enrollment = enrollments_collection.find_one({"email": email, "mqtt_topic": mqtt_topic})
-    if not user_enrollment:
-        return None, "You don't have access to this MQTT topic"
+    if check_access:
+        user_enrollment = enrollments_collection.find_one({"email": email, "mqtt_topic": mqtt_topic})
+        if not user_enrollment:
+            return None, "You don't have access to this MQTT topic"
     
-    # Get room dimensions
-    width = float(room.get("width_in", 0))
-    height = float(room.get("height_in", 0))
-    if width <= 0 or height <= 0:
+    # Room dimensions and anchor layout
+    geometry = room_geometry(room)
+    if geometry is None:
         return None, "Room has invalid dimensions"
     
-    # Anchor positions (in inches)
-    anchor_positions = [
-        (0, 0),           # A0
-        (width, 0),       # A1
-        (width, height),  # A2
-        (0, height)       # A3
-    ]
+    # Newest frame per tag from the latest-state store; mqtt_data is only
+    # queried to seed a topic (see _latest_state_seed)
+    entries = latest_state.get(mqtt_topic, loader=lambda since: _latest_state_seed(mqtt_topic, since))
     
-    # Fetch latest MQTT data
-    mqtt_records = list(mqtt_data_collection.find(
-        {"$or": [{"mqtt_topic": mqtt_topic}, {"topic": mqtt_topic}]}
-    ).sort([("ts", -1), ("received_at", -1), ("timestamp", -1)]).limit(100))
-    
-    if not mqtt_records:
+    if not entries:
         return None, "No MQTT data found for this topic"
     
     # Parse MQTT data and group by tag ID
     tag_data = {}
-    for record in mqtt_records:
-        data_str = record.get("data") or record.get("message", "")
-        if not data_str:
-            continue
-        try:
-            tag_info = json.loads(data_str)
-            tag_id = tag_info.get("id")
-            ranges = tag_info.get("range", [])
-            if tag_id is not None and isinstance(ranges, list) and len(ranges) >= 4:
-                if tag_id not in tag_data:
-                    timestamp = record.get("ts") or record.get("received_at") or record.get("timestamp")
-                    tag_data[tag_id] = {"range": ranges, "timestamp": timestamp}
-        except (json.JSONDecodeError, ValueError, TypeError):
-            continue
+    for tag_id, record in latest_state.by_tag(entries).items():
+        _, ranges = record_tag_ranges(record)
+        if len(ranges) >= MIN_ANCHORS:
+            tag_data[tag_id] = {"range": ranges, "timestamp": record.get("ts"), "record": record}
     
     if not tag_data:
         return None, "No valid tag data found in MQTT records"
     
     # Calculate positions
     tag_positions = {}
+    now = datetime.datetime.utcnow()
     for tag_id, tag_info in tag_data.items():
         ranges = tag_info["range"]
-        distances = [(i, r) for i, r in enumerate(ranges) if r > 0 and i < 4]
-        
-        if len(distances) < 3:
+        # Position stored at ingest if it was computed for this room geometry, else solve now
+        fix = stored_position(tag_info["record"], geometry) or solve_fix(ranges, geometry)
+        kalman = None
+        if tag_tracker is not None:
+            kalman = tag_tracker.observe((mqtt_topic, tag_id), geometry, fix, tag_info["timestamp"], now)
+
+        if fix is None:
             tag_positions[tag_id] = {
                 "x": None, "y": None, "status": False,
                 "error": "Insufficient valid ranges (need at least 3)"
             }
+            if kalman:
+                tag_positions[tag_id]["kalman"] = kalman
             continue
-        
-        distances.sort(key=lambda x: x[1])
-        selected_ids = [distances[i][0] for i in range(3)]
-        
-        x_sum, y_sum, count = 0.0, 0.0, 0
-        for i in range(3):
-            for j in range(i + 1, 3):
-                a_id, b_id = selected_ids[i], selected_ids[j]
-                a_x, a_y = anchor_positions[a_id]
-                b_x, b_y = anchor_positions[b_id]
-                temp_x, temp_y = three_point_calculation(a_x, a_y, b_x, b_y, ranges[a_id], ranges[b_id])
-                x_sum += temp_x
-                y_sum += temp_y
-                count += 1
-        
-        if count > 0:
-            x = int(x_sum / count)
-            y = int(y_sum / count)
-            x_clamped = max(0.0, min(width, x))
-            y_clamped = max(0.0, min(height, y))
-            
-            tag_positions[tag_id] = {
-                "x": x_clamped, "y": y_clamped,
-                "x_normalized": x_clamped / width if width > 0 else None,
-                "y_normalized": y_clamped / height if height > 0 else None,
-                "status": True,
-                "ranges": {
-                    "A0": ranges[0] if len(ranges) > 0 else 0,
-                    "A1": ranges[1] if len(ranges) > 1 else 0,
-                    "A2": ranges[2] if len(ranges) > 2 else 0,
-                    "A3": ranges[3] if len(ranges) > 3 else 0
-                },
-                "selected_anchors": [f"A{id}" for id in selected_ids],
-                "timestamp": tag_info["timestamp"].isoformat() if hasattr(tag_info["timestamp"], 'isoformat') else str(tag_info["timestamp"])
-            }
-        else:
-            tag_positions[tag_id] = {"x": None, "y": None, "status": False, "error": "Calculation failed"}
+
+        tag_positions[tag_id] = {
+            **position_dict(fix, geometry),
+            "status": True,
+            "ranges": ranges_by_anchor(ranges, geometry, missing=0),
+            "timestamp": tag_info["timestamp"].isoformat() if hasattr(tag_info["timestamp"], 'isoformat') else str(tag_info["timestamp"])
+        }
+        if kalman:
+            tag_positions[tag_id]["kalman"] = kalman
     
     return tag_positions, None
 
+def _recompute_positions_async(room):
+    """Rewrite the stored positions of a room's topic in a background thread (room created/resized)."""
+    topic = room.get("mqtt_topic")
+
+    def run():
+        try:
+            count = recompute_topic_positions(mqtt_data_collection, topic, room, TOPIC_KEY)
+            if count:
+                print(f"✓ Recomputed {count} stored positions for topic {topic}")
+        except Exception as e:
+            log.warning("Could not recompute stored positions for topic %s (recomputed on read): %s", topic, e)
+
+    threading.Thread(target=run, daemon=True).start()
+
 # ====== ROUTES ======
 
 @app.route("/")
@@ -879,18 +936,43 @@ def store_mqtt_data():
     # if not user_enrollment:
     #     return jsonify({"msg": "Unknown or unregistered MQTT topic"}), 403
 
-    # Store MQTT data directly
-    mqtt_data = {
-        "mqtt_topic": mqtt_topic,
-        "device_id": data["device_id"],
-        "message": data["message"],
-        "timestamp": data["timestamp"],
-        "received_at": datetime.datetime.utcnow(),
-        "data_type": data.get("data_type", "sensor_data"),
-        "metadata": data.get("metadata", {})
-    }
-
-    mqtt_data_collection.insert_one(mqtt_data)
+    # Store MQTT data directly (canonical mqtt_data shape, see mqtt_records)
+    message = data["message"]
+    if isinstance(message, str):
+        try:
+            frame = json.loads(message)
+        except ValueError:
+            frame = None
+    else:
+        frame = message
+        message = json.dumps(message, separators=(",", ":"))
+
+    mqtt_data = build_mqtt_doc(
+        mqtt_topic,
+        message,
+        datetime.datetime.utcnow(),
+        frame=frame,
+        device_id=data["device_id"],
+        timestamp=data["timestamp"],
+        data_type=data.get("data_type", "sensor_data"),
+        metadata=data.get("metadata", {})
+    )
+    if "device_ts" not in mqtt_data:
+        device_ts = parse_device_ts(data["timestamp"])
+        if device_ts is not None:
+            mqtt_data["device_ts"] = device_ts
+
+    dropped = ingest_filter.reject_reason(mqtt_data)
+    if dropped:
+        # Same frame as one stored moments ago (or over the per-tag rate); nothing new to store
+        return jsonify({"msg": "MQTT data not stored", "stored": False, "reason": dropped}), 200
+
+    mqtt_data["seq"] = sequencer.next(mqtt_topic)
+    if is_range_frame(mqtt_data):
+        attach_position(mqtt_data, room_geometry(rooms_collection.find_one({"mqtt_topic": mqtt_topic})))
+
+    mqtt_data_collection.insert_one(stamp_stored([mqtt_data])[0])
+    latest_state.update([mqtt_data])
     return jsonify({"msg": "MQTT data stored successfully"}), 201
 
 
@@ -957,14 +1039,15 @@ def get_mqtt_data_by_topic(mqtt_topic):
     data_type = request.args.get("data_type")  # Optional filter by data type
 
     # Build query
-    query = {"mqtt_topic": mqtt_topic}
+    query = {TOPIC_KEY: mqtt_topic}
     if device_id:
         query["device_id"] = device_id
     if data_type:
         query["data_type"] = data_type
 
     # Get MQTT data
-    mqtt_data = list(mqtt_data_collection.find(query, {"_id": 0}).sort("received_at", -1).limit(limit))
+    mqtt_data = [flatten_record(r) for r in
+                 mqtt_data_collection.find(query, {"_id": 0}).sort("ts", -1).limit(limit)]
     
     return jsonify({
         "mqtt_topic": mqtt_topic,
@@ -991,6 +1074,9 @@ def create_room():
       - label (string)
       - mqtt_topic (string, required) - 7-digit MQTT topic to bind to this room
       - image (file, optional: jpg/jpeg/png)
+      - anchors (JSON string, optional) - [{"id": "A0", "x": 0, "y": 0, "z": 96}, ...]
+        in range-slot order; defaults to the four corners A0..A3
+      - tag_height_in (string/number, optional) - tag height used with anchor z
     """
     token = request.headers.get("Authorization")
     if not token:
@@ -1010,6 +1096,8 @@ def create_room():
     label = request.form.get("label")
     mqtt_topic = request.form.get("mqtt_topic")
     image_file = request.files.get("image")
+    anchors_val = request.form.get("anchors")
+    tag_height_val = request.form.get("tag_height_in")
 
     # Validate required fields
     required_fields = {"A0_A1": a0_a1_val, "A1_A2": a1_a2_val, "A2_A3": a2_a3_val, "A3_A0": a3_a0_val, "label": label, "mqtt_topic": mqtt_topic}
@@ -1067,6 +1155,18 @@ def create_room():
     height_in = a1_a2     # along Y (A0 → A3)
     area_sqft = (width_in * height_in) / 144.0
 
+    # Optional explicit anchor layout
+    anchors = None
+    if anchors_val:
+        try:
+            anchors = parse_anchor_list(anchors_val)
+        except ValueError as e:
+            return jsonify({"msg": str(e)}), 400
+    try:
+        tag_height_in = float(tag_height_val) if tag_height_val else 0.0
+    except (TypeError, ValueError):
+        return jsonify({"msg": "tag_height_in must be numeric inches"}), 400
+
     # Handle image upload (optional)
     image_filename = None
     if image_file:
@@ -1111,7 +1211,15 @@ def create_room():
     if image_filename:
         room_doc["image_file"] = image_filename
 
+    if anchors:
+        room_doc["anchors"] = anchors
+    if tag_height_in:
+        room_doc["tag_height_in"] = tag_height_in
+
     result = rooms_collection.insert_one(room_doc)
+    # Frames already stored for this topic get positions for the new room
+    _recompute_positions_async(room_doc)
+    tracker_rooms.invalidate(mqtt_topic)
 
     response_data = {
         "msg": "Room created successfully",
@@ -1121,6 +1229,7 @@ def create_room():
         "area_sqft": round(area_sqft, 4),
         "label": label,
         "mqtt_topic": mqtt_topic,
+        "anchors": anchor_list(room_geometry(room_doc)),
         "image_file": image_filename,
         "image_url": f"http://{get_server_ip()}/uploads/{image_filename}" if image_filename else None
     }
@@ -1190,6 +1299,7 @@ def get_room_details(room_id):
 
     # Build response with all room details
     image_file = room.get("image_file")
+    geometry = room_geometry(room)
     room_data = {
         "room_id": str(room["_id"]),
         "label": room.get("label"),
@@ -1200,6 +1310,8 @@ def get_room_details(room_id):
         "width_in": room.get("width_in"),
         "height_in": room.get("height_in"),
         "area_sqft": room.get("area_sqft"),
+        "anchors": anchor_list(geometry) if geometry else None,
+        "tag_height_in": room.get("tag_height_in", 0.0),
         "mqtt_topic": room.get("mqtt_topic"),
         "image_file": image_file,
         "image_url": f"http://{get_server_ip()}/uploads/{image_file}" if image_file else None,
@@ -1222,6 +1334,8 @@ def update_room_details(room_id):
         "A1_A2": 800,              // Optional
         "A2_A3": 1200,             // Optional
         "A3_A0": 800,              // Optional
+        "anchors": [{"id": "A0", "x": 0, "y": 0, "z": 96}, ...],  // Optional - null/[] restores the corners
+        "tag_height_in": 40,       // Optional
         "image": <file>            // Optional - new image file
     }
     
@@ -1264,6 +1378,9 @@ def update_room_details(room_id):
         a2_a3_val = request.form.get("A2_A3")
         a3_a0_val = request.form.get("A3_A0")
         image_file = request.files.get("image")
+        anchors_given = "anchors" in request.form
+        anchors_val = request.form.get("anchors")
+        tag_height_val = request.form.get("tag_height_in")
     else:
         # Try JSON
         data = request.get_json(silent=True) or {}
@@ -1273,6 +1390,9 @@ def update_room_details(room_id):
         a2_a3_val = data.get("A2_A3")
         a3_a0_val = data.get("A3_A0")
         image_file = None
+        anchors_given = "anchors" in data
+        anchors_val = data.get("anchors")
+        tag_height_val = data.get("tag_height_in")
 
     # Update label if provided
     if label is not None:
@@ -1322,6 +1442,22 @@ def update_room_details(room_id):
         update_data["height_in"] = height_in
         update_data["area_sqft"] = area_sqft
 
+    # Update the anchor layout if provided (empty/null restores the corner anchors)
+    unset_data = {}
+    if anchors_given:
+        if anchors_val:
+            try:
+                update_data["anchors"] = parse_anchor_list(anchors_val)
+            except ValueError as e:
+                return jsonify({"msg": str(e)}), 400
+        else:
+            unset_data["anchors"] = ""
+    if tag_height_val not in (None, ""):
+        try:
+            update_data["tag_height_in"] = float(tag_height_val)
+        except (TypeError, ValueError):
+            return jsonify({"msg": "tag_height_in must be numeric inches"}), 400
+
     # Handle image upload (optional)
     if image_file:
         def _allowed_image(filename: str) -> bool:
@@ -1358,17 +1494,17 @@ def update_room_details(room_id):
             return jsonify({"msg": f"Failed to save image: {str(e)}"}), 500
 
     # If no updates provided
-    if not update_data:
+    if not update_data and not unset_data:
         return jsonify({"msg": "No fields to update"}), 400
 
     # Add updated timestamp
     update_data["updated_at"] = datetime.datetime.utcnow()
 
     # Update the room
-    result = rooms_collection.update_one(
-        {"_id": room_oid},
-        {"$set": update_data}
-    )
+    update = {"$set": update_data}
+    if unset_data:
+        update["$unset"] = unset_data
+    result = rooms_collection.update_one({"_id": room_oid}, update)
 
     if result.modified_count == 0:
         return jsonify({"msg": "No changes were made"}), 200
@@ -1376,6 +1512,13 @@ def update_room_details(room_id):
     # Get updated room
     updated_room = rooms_collection.find_one({"_id": room_oid})
 
+    # Stored positions were computed for the old size or anchors (on a
+    # time-series collection they stay stale and are recomputed on read)
+    updated_geometry = room_geometry(updated_room)
+    if updated_geometry != room_geometry(room):
+        _recompute_positions_async(updated_room)
+        tracker_rooms.invalidate(updated_room.get("mqtt_topic"))
+
     # Build response
     image_file = updated_room.get("image_file")
     response_data = {
@@ -1385,6 +1528,8 @@ def update_room_details(room_id):
         "width_in": updated_room.get("width_in"),
         "height_in": updated_room.get("height_in"),
         "area_sqft": updated_room.get("area_sqft"),
+        "anchors": anchor_list(updated_geometry) if updated_geometry else None,
+        "tag_height_in": updated_room.get("tag_height_in", 0.0),
         "mqtt_topic": updated_room.get("mqtt_topic"),
         "image_file": image_file,
         "image_url": f"http://{get_server_ip()}/uploads/{image_file}" if image_file else None,
@@ -1450,89 +1595,30 @@ def visualize_position():
     if not user_enrollment:
         return jsonify({"msg": "You don't have access to this MQTT topic"}), 403
 
-    # Get room dimensions
-    width = float(room.get("width_in", 0))
-    height = float(room.get("height_in", 0))
-    if width <= 0 or height <= 0:
+    # Get room dimensions and anchors
+    geometry = room_geometry(room)
+    if geometry is None:
         return jsonify({"msg": "Room has invalid dimensions"}), 500
 
-    # Anchor positions (in inches) - same as main.py
-    # A0 = (0, 0)
-    # A1 = (width, 0)
-    # A2 = (width, height)
-    # A3 = (0, height)
-    anchor_positions = [
-        (0, 0),           # A0
-        (width, 0),       # A1
-        (width, height),  # A2
-        (0, height)       # A3
-    ]
-
-    # Fetch latest MQTT data for this topic
-    # Try both field names: "topic" and "mqtt_topic", and "data" and "message"
-    # Sort by timestamp (ts, received_at, or timestamp field)
-    mqtt_records = list(mqtt_data_collection.find(
-        {"$or": [{"mqtt_topic": mqtt_topic}, {"topic": mqtt_topic}]}
-    ).sort([("ts", -1), ("received_at", -1), ("timestamp", -1)]).limit(100))  # Get latest 100 records
-
-    if not mqtt_records:
-        return jsonify({"msg": "No MQTT data found for this topic"}), 404
-
-    # Parse MQTT data and group by tag ID
-    tag_data = {}  # {tag_id: {"range": [r0, r1, r2, r3, ...], "timestamp": ...}}
-    
-    for record in mqtt_records:
-        # Handle both field name formats
-        data_str = record.get("data") or record.get("message", "")
-        if not data_str:
-            continue
-        
-        try:
-            tag_info = json.loads(data_str)
-            tag_id = tag_info.get("id")
-            ranges = tag_info.get("range", [])
-            
-            if tag_id is not None and isinstance(ranges, list) and len(ranges) >= 4:
-                # Keep only the latest data for each tag
-                if tag_id not in tag_data:
-                    timestamp = record.get("ts") or record.get("received_at") or record.get("timestamp")
-                    tag_data[tag_id] = {
-                        "range": ranges,
-                        "timestamp": timestamp
-                    }
-        except (json.JSONDecodeError, ValueError, TypeError) as e:
-            continue  # Skip invalid records
-
-    if not tag_data:
-        return jsonify({"msg": "No valid tag data found in MQTT records"}), 404
-
-    # Calculate positions using helper function
-    tag_positions, error = calculate_tag_positions(mqtt_topic, room, email)
+    # Calculate positions using helper function (enrollment checked above)
+    tag_positions, error = calculate_tag_positions(mqtt_topic, room, email, check_access=False)
     if error:
-        return jsonify({"msg": error}), 404 if "not found" in error.lower() else 400
+        return jsonify({"msg": error}), 404 if "found" in error.lower() else 400
 
-    width = float(room.get("width_in", 0))
-    height = float(room.get("height_in", 0))
-
-    return jsonify({
+    return api_response({
         "msg": "Positions computed",
         "room_id": room_id,
         "label": room.get("label"),
         "mqtt_topic": mqtt_topic,
         "room_dimensions_in": {
-            "width_in": width,
-            "height_in": height
+            "width_in": geometry.width,
+            "height_in": geometry.height
         },
         "image_url": f"http://{get_server_ip()}/uploads/{room.get('image_file')}" if room.get("image_file") else None,
-        "anchor_positions": {
-            "A0": {"x": 0, "y": 0},
-            "A1": {"x": width, "y": 0},
-            "A2": {"x": width, "y": height},
-            "A3": {"x": 0, "y": height}
-        },
+        "anchor_positions": anchor_positions(geometry),
         "tag_positions": tag_positions,
         "tag_count": len(tag_positions)
-    }), 200
+    })
 
 
 
@@ -1544,6 +1630,7 @@ def create_dummy_mqtt_data():
     """
     Create dummy MQTT data for testing the visualize endpoint.
     For testing purposes, this endpoint will auto-create enrollment if it doesn't exist.
+    Frames repeating what a tag stored within INGEST_DEDUP_WINDOW_S are skipped.
     
     Body:
     {
@@ -1631,6 +1718,7 @@ def create_dummy_mqtt_data():
     # Generate dummy data
     inserted_records = []
     current_time = datetime.datetime.utcnow()
+    geometry = room_geometry(rooms_collection.find_one({"mqtt_topic": mqtt_topic}))
 
     # Default ranges for testing (in inches, simulating realistic distances)
     default_ranges = {
@@ -1664,24 +1752,26 @@ def create_dummy_mqtt_data():
             "range": ranges
         }
 
-        # Insert into mqtt_data collection with both field name formats for compatibility
-        mqtt_record = {
-            "topic": mqtt_topic,  # Your format
-            "mqtt_topic": mqtt_topic,  # Standard format
-            "data": json.dumps(tag_data),  # Your format
-            "message": json.dumps(tag_data),  # Standard format
-            "device_id": f"tag_{tag_id}",
-            "ts": current_time,  # Your format
-            "timestamp": current_time.isoformat(),  # Standard format
-            "received_at": current_time,  # Standard format
-            "data_type": "uwb_tag_data",
-            "metadata": {
+        # Insert into mqtt_data collection (canonical shape, see mqtt_records)
+        mqtt_record = build_mqtt_doc(
+            mqtt_topic,
+            json.dumps(tag_data, separators=(",", ":")),
+            current_time,
+            frame=tag_data,
+            device_id=f"tag_{tag_id}",
+            data_type="uwb_tag_data",
+            metadata={
                 "tag_id": tag_id,
                 "test_data": True
             }
-        }
+        )
+        if not ingest_filter.accept(mqtt_record):
+            continue
+        mqtt_record["seq"] = sequencer.next(mqtt_topic)
+        attach_position(mqtt_record, geometry)
 
-        result = mqtt_data_collection.insert_one(mqtt_record)
+        result = mqtt_data_collection.insert_one(stamp_stored([mqtt_record])[0])
+        latest_state.update([mqtt_record])
         inserted_records.append({
             "tag_id": tag_id,
             "ranges": ranges,
@@ -1718,25 +1808,125 @@ def get_latest_mqtt_data(mqtt_topic):
     if not user_enrollment:
         return jsonify({"msg": "You don't have access to this MQTT topic"}), 403
 
-    # Get latest data for each device
-    pipeline = [
-        {"$match": {"mqtt_topic": mqtt_topic}},
-        {"$sort": {"received_at": -1}},
-        {"$group": {
-            "_id": "$device_id",
-            "latest_data": {"$first": "$$ROOT"}
-        }},
-        {"$replaceRoot": {"newRoot": "$latest_data"}},
-        {"$project": {"_id": 0}}
-    ]
-
-    latest_data = list(mqtt_data_collection.aggregate(pipeline))
+    # Get latest data for each device (mqtt_data only seeds a topic the latest-state store lacks)
+    entries = latest_state.get(mqtt_topic, loader=lambda since: _latest_state_seed(mqtt_topic, since))
+    latest_data = [dict(r) for r in latest_state.by_device(entries).values()]
     
-    return jsonify({
+    return api_response({
         "mqtt_topic": mqtt_topic,
         "latest_data": latest_data,
         "device_count": len(latest_data)
-    }), 200
+    })
+
+
+def _page_positions(records, ranges_list, geometry):
+    """
+    "position" field of each history row: the ingest-time fix when it matches
+    the room geometry, the rest solved in one batch. None where no fix is possible.
+    """
+    if geometry is None:
+        return [None] * len(records)
+
+    fixes = [stored_position(record, geometry) if len(ranges) >= MIN_ANCHORS else None
+             for record, ranges in zip(records, ranges_list)]
+    missing = [i for i, (fix, ranges) in enumerate(zip(fixes, ranges_list))
+               if fix is None and len(ranges) >= MIN_ANCHORS]
+    for i, fix in zip(missing, solve_fixes([ranges_list[i] for i in missing], geometry)):
+        fixes[i] = fix
+    return [position_dict(fix, geometry) if fix else None for fix in fixes]
+
+
+# Timezone for history date inputs/outputs when the request has no "tz" parameter.
+# Stored "ts" values are always UTC.
+HISTORY_DEFAULT_TZ = os.getenv("HISTORY_DEFAULT_TZ", "UTC")
+
+
+def _parse_tz(name):
+    """tzinfo for an IANA zone name ("Asia/Karachi") or a UTC offset ("+05:00"); None if invalid."""
+    if not name:
+        return None
+    if name[0] == " ":
+        name = "+" + name.strip()  # unencoded "+" in a query string arrives as a space
+    if name[0] in "+-":
+        try:
+            sign = -1 if name[0] == "-" else 1
+            hours, _, minutes = name[1:].partition(":")
+            return datetime.timezone(sign * datetime.timedelta(hours=int(hours), minutes=int(minutes or 0)))
+        except ValueError:
+            return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def _history_tz():
+    """(tzinfo, output_tz) for a history request; output_tz is None to keep naive UTC timestamps."""
+    name = request.args.get("tz") or HISTORY_DEFAULT_TZ
+    tz = _parse_tz(name)
+    if tz is None:
+        return None, None
+    explicit = "tz" in request.args or HISTORY_DEFAULT_TZ.upper() != "UTC"
+    return tz, (tz if explicit else None)
+
+
+def _to_utc(value, tz):
+    """Naive UTC datetime for a request datetime; naive inputs are taken to be in `tz`."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz)
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _format_ts(ts, output_tz=None):
+    """ISO string for a stored UTC datetime, converted to output_tz if given."""
+    if not hasattr(ts, "isoformat"):
+        return str(ts) if ts else None
+    if output_tz is None:
+        return ts.isoformat()
+    return ts.replace(tzinfo=datetime.timezone.utc).astimezone(output_tz).isoformat()
+
+
+def _rollup_history_page(tier, mqtt_topic, date_filter, tag_id, skip, per_page, room, include_positions,
+                         output_tz=None):
+    """
+    One page of history from a rollup tier (see retention.py).
+    Returns (items, total_count); each item summarises one bucket per tag.
+    """
+    collection = db[tier["collection"]]
+    query = {"mqtt_topic": mqtt_topic}
+    if date_filter:
+        query["ts"] = date_filter
+    if tag_id is not None:
+        query["tag_id"] = tag_id
+
+    total_count = collection.count_documents(query)
+    width = float(room.get("width_in", 0)) if room else 0.0
+    height = float(room.get("height_in", 0)) if room else 0.0
+
+    items = []
+    for doc in collection.find(query).sort("ts", -1).skip(skip).limit(per_page):
+        item = {
+            "record_id": str(doc.get("_id")),
+            "tag_id": doc.get("tag_id"),
+            "timestamp": _format_ts(doc["ts"], output_tz),
+            "bucket_seconds": tier["bucket_s"],
+            "sample_count": doc.get("count", 0),
+            "range_min": doc.get("range_min", []),
+            "range_max": doc.get("range_max", [])
+        }
+        if include_positions:
+            if doc.get("x_mean") is not None and width > 0 and height > 0:
+                item["position"] = {
+                    "x": round(doc["x_mean"], 2),
+                    "y": round(doc["y_mean"], 2),
+                    "x_normalized": round(doc["x_mean"] / width, 4),
+                    "y_normalized": round(doc["y_mean"] / height, 4)
+                }
+            else:
+                item["position"] = None
+        items.append(item)
+
+    return items, total_count
 
 
 @app.route("/api/mqtt/data/<mqtt_topic>/history", methods=["GET"])
@@ -1751,6 +1941,12 @@ def get_mqtt_history(mqtt_topic):
     - page (optional): Page number for pagination (default: 1)
     - per_page (optional): Records per page (default: 100, max: 1000)
     - include_positions (optional): Include calculated x,y positions (default: true)
+    - resolution (optional): Coarsest acceptable bucket in seconds (default: 0 = raw frames).
+      1 or 60 allow the 1-second / 1-minute rollups; rollups are also used when the raw
+      frames for start_date have already expired. The chosen tier is returned as "tier".
+    - tz (optional): Timezone of start_date/end_date values without an offset and of the
+      returned timestamps, as an IANA name ("Asia/Karachi") or offset ("+05:00").
+      Default HISTORY_DEFAULT_TZ (UTC). Stored times are UTC.
 
     If no date filters provided, returns all available data (paginated).
     """
@@ -1780,6 +1976,10 @@ def get_mqtt_history(mqtt_topic):
     page = request.args.get("page", 1, type=int)
     per_page = request.args.get("per_page", 100, type=int)
     include_positions = request.args.get("include_positions", "true").lower() == "true"
+    resolution = max(0, request.args.get("resolution", 0, type=int))
+    tz, output_tz = _history_tz()
+    if tz is None:
+        return jsonify({"msg": "Invalid tz. Use an IANA name (e.g. Asia/Karachi) or an offset like +05:00"}), 400
 
     # Validate pagination
     if page < 1:
@@ -1790,155 +1990,82 @@ def get_mqtt_history(mqtt_topic):
         per_page = 1000
 
     # Build query
-    query = {"$or": [{"mqtt_topic": mqtt_topic}, {"topic": mqtt_topic}]}
+    query = {TOPIC_KEY: mqtt_topic}
+    if tag_id is not None:
+        query[TAG_KEY] = tag_id
 
     # Parse and add date filters
     date_filter = {}
     if start_date_str:
         try:
             start_date = datetime.datetime.fromisoformat(start_date_str.replace('Z', '+00:00'))
-            date_filter["$gte"] = start_date
+            date_filter["$gte"] = _to_utc(start_date, tz)
         except ValueError:
             return jsonify({"msg": "Invalid start_date format. Use ISO format: YYYY-MM-DDTHH:MM:SS"}), 400
 
     if end_date_str:
         try:
             end_date = datetime.datetime.fromisoformat(end_date_str.replace('Z', '+00:00'))
-            date_filter["$lte"] = end_date
+            date_filter["$lte"] = _to_utc(end_date, tz)
         except ValueError:
             return jsonify({"msg": "Invalid end_date format. Use ISO format: YYYY-MM-DDTHH:MM:SS"}), 400
 
     if date_filter:
-        query["$or"] = [
-            {"received_at": date_filter},
-            {"ts": date_filter},
-            {"timestamp": date_filter}
-        ]
-        # Rebuild query to include both topic and date filters
-        query = {
-            "$and": [
-                {"$or": [{"mqtt_topic": mqtt_topic}, {"topic": mqtt_topic}]},
-                {"$or": [
-                    {"received_at": date_filter},
-                    {"ts": date_filter}
-                ]}
-            ]
-        }
+        query["ts"] = date_filter
 
-    # Get total count for pagination
-    total_count = mqtt_data_collection.count_documents(query)
-    total_pages = math.ceil(total_count / per_page) if total_count > 0 else 1
+    # Get room for position calculation if needed
+    room = rooms_collection.find_one({"mqtt_topic": mqtt_topic, "email": email})
 
-    # Get paginated data
+    # Raw frames, or a rollup tier if raw data has expired / a coarser resolution was asked for
+    tier = pick_history_tier(date_filter.get("$gte"), resolution,
+                             raw_days=topic_raw_days(db["retention_policies"], mqtt_topic))
     skip = (page - 1) * per_page
-    mqtt_records = list(mqtt_data_collection.find(query).sort([
-        ("ts", -1),
-        ("received_at", -1),
-        ("timestamp", -1)
-    ]).skip(skip).limit(per_page))
+    if tier["collection"]:
+        results, total_count = _rollup_history_page(
+            tier, mqtt_topic, date_filter, tag_id, skip, per_page, room, include_positions, output_tz)
+        mqtt_records = []
+    else:
+        results = []
+        # Get total count for pagination
+        total_count = mqtt_data_collection.count_documents(query)
+        # Get paginated data
+        mqtt_records = expand_ranges_batch(
+            list(mqtt_data_collection.find(query).sort("ts", -1).skip(skip).limit(per_page)))
 
-    # Get room for position calculation if needed
-    room = rooms_collection.find_one({"mqtt_topic": mqtt_topic, "email": email})
+    total_pages = math.ceil(total_count / per_page) if total_count > 0 else 1
+
+    # Typed tag_id/ranges fields, or the legacy "data"/"message" JSON string
+    parsed = [record_tag_ranges(record) for record in mqtt_records]
+    geometry = room_geometry(room)
+    positions = _page_positions(mqtt_records, [ranges for _, ranges in parsed], geometry) if include_positions else None
 
     # Process records
-    results = []
-    for record in mqtt_records:
-        # Parse tag data from the record
-        data_str = record.get("data") or record.get("message", "")
-        tag_info = None
-        parsed_tag_id = None
-        ranges = []
-
-        if data_str:
-            try:
-                tag_info = json.loads(data_str)
-                parsed_tag_id = tag_info.get("id")
-                ranges = tag_info.get("range", [])
-            except (json.JSONDecodeError, ValueError, TypeError):
-                pass
-
-        # Filter by tag_id if specified
-        if tag_id is not None and parsed_tag_id != tag_id:
-            continue
+    for index, record in enumerate(mqtt_records):
+        parsed_tag_id, ranges = parsed[index]
 
-        # Get timestamp
-        timestamp = record.get("ts") or record.get("received_at") or record.get("timestamp")
-        if hasattr(timestamp, 'isoformat'):
-            timestamp_str = timestamp.isoformat()
-        else:
-            timestamp_str = str(timestamp) if timestamp else None
+        # Get timestamp (stored in UTC; rendered in the requested tz)
+        timestamp_str = _format_ts(record.get("ts"), output_tz)
 
         result_item = {
             "record_id": str(record.get("_id")),
             "tag_id": parsed_tag_id,
-            "ranges": {
-                "A0": ranges[0] if len(ranges) > 0 else None,
-                "A1": ranges[1] if len(ranges) > 1 else None,
-                "A2": ranges[2] if len(ranges) > 2 else None,
-                "A3": ranges[3] if len(ranges) > 3 else None
-            },
+            "ranges": ranges_by_anchor(ranges, geometry),
             "raw_ranges": ranges,
             "timestamp": timestamp_str,
             "device_id": record.get("device_id"),
             "data_type": record.get("data_type")
         }
 
-        # Calculate position if room exists and positions requested
-        if include_positions and room and len(ranges) >= 4:
-            width = float(room.get("width_in", 0))
-            height = float(room.get("height_in", 0))
-
-            if width > 0 and height > 0:
-                anchor_positions = [
-                    (0, 0),           # A0
-                    (width, 0),       # A1
-                    (width, height),  # A2
-                    (0, height)       # A3
-                ]
-
-                # Get valid distances
-                distances = [(i, r) for i, r in enumerate(ranges[:4]) if r > 0]
-
-                if len(distances) >= 3:
-                    distances.sort(key=lambda x: x[1])
-                    selected_ids = [distances[i][0] for i in range(3)]
-
-                    x_sum, y_sum, count = 0.0, 0.0, 0
-                    for i in range(3):
-                        for j in range(i + 1, 3):
-                            a_id, b_id = selected_ids[i], selected_ids[j]
-                            a_x, a_y = anchor_positions[a_id]
-                            b_x, b_y = anchor_positions[b_id]
-                            temp_x, temp_y = three_point_calculation(a_x, a_y, b_x, b_y, ranges[a_id], ranges[b_id])
-                            x_sum += temp_x
-                            y_sum += temp_y
-                            count += 1
-
-                    if count > 0:
-                        x = max(0.0, min(width, x_sum / count))
-                        y = max(0.0, min(height, y_sum / count))
-
-                        result_item["position"] = {
-                            "x": round(x, 2),
-                            "y": round(y, 2),
-                            "x_normalized": round(x / width, 4) if width > 0 else None,
-                            "y_normalized": round(y / height, 4) if height > 0 else None,
-                            "selected_anchors": [f"A{id}" for id in selected_ids]
-                        }
-                    else:
-                        result_item["position"] = None
-                else:
-                    result_item["position"] = None
-            else:
-                result_item["position"] = None
-        elif include_positions:
-            result_item["position"] = None
+        # Position stored at ingest if it was computed for this room size, else solved for the page above
+        if include_positions:
+            result_item["position"] = positions[index]
 
         results.append(result_item)
 
     # Build response
     response = {
         "mqtt_topic": mqtt_topic,
+        "tier": tier["name"],
         "data": results,
         "count": len(results),
         "pagination": {
@@ -1953,6 +2080,8 @@ def get_mqtt_history(mqtt_topic):
             "start_date": start_date_str,
             "end_date": end_date_str,
             "tag_id": tag_id,
+            "resolution": resolution,
+            "tz": request.args.get("tz") or HISTORY_DEFAULT_TZ,
             "include_positions": include_positions
         }
     }
@@ -1969,7 +2098,7 @@ def get_mqtt_history(mqtt_topic):
             "image_url": f"http://{get_server_ip()}/uploads/{image_file}" if image_file else None
         }
 
-    return jsonify(response), 200
+    return api_response(response)
 
 
 @app.route("/api/mqtt/data/<mqtt_topic>/history/by-date", methods=["GET"])
@@ -1985,6 +2114,9 @@ def get_mqtt_history_by_date(mqtt_topic):
     - page (optional): Page number (default: 1)
     - per_page (optional): Records per page (default: 100, max: 1000)
     - include_positions (optional): Include calculated x,y positions (default: true)
+    - resolution (optional): Coarsest acceptable bucket in seconds, as for /history
+    - tz (optional): Timezone the date/hour/minute refer to and timestamps are returned in,
+      as for /history (default HISTORY_DEFAULT_TZ, UTC)
     """
     token = request.headers.get("Authorization")
     if not token:
@@ -2011,6 +2143,10 @@ def get_mqtt_history_by_date(mqtt_topic):
     page          = max(1, request.args.get("page", 1, type=int))
     per_page      = min(1000, max(1, request.args.get("per_page", 100, type=int)))
     include_positions = request.args.get("include_positions", "true").lower() == "true"
+    resolution    = max(0, request.args.get("resolution", 0, type=int))
+    tz, output_tz = _history_tz()
+    if tz is None:
+        return jsonify({"msg": "Invalid tz. Use an IANA name (e.g. Asia/Karachi) or an offset like +05:00"}), 400
 
     if not date_str:
         return jsonify({"msg": "date is required (format: YYYY-MM-DD)"}), 400
@@ -2043,97 +2179,57 @@ def get_mqtt_history_by_date(mqtt_topic):
         range_start = parsed_date.replace(hour=0,  minute=0,  second=0,  microsecond=0)
         range_end   = parsed_date.replace(hour=23, minute=59, second=59, microsecond=999999)
 
+    # The window is local to tz; stored ts is UTC, so query the converted bounds
+    range_start = _to_utc(range_start, tz)
+    range_end = _to_utc(range_end, tz)
     date_filter = {"$gte": range_start, "$lte": range_end}
 
-    query = {
-        "$and": [
-            {"$or": [{"mqtt_topic": mqtt_topic}, {"topic": mqtt_topic}]},
-            {"$or": [{"ts": date_filter}, {"received_at": date_filter}]}
-        ]
-    }
-
-    total_count = mqtt_data_collection.count_documents(query)
-    total_pages = math.ceil(total_count / per_page) if total_count > 0 else 1
-    skip = (page - 1) * per_page
-
-    mqtt_records = list(mqtt_data_collection.find(query)
-                        .sort([("ts", -1), ("received_at", -1)])
-                        .skip(skip).limit(per_page))
+    query = {TOPIC_KEY: mqtt_topic, "ts": date_filter}
+    if tag_id is not None:
+        query[TAG_KEY] = tag_id
 
     room = rooms_collection.find_one({"mqtt_topic": mqtt_topic, "email": email})
 
-    results = []
-    for record in mqtt_records:
-        data_str = record.get("data") or record.get("message", "")
-        parsed_tag_id = None
-        ranges = []
+    tier = pick_history_tier(range_start, resolution, raw_days=topic_raw_days(db["retention_policies"], mqtt_topic))
+    skip = (page - 1) * per_page
+    if tier["collection"]:
+        results, total_count = _rollup_history_page(
+            tier, mqtt_topic, date_filter, tag_id, skip, per_page, room, include_positions, output_tz)
+        mqtt_records = []
+    else:
+        results = []
+        total_count = mqtt_data_collection.count_documents(query)
+        mqtt_records = expand_ranges_batch(list(mqtt_data_collection.find(query)
+                                                .sort("ts", -1)
+                                                .skip(skip).limit(per_page)))
 
-        if data_str:
-            try:
-                tag_info = json.loads(data_str)
-                parsed_tag_id = tag_info.get("id")
-                ranges = tag_info.get("range", [])
-            except (json.JSONDecodeError, ValueError, TypeError):
-                pass
+    total_pages = math.ceil(total_count / per_page) if total_count > 0 else 1
 
-        if tag_id is not None and parsed_tag_id != tag_id:
-            continue
+    parsed = [record_tag_ranges(record) for record in mqtt_records]
+    geometry = room_geometry(room)
+    positions = _page_positions(mqtt_records, [ranges for _, ranges in parsed], geometry) if include_positions else None
+
+    for index, record in enumerate(mqtt_records):
+        parsed_tag_id, ranges = parsed[index]
 
-        timestamp = record.get("ts") or record.get("received_at") or record.get("timestamp")
-        timestamp_str = timestamp.isoformat() if hasattr(timestamp, "isoformat") else str(timestamp) if timestamp else None
+        timestamp_str = _format_ts(record.get("ts"), output_tz)
 
         item = {
             "record_id": str(record.get("_id")),
             "tag_id": parsed_tag_id,
-            "ranges": {
-                "A0": ranges[0] if len(ranges) > 0 else None,
-                "A1": ranges[1] if len(ranges) > 1 else None,
-                "A2": ranges[2] if len(ranges) > 2 else None,
-                "A3": ranges[3] if len(ranges) > 3 else None
-            },
+            "ranges": ranges_by_anchor(ranges, geometry),
             "raw_ranges": ranges,
             "timestamp": timestamp_str
         }
 
-        if include_positions and room and len(ranges) >= 4:
-            width  = float(room.get("width_in", 0))
-            height = float(room.get("height_in", 0))
-            if width > 0 and height > 0:
-                anchor_positions = [(0,0),(width,0),(width,height),(0,height)]
-                distances = [(i, r) for i, r in enumerate(ranges[:4]) if r > 0]
-                if len(distances) >= 3:
-                    distances.sort(key=lambda x: x[1])
-                    sel = [distances[i][0] for i in range(3)]
-                    xs, ys, cnt = 0.0, 0.0, 0
-                    for i in range(3):
-                        for j in range(i+1, 3):
-                            ax, ay = anchor_positions[sel[i]]
-                            bx, by = anchor_positions[sel[j]]
-                            tx, ty = three_point_calculation(ax, ay, bx, by, ranges[sel[i]], ranges[sel[j]])
-                            xs += tx; ys += ty; cnt += 1
-                    if cnt > 0:
-                        x = max(0.0, min(width,  xs / cnt))
-                        y = max(0.0, min(height, ys / cnt))
-                        item["position"] = {
-                            "x": round(x, 2),
-                            "y": round(y, 2),
-                            "x_normalized": round(x / width,  4),
-                            "y_normalized": round(y / height, 4),
-                            "selected_anchors": [f"A{i}" for i in sel]
-                        }
-                    else:
-                        item["position"] = None
-                else:
-                    item["position"] = None
-            else:
-                item["position"] = None
-        elif include_positions:
-            item["position"] = None
+        if include_positions:
+            item["position"] = positions[index]
 
         results.append(item)
 
     response = {
         "mqtt_topic": mqtt_topic,
+        "tier": tier["name"],
         "data": results,
         "count": len(results),
         "pagination": {
@@ -2149,10 +2245,12 @@ def get_mqtt_history_by_date(mqtt_topic):
             "hour": hour,
             "minute": minute,
             "time_window": {
-                "from": range_start.isoformat(),
-                "to":   range_end.isoformat()
+                "from": _format_ts(range_start, output_tz),
+                "to":   _format_ts(range_end, output_tz)
             },
             "tag_id": tag_id,
+            "resolution": resolution,
+            "tz": request.args.get("tz") or HISTORY_DEFAULT_TZ,
             "include_positions": include_positions
         }
     }
@@ -2168,7 +2266,7 @@ def get_mqtt_history_by_date(mqtt_topic):
             "image_url": f"http://{get_server_ip()}/uploads/{image_file}" if image_file else None
         }
 
-    return jsonify(response), 200
+    return api_response(response)
 
 
 
@@ -2246,14 +2344,116 @@ def backfill_used_topics():
         import traceback
         traceback.print_exc()
 
+# Indexes backing every lookup the routes and the WebSocket loop do.
+# (collection, keys, options)
+INDEX_SPECS = [
+    (users_collection, [("email", ASCENDING)], {"unique": True}),
+    (used_emails_collection, [("email", ASCENDING)], {"unique": True}),
+    (used_topics_collection, [("mqtt_topic", ASCENDING)], {"unique": True}),
+    (enrollments_collection, [("email", ASCENDING), ("mqtt_topic", ASCENDING)], {}),
+    (enrollments_collection, [("mqtt_topic", ASCENDING)], {}),
+    (rooms_collection, [("mqtt_topic", ASCENDING), ("email", ASCENDING)], {}),
+    (rooms_collection, [("email", ASCENDING)], {}),
+    (mqtt_data_collection, [(TOPIC_KEY, ASCENDING), ("ts", DESCENDING)], {}),
+    (mqtt_data_collection, [(TOPIC_KEY, ASCENDING), (TAG_KEY, ASCENDING), ("ts", DESCENDING)], {}),
+    # change feed polling fallback (see MqttDataWatcher._poll)
+    (mqtt_data_collection, [(TOPIC_KEY, ASCENDING), (STORED_AT_FIELD, ASCENDING)], {}),
+    (latest_state_collection, [("mqtt_topic", ASCENDING)], {}),
+]
+
+def ensure_indexes():
+    """
+    Create the indexes in INDEX_SPECS if they don't exist yet.
+    A failure (e.g. duplicates blocking a unique index) is reported, not raised.
+    """
+    created = 0
+    for collection, keys, options in INDEX_SPECS:
+        try:
+            collection.create_index(keys, **options)
+            created += 1
+        except Exception as e:
+            print(f"⚠ Warning: Could not create index {keys} on {collection.name}: {e}")
+    print(f"✓ Ensured {created}/{len(INDEX_SPECS)} indexes")
+
+    try:
+        ensure_retention_indexes(db, mqtt_data_collection)
+        print("✓ Ensured retention (TTL) and rollup indexes")
+    except Exception as e:
+        print(f"⚠ Warning: Could not create retention indexes: {e}")
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() query plan tree."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+def report_collscans():
+    """
+    explain() the hot-path queries against a sample topic/email and report
+    any whose winning plan is a COLLSCAN (i.e. a missing index).
+    """
+    sample = enrollments_collection.find_one({}, {"email": 1, "mqtt_topic": 1})
+    if not sample:
+        print("✓ Skipped query plan check (no enrollments yet)")
+        return
+    email = sample.get("email", "")
+    topic = sample.get("mqtt_topic", "")
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+
+    hot_queries = {
+        "users_auth by email": users_collection.find({"email": email}).limit(1),
+        "used_emails by email": used_emails_collection.find({"email": email}).limit(1),
+        "used_mqtt_topics by topic": used_topics_collection.find({"mqtt_topic": topic, "enrolled": True}).limit(1),
+        "enrolled_devices by email+topic": enrollments_collection.find({"email": email, "mqtt_topic": topic}).limit(1),
+        "enrolled_devices by email": enrollments_collection.find({"email": email}),
+        "rooms by topic": rooms_collection.find({"mqtt_topic": topic}).limit(1),
+        "rooms by topic+email": rooms_collection.find({"mqtt_topic": topic, "email": email}).limit(1),
+        "rooms by email": rooms_collection.find({"email": email}),
+        "mqtt_data latest": mqtt_data_collection.find({TOPIC_KEY: topic}).sort("ts", -1).limit(100),
+        "mqtt_data history window": mqtt_data_collection.find(
+            {TOPIC_KEY: topic, "ts": {"$gte": since}}).sort("ts", -1).limit(100),
+        "mqtt_data history by tag": mqtt_data_collection.find(
+            {TOPIC_KEY: topic, TAG_KEY: 0}).sort("ts", -1).limit(100),
+    }
+
+    collscans = []
+    checked = 0
+    for name, cursor in hot_queries.items():
+        try:
+            plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        except Exception as e:
+            print(f"⚠ Warning: Could not explain '{name}': {e}")
+            continue
+        checked += 1
+        if "COLLSCAN" in set(_plan_stages(plan)):
+            collscans.append(name)
+
+    for name in collscans:
+        print(f"⚠ Warning: COLLSCAN in hot-path query '{name}'")
+    print(f"✓ Checked {checked}/{len(hot_queries)} hot-path query plans, {len(collscans)} COLLSCAN(s)")
+
 # Backfill on startup (only when server actually starts)
 def initialize_server():
-    """Initialize server - backfill collections with existing data"""
+    """Initialize server - ensure indexes, backfill collections with existing data"""
     print("\n" + "="*50)
     print("Initializing UWB Server...")
     print("="*50)
+    ensure_indexes()
     backfill_used_emails()
     backfill_used_topics()
+    report_collscans()
+    if os.getenv("ROLLUP_IN_SERVER", "0").lower() in ("1", "true", "yes"):
+        start_rollup_thread(db, mqtt_data_collection)
+        print("✓ Started rollup job (1s/1m tiers)")
+    if REALTIME_MODE == "push":
+        start_realtime_push()
+    elif tag_tracker is not None:
+        start_tracking_feed()
     print("="*50 + "\n")
 
 # ====== WEBSOCKET ENDPOINTS ======
@@ -2261,6 +2461,408 @@ def initialize_server():
 # Store active WebSocket connections
 active_connections = {}
 
+# Viewers of the same (mqtt_topic, room_id) share one Socket.IO room and one
+# broadcaster, so positions are computed once per tick however many dashboards
+# watch. The broadcaster is reference counted by its viewers and stops when the
+# last one leaves (stop_visualization, disconnect, or starting another room).
+#
+# Viewers pick a protocol in start_visualization:
+#   "full"  (default) - position_update with the whole payload every tick
+#   "delta"           - visualization_started carries a full snapshot and its
+#                       seq; afterwards position_delta only lists tags whose
+#                       position/ranges changed (plus removed ones), seq+1 each
+#                       time. A client that sees a gap emits `resync` and gets
+#                       position_snapshot.
+# and, in the connect handshake (query or auth "format"), an encoding for these
+# events: "json" (default), "msgpack" or "columnar" (see wire_format). Each
+# (protocol, format) pair is its own Socket.IO room, encoded once per tick.
+_broadcasters = {}  # (topic, room_id) -> {"room", "viewers": {sid: (update_interval, channel)}, "seq", "snapshot", ...}
+_broadcasters_lock = threading.Lock()
+
+# Several nodes (SOCKETIO_MESSAGE_QUEUE set): an emit reaches the viewers on
+# every node, so each (topic, room_id) is computed by one node only, the holder
+# of its lease in broadcast_leases. Nodes with local viewers register their
+# channels there every BROADCAST_LEASE_S/3 and take the lease over once it
+# expires; the holder broadcasts to the union of all channels and keeps its
+# latest snapshot/seq in the lease so delta viewers can sync on any node.
+CLUSTERED = bool(SOCKETIO_MESSAGE_QUEUE)
+NODE_ID = uuid.uuid4().hex
+BROADCAST_LEASE_S = float(os.getenv("BROADCAST_LEASE_S", "5"))
+broadcast_leases_collection = db[os.getenv("BROADCAST_LEASE_COLLECTION", "broadcast_leases")]
+_lease_loop_started = False
+
+# Real-time delivery. "poll": each broadcaster recomputes every update_interval
+# (the smallest requested by its viewers). "push": a single watcher follows new
+# mqtt_data records (change stream, or polling of the watched topics on a
+# standalone mongod) and a broadcaster only emits when its topic received data,
+# coalesced over REALTIME_PUSH_MIN_INTERVAL_S.
+REALTIME_MODE = os.getenv("REALTIME_MODE", "poll").lower()
+REALTIME_PUSH_MIN_INTERVAL_S = float(os.getenv("REALTIME_PUSH_MIN_INTERVAL_S", "0.05"))
+# Polling fallback only: how far the cursor trails stored_at. Must cover the
+# clock skew between writers (bridge, API) and this server.
+CHANGE_FEED_OVERLAP_S = float(os.getenv("CHANGE_FEED_OVERLAP_S", "5"))
+
+# Broadcasters re-check their viewers' enrollment this often (cached in
+# between) and drop viewers whose access to the topic was revoked
+VIEWER_RECHECK_S = float(os.getenv("VIEWER_RECHECK_S", "5"))
+
+_dirty_topics = set()
+_dirty_lock = threading.Lock()
+_dirty_event = threading.Event()
+realtime_watcher = None
+
+
+def _viz_room(topic, room_id, channel=("full", "json")):
+    room = f"viz:{topic}:{room_id}"
+    return room if channel == ("full", "json") else f"{room}:{channel[0]}:{channel[1]}"
+
+
+def _position_update_payload(topic, room_id, room_data):
+    """(position_update payload, error) for a room; viewer access is checked by _recheck_viewers."""
+    tag_positions, error = calculate_tag_positions(topic, room_data, None, check_access=False)
+    if error:
+        return None, error
+    tag_positions = {str(tag_id): entry for tag_id, entry in tag_positions.items()}  # as they go over the wire
+
+    geometry = room_geometry(room_data)
+    img_file = room_data.get("image_file")
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'room_id': room_id,
+        'mqtt_topic': topic,
+        'room_dimensions_in': {
+            'width_in': geometry.width,
+            'height_in': geometry.height
+        },
+        'image_url': f"http://{get_server_ip()}/uploads/{img_file}" if img_file else None,
+        'anchor_positions': anchor_positions(geometry),
+        'tag_positions': tag_positions,
+        'tag_count': len(tag_positions)
+    }, None
+
+
+def _measured(entry):
+    """A tag entry without its frame timestamp, and its Kalman block reduced to the frames it consumed."""
+    measured = {k: v for k, v in entry.items() if k not in ("timestamp", "kalman")}
+    if "kalman" in entry:
+        measured["kalman_updates"] = entry["kalman"]["updates"]
+    return measured
+
+
+def _tag_changed(old, new):
+    """
+    A tag entry differs in anything but its frame timestamp. The Kalman
+    prediction moves every tick on its own, so it only counts once the filter
+    has consumed a new frame (delta clients extrapolate with vx/vy in between).
+    """
+    if old is None:
+        return True
+    return _measured(old) != _measured(new)
+
+
+def _lease_id(key):
+    return f"{key[0]}:{key[1]}"
+
+
+def _sync_lease(key, broadcaster):
+    """Register this node's viewers of key and take or renew its broadcast lease (CLUSTERED only)."""
+    with broadcaster["lease_lock"]:  # join and _lease_loop may sync the same key at once
+        _sync_lease_locked(key, broadcaster)
+
+
+def _sync_lease_locked(key, broadcaster):
+    now = datetime.datetime.utcnow()
+    expires = now + datetime.timedelta(seconds=BROADCAST_LEASE_S)
+    with _broadcasters_lock:
+        local = {channel for _, channel in broadcaster["viewers"].values()}
+    try:
+        lease = broadcast_leases_collection.find_one_and_update(
+            {"_id": _lease_id(key)},
+            {"$set": {f"nodes.{NODE_ID}": {"channels": [list(c) for c in local], "expires": expires}}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        owner = lease.get("owner")
+        owned = False
+        if owner == NODE_ID:
+            owned = broadcast_leases_collection.update_one(
+                {"_id": _lease_id(key), "owner": NODE_ID},
+                {"$set": {"owner_expires": expires}}).modified_count == 1
+        elif owner is None or lease.get("owner_expires", now) <= now:
+            # compare-and-set against what we just read: one node wins a takeover
+            owned = broadcast_leases_collection.update_one(
+                {"_id": _lease_id(key), "owner": owner, "owner_expires": lease.get("owner_expires")},
+                {"$set": {"owner": NODE_ID, "owner_expires": expires}}).modified_count == 1
+    except Exception as e:
+        print(f"⚠ Warning: broadcast lease sync failed for {key}: {e}")
+        return
+
+    channels = {tuple(c) for node in lease.get("nodes", {}).values() if node.get("expires", now) > now
+                for c in node.get("channels", [])}
+    with _broadcasters_lock:
+        if owned and not broadcaster["owner"] and lease.get("snapshot"):
+            # carry on from the previous holder's sequence
+            broadcaster["snapshot"] = json.loads(lease["snapshot"])
+            broadcaster["seq"] = lease.get("seq", 0)
+        broadcaster["owner"] = owned
+        broadcaster["channels"] = channels | local
+
+
+def _release_lease(key, broadcaster):
+    """This node has no viewers of key left: deregister and hand the lease on."""
+    try:
+        broadcast_leases_collection.update_one({"_id": _lease_id(key)}, {"$unset": {f"nodes.{NODE_ID}": ""}})
+        if broadcaster["owner"]:
+            broadcast_leases_collection.update_one({"_id": _lease_id(key), "owner": NODE_ID},
+                                                   {"$set": {"owner": None, "owner_expires": None}})
+    except Exception as e:
+        print(f"⚠ Warning: broadcast lease release failed for {key}: {e}")
+
+
+def _lease_loop():
+    while True:
+        with _broadcasters_lock:
+            current = list(_broadcasters.items())
+        for key, broadcaster in current:
+            _sync_lease(key, broadcaster)
+        socketio.sleep(BROADCAST_LEASE_S / 3)
+
+
+def _revoke_viewer(sid):
+    """Stop a viewer's stream after its enrollment in the topic was revoked."""
+    conn = active_connections.get(sid)
+    if not conn or not conn.get("mqtt_topic") or not conn.get("room_id"):
+        return
+    room = _viz_room(conn["mqtt_topic"], conn["room_id"], (conn.get("protocol", "full"), conn.get("format", "json")))
+    _leave_visualization(sid, leave=False)
+    socketio.server.leave_room(sid, room, namespace="/")  # no request context here
+    conn.update(active=False, room_id=None, mqtt_topic=None)
+    socketio.emit('error', {'msg': "You don't have access to this MQTT topic"}, to=sid)
+    socketio.emit('visualization_stopped', {'msg': 'Visualization stopped: access revoked'}, to=sid)
+
+
+def _recheck_viewers(key, broadcaster):
+    """Drop this node's viewers of key that are no longer enrolled in its topic (every VIEWER_RECHECK_S)."""
+    now = time.monotonic()
+    with _broadcasters_lock:
+        if now - broadcaster["checked_at"] < VIEWER_RECHECK_S:
+            return
+        broadcaster["checked_at"] = now
+        sids = list(broadcaster["viewers"])
+    emails = {sid: active_connections[sid]["email"] for sid in sids if sid in active_connections}
+    if not emails:
+        return
+    try:
+        allowed = {doc["email"] for doc in enrollments_collection.find(
+            {"mqtt_topic": key[0], "email": {"$in": list(set(emails.values()))}}, {"email": 1})}
+    except Exception as e:
+        print(f"⚠ Warning: could not re-check viewers of topic {key[0]}: {e}")
+        return
+    for sid, email in emails.items():
+        if email not in allowed:
+            print(f"WebSocket viewer dropped, access revoked: {email} (sid: {sid})")
+            _revoke_viewer(sid)
+
+
+def _broadcast(key, broadcaster):
+    """Recompute a (topic, room_id) once; position_update to full viewers, position_delta to delta viewers."""
+    topic, room_id = key
+    _recheck_viewers(key, broadcaster)  # on every node: viewers are local, the lease is not
+    with _broadcasters_lock:
+        if not broadcaster["owner"]:
+            return  # another node holds the lease
+        channels = set(broadcaster["channels"]) | {channel for _, channel in broadcaster["viewers"].values()}
+    try:
+        payload, error = _position_update_payload(topic, room_id, broadcaster["room"])
+        if error:
+            for channel in channels:
+                socketio.emit('error', {'msg': error}, to=_viz_room(topic, room_id, channel))
+            return
+
+        with _broadcasters_lock:
+            previous = broadcaster["snapshot"]["tag_positions"] if broadcaster["snapshot"] else {}
+            tags = payload["tag_positions"]
+            changed = {tag_id: entry for tag_id, entry in tags.items() if _tag_changed(previous.get(tag_id), entry)}
+            removed = [tag_id for tag_id in previous if tag_id not in tags]
+            advanced = bool(changed or removed or broadcaster["snapshot"] is None)
+            if advanced:
+                broadcaster["seq"] += 1
+            seq = broadcaster["seq"]
+            broadcaster["snapshot"] = payload
+
+        if CLUSTERED and advanced:
+            broadcast_leases_collection.update_one(
+                {"_id": _lease_id(key), "owner": NODE_ID},
+                {"$set": {"snapshot": json.dumps(payload, default=str), "seq": seq}})
+
+        delta = {
+            'seq': seq,
+            'timestamp': payload['timestamp'],
+            'room_id': room_id,
+            'mqtt_topic': topic,
+            'tag_positions': changed,
+            'removed_tags': removed,
+            'tag_count': payload['tag_count']
+        }
+        for protocol, fmt in channels:
+            if protocol == "full":
+                socketio.emit('position_update', wire_format.encode(payload, fmt),
+                              to=_viz_room(topic, room_id, (protocol, fmt)))
+            elif changed or removed:
+                socketio.emit('position_delta', wire_format.encode(delta, fmt),
+                              to=_viz_room(topic, room_id, (protocol, fmt)))
+    except Exception as e:
+        try:
+            for channel in channels:
+                socketio.emit('error', {'msg': f'Update error: {str(e)}'}, to=_viz_room(topic, room_id, channel))
+        except Exception:
+            pass
+
+
+def _snapshot(key, broadcaster):
+    """Current full payload plus its seq (computed first if the broadcaster has none yet), or None."""
+    if not broadcaster["owner"]:
+        lease = broadcast_leases_collection.find_one({"_id": _lease_id(key)}, {"snapshot": 1, "seq": 1})
+        if not lease or not lease.get("snapshot"):
+            return None
+        return {**json.loads(lease["snapshot"]), 'seq': lease.get("seq", 0)}
+    if broadcaster["snapshot"] is None:
+        _broadcast(key, broadcaster)
+    with _broadcasters_lock:
+        if broadcaster["snapshot"] is None:
+            return None
+        return {**broadcaster["snapshot"], 'seq': broadcaster["seq"]}
+
+
+def _broadcast_loop(key, broadcaster):
+    """Poll-mode broadcaster; exits once its entry is dropped from _broadcasters."""
+    while True:
+        with _broadcasters_lock:
+            if _broadcasters.get(key) is not broadcaster:
+                return
+            interval = min(interval for interval, _ in broadcaster["viewers"].values())
+        _broadcast(key, broadcaster)
+        socketio.sleep(interval)
+
+
+def _join_visualization(sid, topic, room_id, room, update_interval, channel):
+    """Register a viewer; returns (broadcaster, created). The caller joins the Socket.IO room."""
+    global _lease_loop_started
+    key = (topic, room_id)
+    with _broadcasters_lock:
+        broadcaster = _broadcasters.get(key)
+        created = broadcaster is None
+        if created:
+            broadcaster = _broadcasters[key] = {"room": room, "viewers": {}, "seq": 0, "snapshot": None,
+                                                "owner": not CLUSTERED, "channels": set(),
+                                                "lease_lock": threading.Lock(), "checked_at": time.monotonic()}
+        broadcaster["room"] = room
+        broadcaster["viewers"][sid] = (update_interval, channel)
+    if CLUSTERED:
+        _sync_lease(key, broadcaster)
+        if not _lease_loop_started:
+            _lease_loop_started = True
+            socketio.start_background_task(_lease_loop)
+    return broadcaster, created
+
+
+def _leave_visualization(sid, leave=True):
+    """Drop a viewer from the broadcaster it is attached to (the last one stops it)."""
+    conn = active_connections.get(sid)
+    if not conn or not conn.get("mqtt_topic") or not conn.get("room_id"):
+        return
+    key = (conn["mqtt_topic"], conn["room_id"])
+    stopped = None
+    with _broadcasters_lock:
+        broadcaster = _broadcasters.get(key)
+        if broadcaster:
+            broadcaster["viewers"].pop(sid, None)
+            if not broadcaster["viewers"]:
+                stopped = _broadcasters.pop(key)
+    if stopped is not None and CLUSTERED:
+        _release_lease(key, stopped)
+    if leave:
+        leave_room(_viz_room(*key, (conn.get("protocol", "full"), conn.get("format", "json"))), sid=sid)
+
+
+def _watched_topics():
+    with _broadcasters_lock:
+        return {topic for topic, _ in _broadcasters}
+
+
+def _tracked_topics():
+    """Topics whose frames the change feed follows: watched rooms plus those with Kalman tracks."""
+    topics = _watched_topics()
+    if tag_tracker is not None:
+        topics |= tag_tracker.topics()
+    return topics
+
+
+def _track_records(records):
+    """Feed every new frame of a tracked topic to its tag's Kalman track, not just the newest per tick."""
+    tracked = tag_tracker.topics() | _watched_topics()
+    for record in expand_ranges_batch([flatten_record(r) for r in records]):
+        topic = record.get("mqtt_topic")
+        if topic not in tracked:
+            continue
+        geometry = tracker_rooms.get(topic)
+        tag_id, ranges = record_tag_ranges(record)
+        if geometry is None or tag_id is None or len(ranges) < MIN_ANCHORS:
+            continue
+        fix = stored_position(record, geometry) or solve_fix(ranges, geometry)
+        if fix is not None:
+            tag_tracker.observe((topic, tag_id), geometry, fix, record.get("ts"))
+
+
+def _on_new_records(records):
+    """Change-feed consumer: refresh the latest-state store and mark topics for a push."""
+    latest_state.update(records, share=False)  # the writer already shared them
+    if tag_tracker is not None:
+        _track_records(records)
+    # not just the keys update() reports as changed: writers in this process updated the store already
+    topics = {flatten_record(r).get("mqtt_topic") for r in records} & _watched_topics()
+    if topics:
+        with _dirty_lock:
+            _dirty_topics.update(topics)
+        _dirty_event.set()
+
+
+def _push_loop():
+    while True:
+        _dirty_event.wait()
+        socketio.sleep(REALTIME_PUSH_MIN_INTERVAL_S)  # coalesce a burst of frames into one update
+        with _dirty_lock:
+            topics = set(_dirty_topics)
+            _dirty_topics.clear()
+            _dirty_event.clear()
+
+        with _broadcasters_lock:
+            due = [(key, b) for key, b in _broadcasters.items() if key[0] in topics]
+        for key, broadcaster in due:
+            _broadcast(key, broadcaster)
+
+
+def start_realtime_push():
+    """Start the change-feed watcher and the push loop (REALTIME_MODE=push)."""
+    global realtime_watcher
+    if realtime_watcher is not None:
+        return
+    # time-series collections do not support change streams: poll them directly
+    realtime_watcher = MqttDataWatcher(mqtt_data_collection, _on_new_records, _tracked_topics, TOPIC_KEY,
+                                       use_change_stream=not TIMESERIES_MODE, overlap_s=CHANGE_FEED_OVERLAP_S)
+    realtime_watcher.start()
+    socketio.start_background_task(_push_loop)
+    print("✓ Started real-time push (change feed)")
+
+
+def start_tracking_feed():
+    """Follow new frames for the Kalman tracks only (POSITION_FILTER=kalman in poll mode)."""
+    global realtime_watcher
+    if realtime_watcher is not None or tag_tracker is None:
+        return
+    realtime_watcher = MqttDataWatcher(mqtt_data_collection, _track_records, tag_tracker.topics, TOPIC_KEY,
+                                       use_change_stream=not TIMESERIES_MODE, overlap_s=CHANGE_FEED_OVERLAP_S)
+    realtime_watcher.start()
+    print("✓ Started Kalman tracking feed (change feed)")
+
 @socketio.on('connect')
 def handle_connect(auth=None):
     """Handle WebSocket connection - accepts token from query string or auth"""
@@ -2287,13 +2889,20 @@ def handle_connect(auth=None):
         return False
     
     email = decoded["email"]
+
+    # Encoding of position events: "json" (default), "msgpack" or "columnar"
+    fmt = request.args.get('format') or (auth or {}).get('format') or "json"
+    if not wire_format.available(fmt):
+        fmt = "json"
+
     active_connections[request.sid] = {
         "email": email,
         "room_id": None,
         "mqtt_topic": None,
+        "format": fmt,
         "active": True
     }
-    emit('connected', {'msg': 'Connected successfully', 'email': email})
+    emit('connected', {'msg': 'Connected successfully', 'email': email, 'format': fmt})
     print(f"WebSocket connected: {email} (sid: {request.sid})")
     return True
 
@@ -2302,6 +2911,7 @@ def handle_disconnect():
     """Handle WebSocket disconnection"""
     if request.sid in active_connections:
         email = active_connections[request.sid].get("email")
+        _leave_visualization(request.sid, leave=False)  # Socket.IO drops its rooms itself
         del active_connections[request.sid]
         print(f"WebSocket disconnected: {email} (sid: {request.sid})")
 
@@ -2314,7 +2924,8 @@ def handle_start_visualization(data):
     {
         "room_id": "67890abcdef1234567890123",
         "mqtt_topic": "1000087",
-        "update_interval": 0.5  // Optional, default 0.5 seconds
+        "update_interval": 0.5,  // Optional, default 0.5 seconds
+        "protocol": "delta"      // Optional, "full" (default) or "delta"
     }
     """
     if request.sid not in active_connections:
@@ -2327,10 +2938,15 @@ def handle_start_visualization(data):
     room_id = data.get("room_id")
     mqtt_topic = data.get("mqtt_topic")
     update_interval = float(data.get("update_interval", 0.5))
+    protocol = data.get("protocol", "full")
     
     if not room_id or not mqtt_topic:
         emit('error', {'msg': 'room_id and mqtt_topic are required'})
         return
+
+    if protocol not in ("full", "delta"):
+        emit('error', {'msg': 'protocol must be "full" or "delta"'})
+        return
     
     # Validate room_id
     try:
@@ -2354,80 +2970,71 @@ def handle_start_visualization(data):
         emit('error', {'msg': "You don't have access to this room"})
         return
     
+    # Checked here and again every VIEWER_RECHECK_S by the broadcaster (_recheck_viewers)
+    if not enrollments_collection.find_one({"email": email, "mqtt_topic": mqtt_topic}):
+        emit('error', {'msg': "You don't have access to this MQTT topic"})
+        return
+
+    # A second start_visualization moves the client instead of stacking another stream
+    _leave_visualization(request.sid)
+
     # Store connection info
     conn["room_id"] = room_id
     conn["mqtt_topic"] = mqtt_topic
     conn["update_interval"] = update_interval
     conn["room"] = room
-    
+    conn["protocol"] = protocol
+    conn["active"] = True
+
+    key = (mqtt_topic, room_id)
+    fmt = conn.get("format", "json")
+    channel = (protocol, fmt)
+    broadcaster, created = _join_visualization(request.sid, mqtt_topic, room_id, room, update_interval, channel)
+
     image_file = room.get("image_file")
-    emit('visualization_started', {
+    started = {
         'msg': 'Visualization started',
         'room_id': room_id,
         'mqtt_topic': mqtt_topic,
         'update_interval': update_interval,
+        'protocol': protocol,
         'image_url': f"http://{get_server_ip()}/uploads/{image_file}" if image_file else None
-    })
-
-    # Capture sid before starting thread (request context won't be available in thread)
-    client_sid = request.sid
-
-    # Start background thread for updates
-    def send_updates(sid):
-        while sid in active_connections and active_connections[sid].get("active"):
-            try:
-                conn = active_connections.get(sid)
-                if not conn or not conn.get("room_id"):
-                    break
-
-                room_data = conn["room"]
-                topic = conn["mqtt_topic"]
-                user_email = conn["email"]
-
-                # Calculate positions
-                tag_positions, error = calculate_tag_positions(topic, room_data, user_email)
-
-                if error:
-                    socketio.emit('error', {'msg': error}, to=sid)
-                else:
-                    width = float(room_data.get("width_in", 0))
-                    height = float(room_data.get("height_in", 0))
-
-                    img_file = room_data.get("image_file")
-                    socketio.emit('position_update', {
-                        'timestamp': datetime.datetime.utcnow().isoformat(),
-                        'room_id': conn["room_id"],
-                        'mqtt_topic': topic,
-                        'room_dimensions_in': {
-                            'width_in': width,
-                            'height_in': height
-                        },
-                        'image_url': f"http://{get_server_ip()}/uploads/{img_file}" if img_file else None,
-                        'anchor_positions': {
-                            'A0': {'x': 0, 'y': 0},
-                            'A1': {'x': width, 'y': 0},
-                            'A2': {'x': width, 'y': height},
-                            'A3': {'x': 0, 'y': height}
-                        },
-                        'tag_positions': tag_positions,
-                        'tag_count': len(tag_positions)
-                    }, to=sid)
-
-                time.sleep(update_interval)
-            except Exception as e:
-                try:
-                    socketio.emit('error', {'msg': f'Update error: {str(e)}'}, to=sid)
-                except:
-                    pass
-                time.sleep(update_interval)
-
-    thread = threading.Thread(target=send_updates, args=(client_sid,), daemon=True)
-    thread.start()
+    }
+    # Taken before joining the Socket.IO room: a delta missed in between shows up as a seq gap
+    snapshot = _snapshot(key, broadcaster) if protocol == "delta" or REALTIME_MODE == "push" else None
+    if protocol == "delta":
+        started['snapshot'] = wire_format.encode(snapshot, fmt) if snapshot else None
+    emit('visualization_started', started)
+    join_room(_viz_room(mqtt_topic, room_id, channel))
+
+    if REALTIME_MODE == "push":
+        # One immediate update for a full viewer; later ones come from _push_loop
+        if protocol == "full" and snapshot:
+            emit('position_update', wire_format.encode({k: v for k, v in snapshot.items() if k != 'seq'}, fmt))
+    elif created:
+        socketio.start_background_task(_broadcast_loop, key, broadcaster)
+
+@socketio.on('resync')
+def handle_resync():
+    """Full position_snapshot for a delta viewer that missed a seq."""
+    conn = active_connections.get(request.sid)
+    if not conn or not conn.get("mqtt_topic") or not conn.get("room_id"):
+        emit('error', {'msg': 'No active visualization'})
+        return
+    key = (conn["mqtt_topic"], conn["room_id"])
+    with _broadcasters_lock:
+        broadcaster = _broadcasters.get(key)
+    snapshot = _snapshot(key, broadcaster) if broadcaster else None
+    if snapshot is None:
+        emit('error', {'msg': 'No position data available yet'})
+        return
+    emit('position_snapshot', wire_format.encode(snapshot, conn.get("format", "json")))
 
 @socketio.on('stop_visualization')
 def handle_stop_visualization():
     """Stop real-time visualization"""
     if request.sid in active_connections:
+        _leave_visualization(request.sid)
         active_connections[request.sid]["active"] = False
         active_connections[request.sid]["room_id"] = None
         active_connections[request.sid]["mqtt_topic"] = None
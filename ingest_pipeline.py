@@ -0,0 +1,203 @@
+"""
+Staged ingest for the MQTT bridge (taha.py):
+
+    paho loop --(recv queue)--> dispatcher --(process pool: decode + position)--> MongoBatchWriter
+
+on_message only enqueues (topic, payload, ts, seq); the dispatcher groups messages
+into chunks, resolves room geometry for their topics and hands each chunk to
+a worker process, which decodes payloads, builds canonical documents and
+attaches positions. Finished documents go to the writer's queue. Every stage
+is bounded; a full receive queue drops (and counts) the message so the paho
+network thread never blocks.
+
+Worker code lives here rather than in taha.py so spawned workers can import
+it without starting a second bridge.
+"""
+import base64
+import json
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import time
+
+from mqtt_records import build_mqtt_doc, is_range_frame
+from positioning import attach_position
+
+
+def bytes_to_data(b: bytes) -> tuple[str, object]:
+    """
+    Returns (data_string, parsed_json).
+    JSON -> compact string (parsed_json is the decoded value);
+    UTF-8 -> text; otherwise base64 (prefixed). parsed_json is None for non-JSON.
+    """
+    if not b:
+        return "", None
+    try:
+        # Try JSON first
+        parsed = json.loads(b.decode("utf-8"))
+        return json.dumps(parsed, separators=(",", ":")), parsed
+    except Exception:
+        pass
+    try:
+        return b.decode("utf-8"), None
+    except Exception:
+        return "base64:" + base64.b64encode(b).decode("ascii"), None
+
+
+def decode_message(topic, payload, ts, seq=None, geometry=None):
+    """Canonical mqtt_data document for one MQTT message, with its position if geometry is known."""
+    data_str, parsed = bytes_to_data(payload or b"")
+    if seq is None:
+        doc = build_mqtt_doc(topic, data_str, ts, frame=parsed)
+    else:
+        doc = build_mqtt_doc(topic, data_str, ts, frame=parsed, seq=seq)
+    if geometry and is_range_frame(doc):
+        attach_position(doc, geometry)
+    return doc
+
+
+def decode_chunk(messages, geometries):
+    """Worker entry point: [(topic, payload, ts, seq), ...] -> [doc, ...]."""
+    return [decode_message(topic, payload, ts, seq, geometries.get(topic)) for topic, payload, ts, seq in messages]
+
+
+def _worker_init():
+    # Ctrl-C / SIGTERM are handled by the parent, which drains the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def start_worker_pool(workers):
+    """
+    The process pool that decodes chunks. Start it before the process opens
+    a MongoClient or starts threads, so forked workers inherit neither, and
+    pass it to IngestPipeline as `pool`.
+    """
+    return multiprocessing.Pool(max(1, workers), initializer=_worker_init)
+
+
+class IngestPipeline:
+    """
+    Receive -> decode/compute -> write stages with per-stage counters.
+    `geometry_for(topic)` (optional) returns the room geometry used for
+    positions; `accept(doc)` (optional, e.g. IngestFilter.accept) runs in
+    the parent before a decoded doc is handed to `writer`, which needs
+    put(doc) (see MongoBatchWriter). `pool` is a start_worker_pool() pool
+    (one is forked in start() without it).
+    """
+
+    def __init__(self, writer, workers, geometry_for=None, accept=None, recv_max=20000, chunk_size=200,
+                 chunk_age_ms=20, max_inflight=None, pool=None):
+        self.writer = writer
+        self.geometry_for = geometry_for
+        self.accept = accept
+        self.chunk_size = max(1, chunk_size)
+        self.chunk_age = max(0, chunk_age_ms) / 1000.0
+        self.workers = max(1, workers)
+        self.received = 0
+        self.recv_dropped = 0
+        self.decoded = 0
+        self.decode_errors = 0
+        self.chunks = 0          # dispatched (dispatcher thread only)
+        self.chunks_done = 0     # finished (pool result thread only)
+        self._inflight = threading.BoundedSemaphore(max_inflight or self.workers * 2)
+        self._queue = queue.Queue(maxsize=max(1, recv_max))
+        self._stopping = threading.Event()
+        self._pool = pool
+        self._thread = threading.Thread(target=self._run, name="ingest-dispatch", daemon=True)
+
+    # -------------------- Receive stage --------------------
+    def submit(self, topic, payload, ts, seq=None) -> bool:
+        """Called from the paho thread; never blocks."""
+        try:
+            self._queue.put_nowait((topic, payload, ts, seq))
+            self.received += 1
+            return True
+        except queue.Full:
+            self.recv_dropped += 1
+            if self.recv_dropped == 1 or self.recv_dropped % 1000 == 0:
+                print(f"[RECV FULL] dropped {self.recv_dropped} messages so far", file=sys.stderr)
+            return False
+
+    # -------------------- Decode/compute stage --------------------
+    def start(self):
+        if self._pool is None:
+            self._pool = start_worker_pool(self.workers)
+        self._thread.start()
+
+    def _geometries(self, chunk):
+        if not self.geometry_for:
+            return {}
+        geometries = {}
+        for topic, *_ in chunk:
+            if topic not in geometries:
+                try:
+                    geometries[topic] = self.geometry_for(topic)
+                except Exception as e:
+                    print(f"[GEOMETRY ERROR] {topic}: {e}", file=sys.stderr)
+                    geometries[topic] = None
+        return geometries
+
+    def _done(self, docs):
+        self._inflight.release()
+        self.chunks_done += 1
+        self.decoded += len(docs)
+        for doc in docs:
+            if self.accept is None or self.accept(doc):
+                self.writer.put(doc)
+
+    def _failed(self, error, size):
+        self._inflight.release()
+        self.chunks_done += 1
+        self.decode_errors += size
+        print(f"[DECODE ERROR] {error} ({size} messages lost)", file=sys.stderr)
+
+    def _dispatch(self, chunk):
+        geometries = self._geometries(chunk)
+        self._inflight.acquire()  # back-pressure: at most max_inflight chunks in the pool
+        self.chunks += 1
+        self._pool.apply_async(decode_chunk, (chunk, geometries), callback=self._done,
+                               error_callback=lambda e, n=len(chunk): self._failed(e, n))
+
+    def _run(self):
+        chunk = []
+        deadline = None
+        while True:
+            wait = max(0.0, deadline - time.monotonic()) if chunk else 0.1
+            try:
+                msg = self._queue.get(timeout=wait)
+                if not chunk:
+                    deadline = time.monotonic() + self.chunk_age
+                chunk.append(msg)
+            except queue.Empty:
+                pass
+
+            if chunk and (len(chunk) >= self.chunk_size or time.monotonic() >= deadline):
+                self._dispatch(chunk)
+                chunk = []
+
+            if self._stopping.is_set() and self._queue.empty():
+                if chunk:
+                    self._dispatch(chunk)
+                return
+
+    # -------------------- Shutdown / stats --------------------
+    def close(self, timeout=None):
+        """Dispatch what is still queued and wait for the workers to hand it to the writer."""
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "recv_dropped": self.recv_dropped,
+            "recv_queue": self._queue.qsize(),
+            "inflight_chunks": self.chunks - self.chunks_done,
+            "decoded": self.decoded,
+            "decode_errors": self.decode_errors,
+        }
@@ -0,0 +1,181 @@
+"""
+Latest record per (mqtt_topic, tag_id, device_id), kept in memory and
+updated by the ingest path, so "current state" reads (/api/visualize,
+/api/mqtt/data/<topic>/latest, the WebSocket loop) cost O(tags) instead of a
+sorted query over mqtt_data.
+
+Optionally shared through a small MongoDB collection (LATEST_STATE_COLLECTION,
+one document per key) that every writer upserts; that is how frames stored by
+the bridge (taha.py) reach the API server processes. In-memory entries of a
+topic are reloaded after `ttl` seconds, from the shared collection if there
+is one, else from the `loader` passed to get(). ttl=None means the store is
+fed directly (see the change-stream watcher) and never reloads on its own.
+
+The shared collection only holds keys written since it existed, so the first
+get() of a topic in a process also merges the loader's seed; seeds stay
+local (a seed can be partial and must not look authoritative to others).
+A topic is seeded once per process, from the last LATEST_STATE_SEED_S of
+frames (at most LATEST_STATE_SEED_MAX); without a shared collection later
+reloads only ask the loader for frames stored since the previous one.
+"""
+import datetime
+import os
+import sys
+import threading
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from mqtt_records import flatten_record, record_tag_ranges
+
+LATEST_STATE_SHARED     = os.getenv("LATEST_STATE_SHARED", "1").lower() in ("1", "true", "yes")
+LATEST_STATE_COLLECTION = os.getenv("LATEST_STATE_COLLECTION", "latest_tag_state")
+LATEST_STATE_TTL_S      = float(os.getenv("LATEST_STATE_TTL_S", "1"))
+LATEST_STATE_SEED_S     = float(os.getenv("LATEST_STATE_SEED_S", "86400"))
+LATEST_STATE_SEED_MAX   = int(os.getenv("LATEST_STATE_SEED_MAX", "5000"))
+
+# Incremental reloads re-read this far before the previous one (frames stamped
+# on receipt reach mqtt_data a little later)
+RELOAD_OVERLAP = datetime.timedelta(seconds=5)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def state_entry(record):
+    """Flattened copy of a stored record plus its (topic, tag_id, device_id) key, or None."""
+    record = flatten_record({k: v for k, v in record.items() if k != "_id"})
+    topic = record.get("mqtt_topic")
+    if topic is None:
+        return None
+    tag_id, _ = record_tag_ranges(record)
+    return (topic, tag_id, record.get("device_id")), record
+
+
+def _newer(a, b):
+    """True if record a is at least as recent as record b."""
+    return (a.get("ts") or _EPOCH, a.get("seq") or 0) >= (b.get("ts") or _EPOCH, b.get("seq") or 0)
+
+
+class LatestState:
+    def __init__(self, shared_collection=None, ttl=LATEST_STATE_TTL_S):
+        self.shared = shared_collection
+        self.ttl = ttl
+        self.shared_errors = 0
+        self._topics = {}  # topic -> {"entries": {key: record}, "loaded_at": monotonic}
+        self._lock = threading.Lock()
+
+    # -------------------- Write --------------------
+    def update(self, records, share=True):
+        """Merge stored records (any shape mqtt_records understands); returns the keys that changed."""
+        latest = {}
+        for record in records:
+            entry = state_entry(record)
+            if entry and (entry[0] not in latest or _newer(entry[1], latest[entry[0]])):
+                latest[entry[0]] = entry[1]
+        if not latest:
+            return []
+
+        changed = []
+        with self._lock:
+            for key, record in latest.items():
+                topic_state = self._topics.setdefault(key[0], {"entries": {}, "loaded_at": None})
+                current = topic_state["entries"].get(key)
+                if current is None or _newer(record, current):
+                    topic_state["entries"][key] = record
+                    changed.append(key)
+
+        if share and self.shared is not None:
+            self._share(latest)
+        return changed
+
+    def _share(self, latest):
+        ops = [
+            UpdateOne(
+                {"_id": "|".join(str(k) for k in key), "ts": {"$lte": record.get("ts") or _EPOCH}},
+                {"$set": {"mqtt_topic": key[0], "tag_id": key[1], "device_id": key[2],
+                          "ts": record.get("ts") or _EPOCH, "record": record}},
+                upsert=True,
+            )
+            for key, record in latest.items()
+        ]
+        try:
+            self.shared.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # duplicate _id = the shared entry is already newer; anything else is a real failure
+            if any(err.get("code") != 11000 for err in (e.details or {}).get("writeErrors", [])):
+                self._shared_failed(e)
+        except Exception as e:
+            self._shared_failed(e)
+
+    def _shared_failed(self, error):
+        self.shared_errors += 1
+        if self.shared_errors == 1 or self.shared_errors % 1000 == 0:
+            print(f"⚠ Warning: latest-state update failed ({self.shared_errors} so far): {error}", file=sys.stderr)
+
+    # -------------------- Read --------------------
+    def get(self, topic, loader=None):
+        """
+        {(topic, tag_id, device_id): record} for a topic. Expired or unknown
+        topics are reloaded from the shared collection. loader(since) returns
+        stored records: with since=None the seed (newest frame per key in
+        mqtt_data, bounded by LATEST_STATE_SEED_S/LATEST_STATE_SEED_MAX), run
+        on a topic's first read here; without a shared collection, reloads
+        call it with the time of the previous load for the frames since.
+        """
+        with self._lock:
+            topic_state = self._topics.get(topic)
+            first_load = topic_state is None or topic_state["loaded_at"] is None
+            fresh = not first_load and (self.ttl is None or time.monotonic() - topic_state["loaded_at"] < self.ttl)
+            if fresh:
+                return dict(topic_state["entries"])
+            synced_to = topic_state.get("synced_to") if topic_state else None
+
+        entries = {}
+        if self.shared is not None:
+            for doc in self.shared.find({"mqtt_topic": topic}):
+                entries[(topic, doc.get("tag_id"), doc.get("device_id"))] = doc["record"]
+        started = datetime.datetime.utcnow()
+        if loader is not None and synced_to is None:
+            self.update(loader(None), share=False)
+            synced_to = started
+        elif loader is not None and self.shared is None:
+            self.update(loader(synced_to - RELOAD_OVERLAP), share=False)
+            synced_to = started
+
+        with self._lock:
+            topic_state = self._topics.setdefault(topic, {"entries": {}, "loaded_at": None})
+            for key, record in entries.items():
+                current = topic_state["entries"].get(key)
+                if current is None or _newer(record, current):
+                    topic_state["entries"][key] = record
+            topic_state["loaded_at"] = time.monotonic()
+            if synced_to is not None:
+                topic_state["synced_to"] = synced_to
+            return dict(topic_state["entries"])
+
+    @staticmethod
+    def by_tag(entries):
+        """{tag_id: newest range-frame record} from get() entries."""
+        latest = {}
+        for (_, tag_id, _), record in entries.items():
+            if tag_id is not None and (tag_id not in latest or _newer(record, latest[tag_id])):
+                latest[tag_id] = record
+        return latest
+
+    @staticmethod
+    def by_device(entries):
+        """{device_id: newest record} from get() entries (what /latest returns)."""
+        latest = {}
+        for (_, _, device_id), record in entries.items():
+            if device_id not in latest or _newer(record, latest[device_id]):
+                latest[device_id] = record
+        return latest
+
+    def invalidate(self, topic=None):
+        with self._lock:
+            if topic is None:
+                self._topics.clear()
+            else:
+                self._topics.pop(topic, None)
+
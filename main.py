@@ -4,6 +4,8 @@ import json
 import math
 import time
 
+from positioning import get_solver
+
 RED = [255, 0, 0]
 BLACK = [0, 0, 0]
 WHITE = [255, 255, 255]
@@ -28,55 +30,13 @@ class UWB:
         self.status = True
 
     def cal(self):
-        # Map range to anchor index
-        distances = [(i, r) for i, r in enumerate(self.list) if r > 0]
-
-        # Sort by distance (closest anchors)
-        distances.sort(key=lambda x: x[1])
-
-        # Use only the 3 nearest anchors
-        if len(distances) >= 3:
-            selected_ids = [distances[i][0] for i in range(3)]
-
-            x = 0.0
-            y = 0.0
-
-            for i in range(3):
-                for j in range(i + 1, 3):
-                    temp_x, temp_y = self.three_point_uwb(selected_ids[i], selected_ids[j])
-                    x += temp_x
-                    y += temp_y
-
-            x = int(x / 3)
-            y = int(y / 3)
-
-            self.set_location(x, y)
+        # Solver picked by POSITION_SOLVER (pairwise: three nearest anchors)
+        fix = get_solver().solve(self.list, [(a.x, a.y) for a in anc])
+        if fix is not None:
+            x, y, _ = fix
+            self.set_location(int(x), int(y))
             self.status = True
 
-    def three_point_uwb(self, a_id, b_id):
-        x, y = self.three_point(anc[a_id].x, anc[a_id].y, anc[b_id].x,
-                                anc[b_id].y, self.list[a_id], self.list[b_id])
-
-        return x, y
-
-    def three_point(self, x1, y1, x2, y2, r1, r2):
-        temp_x = 0.0
-        temp_y = 0.0
-        # 圆心距离
-        p2p = (x1 - x2)*(x1 - x2) + (y1 - y2)*(y1 - y2)
-        p2p = math.sqrt(p2p)
-
-        # 判断是否相交
-        if r1 + r2 <= p2p:
-            temp_x = x1 + (x2 - x1) * r1 / (r1 + r2)
-            temp_y = y1 + (y2 - y1) * r1 / (r1 + r2)
-        else:
-            dr = p2p / 2 + (r1 * r1 - r2 * r2) / (2 * p2p)
-            temp_x = x1 + (x2 - x1) * dr / p2p
-            temp_y = y1 + (y2 - y1) * dr / p2p
-
-        return temp_x, temp_y
-
 def on_connect(client, userdata, flags, rc, properties=None):
     print(f"Connected to MQTT broker with code {rc}")
     client.subscribe("UWB123")
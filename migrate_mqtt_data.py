@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+One-shot migration of mqtt_data to the canonical document shape
+(see mqtt_records.py): topic -> mqtt_topic, message -> data,
+received_at -> ts, plus typed tag_id/ranges for UWB range frames.
+
+Documents are rewritten in place in _id order, BATCH_SIZE at a time. The last
+processed _id is checkpointed in the schema_migrations collection, so an
+interrupted run picks up where it stopped when started again.
+
+With --to-timeseries the (canonicalised) documents are instead copied into
+the time-series collection used when MQTT_DATA_TIMESERIES=1 (see
+mqtt_records.py); the source collection is left untouched.
+
+With --fix-utc, "ts" of records written by the old bridge, which stored
+utcnow() + BRIDGE_TZ_OFFSET_HOURS (Pakistan time) as if it were UTC, is
+shifted back to true UTC. Such records are recognised by comparing "ts" with
+the creation time in their ObjectId, so running it twice is harmless.
+--to-timeseries applies the same correction while copying.
+
+Usage:
+    python migrate_mqtt_data.py                  # migrate (resumes from checkpoint)
+    python migrate_mqtt_data.py --dry-run        # count what would change
+    python migrate_mqtt_data.py --restart        # ignore checkpoint, rescan everything
+    python migrate_mqtt_data.py --to-timeseries  # copy into the time-series collection
+    python migrate_mqtt_data.py --fix-utc        # shift old bridge timestamps to UTC
+"""
+import datetime
+import os
+import sys
+import time
+
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+
+from mqtt_records import META_FIELD, canonical_update, to_timeseries_doc
+
+MONGO_URI       = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB        = os.getenv("MONGO_DB", "auth_system")
+MONGO_COLLECTION= os.getenv("MONGO_COLLECTION", "mqtt_data")
+BATCH_SIZE      = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+TS_COLLECTION   = os.getenv("MQTT_DATA_TS_COLLECTION", "uwb_ranges")
+BRIDGE_TZ_OFFSET_HOURS = float(os.getenv("BRIDGE_TZ_OFFSET_HOURS", "5"))
+
+MIGRATION_ID = "mqtt_data_canonical_v1"
+TS_COPY_ID   = "mqtt_data_to_timeseries_v1"
+UTC_FIX_ID   = "mqtt_data_utc_ts_v1"
+
+
+def migrate(db, collection_name=MONGO_COLLECTION, batch_size=BATCH_SIZE, dry_run=False, restart=False):
+    """Rewrite legacy documents in batches. Returns (scanned, updated)."""
+    col = db[collection_name]
+    checkpoints = db["schema_migrations"]
+
+    state = checkpoints.find_one({"_id": MIGRATION_ID}) or {}
+    if restart or dry_run:
+        last_id = None
+    else:
+        last_id = state.get("last_id")
+        if state.get("completed_at"):
+            print(f"Migration {MIGRATION_ID} already completed at {state['completed_at']}; use --restart to rescan")
+            return 0, 0
+
+    scanned = 0
+    updated = 0
+    started = time.time()
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = list(col.find(query).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        ops = []
+        for doc in batch:
+            update = canonical_update(doc)
+            if update:
+                ops.append(UpdateOne({"_id": doc["_id"]}, update))
+
+        if ops and not dry_run:
+            col.bulk_write(ops, ordered=False)
+
+        scanned += len(batch)
+        updated += len(ops)
+        last_id = batch[-1]["_id"]
+
+        if not dry_run:
+            checkpoints.update_one(
+                {"_id": MIGRATION_ID},
+                {"$set": {"last_id": last_id, "updated_at": datetime.datetime.utcnow()},
+                 "$inc": {"scanned": len(batch), "migrated": len(ops)}},
+                upsert=True
+            )
+        print(f"  scanned {scanned}, {'would update' if dry_run else 'updated'} {updated} "
+              f"({scanned / max(time.time() - started, 1e-6):.0f} docs/s)")
+
+    if not dry_run:
+        checkpoints.update_one(
+            {"_id": MIGRATION_ID},
+            {"$set": {"completed_at": datetime.datetime.utcnow()}},
+            upsert=True
+        )
+    return scanned, updated
+
+
+def bridge_ts_correction(doc, offset_hours=BRIDGE_TZ_OFFSET_HOURS):
+    """
+    The true UTC "ts" of a record the old bridge stamped with
+    utcnow() + offset_hours, or None if its ts is already UTC.
+    pymongo assigns _id (and its creation time, in UTC) at insert, so a ts
+    about offset_hours ahead of it can only come from the old bridge.
+    """
+    ts = doc.get("ts")
+    oid = doc.get("_id")
+    if not isinstance(ts, datetime.datetime) or not isinstance(oid, ObjectId):
+        return None
+    skew_hours = (ts - oid.generation_time.replace(tzinfo=None)).total_seconds() / 3600.0
+    if abs(skew_hours - offset_hours) <= 0.5:
+        return ts - datetime.timedelta(hours=offset_hours)
+    return None
+
+
+def fix_bridge_timestamps(db, collection_name=MONGO_COLLECTION, batch_size=BATCH_SIZE, dry_run=False, restart=False):
+    """Shift old bridge timestamps to UTC in _id-ordered batches. Returns (scanned, fixed)."""
+    existing = list(db.list_collections(filter={"name": collection_name}))
+    if existing and existing[0].get("type") == "timeseries":
+        print(f"{collection_name} is a time-series collection, whose timeField cannot be updated; "
+              f"fix the source collection and copy it again with --to-timeseries")
+        return 0, 0
+
+    col = db[collection_name]
+    checkpoints = db["schema_migrations"]
+    state = {} if (restart or dry_run) else (checkpoints.find_one({"_id": UTC_FIX_ID}) or {})
+    last_id = state.get("last_id")
+    scanned = 0
+    fixed = 0
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = list(col.find(query, {"ts": 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        ops = []
+        for doc in batch:
+            ts = bridge_ts_correction(doc)
+            if ts is not None:
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"ts": ts}}))
+        if ops and not dry_run:
+            col.bulk_write(ops, ordered=False)
+
+        scanned += len(batch)
+        fixed += len(ops)
+        last_id = batch[-1]["_id"]
+        if not dry_run:
+            checkpoints.update_one(
+                {"_id": UTC_FIX_ID},
+                {"$set": {"last_id": last_id, "updated_at": datetime.datetime.utcnow()},
+                 "$inc": {"scanned": len(batch), "fixed": len(ops)}},
+                upsert=True
+            )
+        print(f"  scanned {scanned}, {'would fix' if dry_run else 'fixed'} {fixed}")
+
+    return scanned, fixed
+
+
+def _apply_update(doc, update):
+    """Apply a canonical_update() result to an in-memory document."""
+    for field in (update or {}).get("$unset", {}):
+        doc.pop(field, None)
+    doc.update((update or {}).get("$set", {}))
+    return doc
+
+
+def copy_to_timeseries(db, source=MONGO_COLLECTION, target=TS_COLLECTION, batch_size=BATCH_SIZE, restart=False):
+    """
+    Copy documents from `source` into the time-series collection `target`,
+    canonicalising legacy fields on the way. Resumes from a checkpoint;
+    a crash mid-batch can re-copy at most that one batch.
+    Returns the number of copied documents.
+    """
+    col = db[source]
+    checkpoints = db["schema_migrations"]
+    existing = list(db.list_collections(filter={"name": target}))
+    if not existing:
+        db.create_collection(target, timeseries={"timeField": "ts", "metaField": META_FIELD, "granularity": "seconds"})
+    ts_col = db[target]
+
+    state = {} if restart else (checkpoints.find_one({"_id": TS_COPY_ID}) or {})
+    last_id = state.get("last_id")
+    copied = 0
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = list(col.find(query).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        docs = []
+        for doc in batch:
+            doc = _apply_update(doc, canonical_update(doc))
+            if doc.get("mqtt_topic") is None:
+                continue
+            doc["ts"] = bridge_ts_correction(doc) or doc["ts"]
+            doc.pop("_id")
+            docs.append(to_timeseries_doc(doc))
+        if docs:
+            ts_col.insert_many(docs, ordered=False)
+
+        copied += len(docs)
+        last_id = batch[-1]["_id"]
+        checkpoints.update_one(
+            {"_id": TS_COPY_ID},
+            {"$set": {"last_id": last_id, "updated_at": datetime.datetime.utcnow()},
+             "$inc": {"copied": len(docs)}},
+            upsert=True
+        )
+        print(f"  copied {copied} into {target}")
+
+    return copied
+
+
+if __name__ == "__main__":
+    dry_run = "--dry-run" in sys.argv
+    restart = "--restart" in sys.argv
+
+    mongo_client = MongoClient(MONGO_URI)
+    db = mongo_client[MONGO_DB]
+
+    if "--to-timeseries" in sys.argv:
+        print(f"Copying {MONGO_DB}.{MONGO_COLLECTION} -> time-series {MONGO_DB}.{TS_COLLECTION}")
+        copied = copy_to_timeseries(db, restart=restart)
+        print(f"Done: copied {copied}")
+        mongo_client.close()
+        sys.exit(0)
+
+    if "--fix-utc" in sys.argv:
+        print(f"Shifting {MONGO_DB}.{MONGO_COLLECTION} bridge timestamps by -{BRIDGE_TZ_OFFSET_HOURS:g}h "
+              f"to UTC{' (dry run)' if dry_run else ''}")
+        scanned, fixed = fix_bridge_timestamps(db, dry_run=dry_run, restart=restart)
+        print(f"Done: scanned {scanned}, {'would fix' if dry_run else 'fixed'} {fixed}")
+        if fixed and not dry_run:
+            print("Rollups built from the shifted data are off by the same offset; drop "
+                  "uwb_rollup_1s/uwb_rollup_1m and the rollup_state collection to rebuild them")
+        mongo_client.close()
+        sys.exit(0)
+
+    if restart and not dry_run:
+        db["schema_migrations"].delete_one({"_id": MIGRATION_ID})
+
+    print(f"Migrating {MONGO_DB}.{MONGO_COLLECTION} (batch size {BATCH_SIZE}{', dry run' if dry_run else ''})")
+    scanned, updated = migrate(db, dry_run=dry_run, restart=restart)
+    print(f"Done: scanned {scanned}, {'would update' if dry_run else 'updated'} {updated}")
+    mongo_client.close()
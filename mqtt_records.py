@@ -0,0 +1,484 @@
+"""
+Helpers shared by the MQTT bridge (taha.py) and the API server (final_server.py)
+for reading and writing documents in the mqtt_data collection.
+
+Canonical mqtt_data document (every writer produces this shape, every reader
+queries {"mqtt_topic": t} sorted on "ts" so one (mqtt_topic, ts) index serves all):
+
+    {
+        "mqtt_topic": "1000087",        # 7-digit topic
+        "ts":         datetime,         # ingest time, true UTC (naive)
+        "seq":        1760000000000000, # per-topic monotonic sequence (see TopicSequencer)
+        "device_ts":  datetime,         # only if the device sent a timestamp, UTC
+        "stored_at":  datetime,         # time of the insert itself, UTC (see stamp_stored)
+        "data":       '{"id":0,...}',   # raw payload as a string
+        "tag_id":     0,                # only for UWB range frames
+        "ranges":     [25, 28, ...],    # only for UWB range frames
+        # optional, REST writers only: device_id, timestamp, data_type, metadata
+    }
+
+Older documents used "topic", "message" and "received_at" instead; see
+migrate_mqtt_data.py for the one-shot rewrite.
+
+With MQTT_DATA_TIMESERIES=1 records go to a native MongoDB time-series
+collection (default name "uwb_ranges") with "ts" as timeField and
+"meta": {"mqtt_topic", "tag_id"} as metaField, so frames are bucketed and
+compressed per topic/tag. Queries must then use TOPIC_KEY / TAG_KEY instead of
+the bare field names; flatten_record() restores the flat shape for API output.
+
+With MQTT_RANGES_ENCODING=packed, range frames store "ranges_bin" instead of
+the "ranges" list: a BSON Binary of
+
+    <u8 version=1><u8 dtype: 1=uint16, 2=float32><little-endian values>
+
+uint16 is used when every range is an integer in 0..65535, which is also the
+only case where the "data" string is dropped (it is rebuilt losslessly as
+{"id":<tag_id>,"range":[...]} on read). Readers go through
+record_tag_ranges() / record_ranges() / expand_ranges_batch(), which accept
+both encodings.
+"""
+import datetime
+import json
+import os
+import struct
+import threading
+import time
+
+from bson.binary import Binary
+
+try:
+    import numpy as np
+except ImportError:  # optional: bulk decoding falls back to struct
+    np = None
+
+# Field names used by documents written before the canonical schema
+LEGACY_FIELDS = ("topic", "message", "received_at")
+
+# -------------------- Storage mode --------------------
+TIMESERIES_MODE        = os.getenv("MQTT_DATA_TIMESERIES", "0").lower() in ("1", "true", "yes")
+TIMESERIES_GRANULARITY = os.getenv("MQTT_DATA_TS_GRANULARITY", "seconds")
+MQTT_DATA_COLLECTION   = os.getenv("MQTT_DATA_COLLECTION", "uwb_ranges" if TIMESERIES_MODE else "mqtt_data")
+
+META_FIELD = "meta"
+TOPIC_KEY  = f"{META_FIELD}.mqtt_topic" if TIMESERIES_MODE else "mqtt_topic"
+TAG_KEY    = f"{META_FIELD}.tag_id" if TIMESERIES_MODE else "tag_id"
+
+# Set right before insert; the change feed's polling fallback follows it
+STORED_AT_FIELD = "stored_at"
+
+# -------------------- Range encoding --------------------
+RANGES_ENCODING    = os.getenv("MQTT_RANGES_ENCODING", "list").lower()  # "list" | "packed"
+RANGES_BIN_FIELD   = "ranges_bin"
+RANGES_BIN_VERSION = 1
+_RANGE_DTYPES = {1: ("H", "<u2"), 2: ("f", "<f4")}  # code -> (struct format, numpy dtype)
+
+# Frame field carrying the device's own clock (epoch s/ms or ISO 8601), if any
+DEVICE_TS_FIELD = os.getenv("DEVICE_TS_FIELD", "ts")
+
+# -------------------- Ingest filtering --------------------
+# A frame repeating the ranges a tag already sent within the last
+# INGEST_DEDUP_WINDOW_S seconds is not stored (0 = off, keep every frame);
+# with INGEST_MAX_RATE_HZ > 0 each tag is also limited to that many frames/s.
+INGEST_DEDUP_WINDOW_S = float(os.getenv("INGEST_DEDUP_WINDOW_S", "0"))
+INGEST_MAX_RATE_HZ    = float(os.getenv("INGEST_MAX_RATE_HZ", "0"))
+
+
+def ensure_mqtt_data_collection(db, name=MQTT_DATA_COLLECTION):
+    """
+    Create the mqtt_data collection as a time-series collection when
+    TIMESERIES_MODE is on. Must run before the first insert/create_index,
+    which would otherwise create a plain collection implicitly.
+    """
+    if not TIMESERIES_MODE:
+        return db[name]
+
+    existing = list(db.list_collections(filter={"name": name}))
+    if not existing:
+        db.create_collection(name, timeseries={
+            "timeField": "ts",
+            "metaField": META_FIELD,
+            "granularity": TIMESERIES_GRANULARITY,
+        })
+    elif existing[0].get("type") != "timeseries":
+        print(f"⚠ Warning: {name} exists but is not a time-series collection; "
+              f"set MQTT_DATA_COLLECTION to a new name or drop it")
+    return db[name]
+
+
+def parse_range_frame(frame):
+    """
+    Recognise a UWB range frame: {"id": <tag id>, "range": [r0, r1, ...]}.
+    Returns (tag_id, ranges) with tag_id as int and ranges as a list of numbers,
+    or (None, None) if the value is not a range frame.
+    """
+    if not isinstance(frame, dict):
+        return None, None
+
+    tag_id = frame.get("id")
+    ranges = frame.get("range")
+    if tag_id is None or isinstance(tag_id, bool) or not isinstance(ranges, list):
+        return None, None
+
+    try:
+        tag_id = int(tag_id)
+        ranges = [r if isinstance(r, (int, float)) and not isinstance(r, bool) else float(r)
+                  for r in ranges]
+    except (TypeError, ValueError):
+        return None, None
+
+    return tag_id, ranges
+
+
+def _uint16_ranges(ranges):
+    return all(isinstance(r, int) and 0 <= r <= 0xFFFF for r in ranges)
+
+
+def pack_ranges(ranges):
+    """Encode a list of ranges as a versioned BSON Binary (see module docstring)."""
+    code = 1 if _uint16_ranges(ranges) else 2
+    fmt = _RANGE_DTYPES[code][0]
+    return Binary(bytes((RANGES_BIN_VERSION, code)) + struct.pack(f"<{len(ranges)}{fmt}", *ranges))
+
+
+def _f32(value):
+    # float32 carries ~7 significant digits; don't expose the binary noise
+    return float(f"{value:.7g}")
+
+
+def unpack_ranges(blob):
+    """Decode one packed ranges Binary back into a list of numbers."""
+    view = memoryview(blob)
+    if len(view) < 2 or view[0] != RANGES_BIN_VERSION or view[1] not in _RANGE_DTYPES:
+        raise ValueError("unsupported packed ranges encoding")
+    fmt = _RANGE_DTYPES[view[1]][0]
+    values = struct.unpack_from(f"<{(len(view) - 2) // struct.calcsize(fmt)}{fmt}", view, 2)
+    return list(values) if view[1] == 1 else [_f32(v) for v in values]
+
+
+def unpack_ranges_batch(blobs):
+    """
+    Decode many packed ranges at once. Blobs with the same dtype and length
+    are joined and decoded in one numpy.frombuffer call; without numpy this
+    falls back to unpack_ranges per blob. Returns a list of lists.
+    """
+    if np is None:
+        return [unpack_ranges(b) for b in blobs]
+
+    out = [None] * len(blobs)
+    groups = {}
+    for i, blob in enumerate(blobs):
+        view = memoryview(blob)
+        if len(view) < 2 or view[0] != RANGES_BIN_VERSION or view[1] not in _RANGE_DTYPES:
+            raise ValueError("unsupported packed ranges encoding")
+        groups.setdefault((view[1], len(view)), []).append((i, view[2:]))
+
+    for (code, size), members in groups.items():
+        dtype = np.dtype(_RANGE_DTYPES[code][1])
+        width = (size - 2) // dtype.itemsize
+        rows = np.frombuffer(b"".join(m[1] for m in members), dtype=dtype).reshape(len(members), width)
+        if code == 2:
+            rows = rows.astype(np.float64)
+            nonzero = rows != 0
+            exponent = np.floor(np.log10(np.abs(rows), where=nonzero, out=np.zeros_like(rows)))
+            scale = 10.0 ** (6 - exponent)
+            rows = np.round(rows * scale) / scale
+        for (i, _), row in zip(members, rows.tolist()):
+            out[i] = row
+    return out
+
+
+def record_ranges(record):
+    """The typed ranges of a record (packed or list), or None if it has none."""
+    ranges = record.get("ranges")
+    if isinstance(ranges, list):
+        return ranges
+    blob = record.get(RANGES_BIN_FIELD)
+    if blob is not None:
+        return unpack_ranges(blob)
+    return None
+
+
+def is_range_frame(record):
+    return "ranges" in record or RANGES_BIN_FIELD in record
+
+
+def _restore_data(record, tag_id, ranges):
+    if "data" not in record:
+        record["data"] = json.dumps({"id": tag_id, "range": ranges}, separators=(",", ":"))
+
+
+def expand_ranges_batch(records):
+    """
+    Replace "ranges_bin" with a plain "ranges" list (and rebuild a dropped
+    "data" string) on every record in place, decoding all of them in bulk.
+    """
+    packed = [r for r in records if RANGES_BIN_FIELD in r]
+    if not packed:
+        return records
+    for record, ranges in zip(packed, unpack_ranges_batch([r[RANGES_BIN_FIELD] for r in packed])):
+        del record[RANGES_BIN_FIELD]
+        record["ranges"] = ranges
+        meta = record.get(META_FIELD)
+        _restore_data(record, meta.get("tag_id") if isinstance(meta, dict) else record.get("tag_id"), ranges)
+    return records
+
+
+def record_tag_ranges(record):
+    """
+    Return (tag_id, ranges) for a stored mqtt_data record.
+    Uses the typed tag_id/ranges (or packed ranges_bin) fields written at
+    ingest; falls back to decoding the raw JSON string for records stored
+    before those existed.
+    """
+    ranges = record_ranges(record)
+    if ranges is not None:
+        if META_FIELD in record:
+            return record[META_FIELD].get("tag_id"), ranges
+        return record.get("tag_id"), ranges
+
+    data_str = record.get("data") or record.get("message", "")
+    if not data_str or not isinstance(data_str, str):
+        return None, []
+
+    try:
+        tag_info = json.loads(data_str)
+    except (json.JSONDecodeError, ValueError, TypeError):
+        return None, []
+
+    tag_id, ranges = parse_range_frame(tag_info)
+    if ranges is None:
+        return None, []
+    return tag_id, ranges
+
+
+def parse_device_ts(value):
+    """
+    A device timestamp as a naive UTC datetime, or None.
+    Accepts epoch seconds or milliseconds and ISO 8601 strings (naive = UTC).
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            seconds = value / 1000.0 if value > 1e11 else float(value)
+            return datetime.datetime.utcfromtimestamp(seconds)
+        if isinstance(value, str):
+            parsed = datetime.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            return parsed
+    except (ValueError, OverflowError, OSError):
+        return None
+    return None
+
+
+class TopicSequencer:
+    """
+    Per-topic monotonic sequence numbers (a hybrid logical clock in
+    microseconds): next() returns max(previous + 1, current epoch us), so
+    numbers keep increasing across restarts and stay close to wall time
+    when several writers feed the same topic.
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def next(self, topic):
+        now_us = time.time_ns() // 1000
+        with self._lock:
+            seq = max(self._last.get(topic, 0) + 1, now_us)
+            self._last[topic] = seq
+            return seq
+
+
+def build_mqtt_doc(mqtt_topic, data, ts, frame=None, **extra):
+    """
+    Build a canonical mqtt_data document.
+    `data` is the raw payload string; `frame` is its decoded JSON value if the
+    caller already has it; `ts` is the UTC ingest time. A device timestamp in
+    the frame (DEVICE_TS_FIELD) is stored as device_ts. Extra keyword fields
+    are stored as-is.
+    """
+    doc = {
+        "mqtt_topic": mqtt_topic,
+        "ts": ts,
+        "data": data,
+    }
+    if isinstance(frame, dict):
+        device_ts = parse_device_ts(frame.get(DEVICE_TS_FIELD))
+        if device_ts is not None:
+            doc["device_ts"] = device_ts
+    tag_id, ranges = parse_range_frame(frame)
+    if ranges is not None:
+        doc["tag_id"] = tag_id
+        if RANGES_ENCODING == "packed":
+            doc[RANGES_BIN_FIELD] = pack_ranges(ranges)
+            # Drop the JSON copy only when _restore_data() rebuilds it exactly
+            if (list(frame) == ["id", "range"] and type(frame["id"]) is int
+                    and _uint16_ranges(frame["range"])):
+                del doc["data"]
+        else:
+            doc["ranges"] = ranges
+    doc.update(extra)
+
+    if TIMESERIES_MODE:
+        return to_timeseries_doc(doc)
+    return doc
+
+
+def stamp_stored(docs):
+    """
+    Set STORED_AT_FIELD on documents about to be inserted. Unlike "ts" and
+    the client-generated _id, this is taken at write time, so a batch that
+    is replayed from the spill log or sat in the ingest pipeline still
+    shows up as new to readers polling on it. Returns `docs`.
+    """
+    now = datetime.datetime.utcnow()
+    for doc in docs:
+        doc[STORED_AT_FIELD] = now
+    return docs
+
+
+def to_timeseries_doc(doc):
+    """Move mqtt_topic/tag_id of a canonical record into the time-series metaField."""
+    meta = {"mqtt_topic": doc.pop("mqtt_topic", None)}
+    if "tag_id" in doc:
+        meta["tag_id"] = doc.pop("tag_id")
+    doc[META_FIELD] = meta
+    return doc
+
+
+def flatten_record(record):
+    """
+    Lift time-series meta fields back to the top level of a record and
+    decode packed ranges, giving the flat JSON-friendly shape.
+    """
+    meta = record.pop(META_FIELD, None)
+    if isinstance(meta, dict):
+        record.update(meta)
+    if RANGES_BIN_FIELD in record:
+        record["ranges"] = unpack_ranges(record.pop(RANGES_BIN_FIELD))
+        _restore_data(record, record.get("tag_id"), record["ranges"])
+    return record
+
+
+class IngestFilter:
+    """
+    Drops repeated and over-rate range frames before they are stored.
+
+    Dedup is keyed on (topic, tag_id, hash of the ranges): a key seen less
+    than `window_s` ago is a duplicate. The window is not extended by the
+    duplicates themselves, so a stationary tag still writes one frame per
+    window. The rate limit is a per-(topic, tag_id) token bucket holding one
+    second's worth of frames. Non-range documents always pass.
+    """
+
+    def __init__(self, window_s=INGEST_DEDUP_WINDOW_S, max_rate_hz=INGEST_MAX_RATE_HZ):
+        self.window = max(0.0, window_s)
+        self.rate = max(0.0, max_rate_hz)
+        self.accepted = 0
+        self.duplicates = 0
+        self.rate_limited = 0
+        self._seen = {}     # (topic, tag_id, ranges hash) -> first seen
+        self._buckets = {}  # (topic, tag_id) -> [tokens, last refill]
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.window > 0 or self.rate > 0
+
+    def accept(self, doc, now=None) -> bool:
+        return self.reject_reason(doc, now) is None
+
+    def reject_reason(self, doc, now=None):
+        """None if `doc` is to be stored, else why not: "duplicate" or "rate_limited"."""
+        if not self.enabled or not ("ranges" in doc or RANGES_BIN_FIELD in doc):
+            return None
+        meta = doc.get(META_FIELD)
+        topic, tag_id = (meta.get("mqtt_topic"), meta.get("tag_id")) if isinstance(meta, dict) \
+            else (doc.get("mqtt_topic"), doc.get("tag_id"))
+        blob = doc.get(RANGES_BIN_FIELD)
+        ranges_hash = hash(bytes(blob)) if blob is not None else hash(tuple(doc["ranges"]))
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            if self.window > 0:
+                key = (topic, tag_id, ranges_hash)
+                seen = self._seen.get(key)
+                if seen is not None and now - seen < self.window:
+                    self.duplicates += 1
+                    return "duplicate"
+
+            if self.rate > 0:
+                bucket = self._buckets.setdefault((topic, tag_id), [self.rate, now])
+                bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                if bucket[0] < 1.0:
+                    self.rate_limited += 1
+                    return "rate_limited"
+                bucket[0] -= 1.0
+
+            if self.window > 0:
+                self._seen[key] = now
+            self.accepted += 1
+            return None
+
+    def _sweep(self, now):
+        self._seen = {k: t for k, t in self._seen.items() if now - t < self.window}
+        if self.rate > 0:
+            # a bucket idle for a second is full again; forget it
+            self._buckets = {k: b for k, b in self._buckets.items() if now - b[1] < 1.0}
+        self._next_sweep = now + max(self.window, 1.0)
+
+    def stats(self):
+        return {"accepted": self.accepted, "duplicates": self.duplicates, "rate_limited": self.rate_limited}
+
+
+def canonical_update(doc):
+    """
+    Return the update document that rewrites a legacy mqtt_data record into the
+    canonical shape, or None if it is already canonical.
+    """
+    set_fields = {}
+
+    if doc.get("mqtt_topic") is None and doc.get("topic") is not None:
+        set_fields["mqtt_topic"] = doc["topic"]
+
+    if not isinstance(doc.get("ts"), datetime.datetime):
+        ts = doc.get("received_at")
+        if not isinstance(ts, datetime.datetime):
+            try:
+                ts = datetime.datetime.fromisoformat(str(doc.get("timestamp")).replace("Z", "+00:00"))
+                if ts.tzinfo is not None:
+                    ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            except ValueError:
+                ts = doc["_id"].generation_time.replace(tzinfo=None)
+        set_fields["ts"] = ts
+
+    data = doc.get("data")
+    if data is None and "message" in doc:
+        message = doc["message"]
+        data = message if isinstance(message, str) else json.dumps(message, separators=(",", ":"))
+        set_fields["data"] = data
+
+    if not isinstance(doc.get("ranges"), list) and RANGES_BIN_FIELD not in doc and isinstance(data, str):
+        try:
+            tag_id, ranges = parse_range_frame(json.loads(data))
+        except (json.JSONDecodeError, ValueError, TypeError):
+            tag_id, ranges = None, None
+        if ranges is not None:
+            set_fields["tag_id"] = tag_id
+            set_fields["ranges"] = ranges
+
+    unset_fields = {f: "" for f in LEGACY_FIELDS if f in doc}
+
+    update = {}
+    if set_fields:
+        update["$set"] = set_fields
+    if unset_fields:
+        update["$unset"] = unset_fields
+    return update or None
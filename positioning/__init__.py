@@ -0,0 +1,28 @@
+"""
+UWB positioning shared by the API server, the MQTT bridge, background jobs
+and the desktop viewer (main.py).
+
+By default anchors sit at the corners of a rectangular room (inches):
+    A0 = (0, 0), A1 = (width, 0), A2 = (width, height), A3 = (0, height)
+Rooms may instead list any number of anchors (see geometry).
+
+geometry - anchor layouts, RoomGeometry and the room "anchors" field
+solvers  - the Solver interface, the registered solvers and solve_fix()/solve_fixes()
+ingest   - positions stored on records at ingest and the room geometry cache
+tracking - optional per-tag Kalman filtering of fixes (POSITION_FILTER)
+"""
+from .geometry import (
+    MAX_ANCHORS, MIN_ANCHORS, AnchorLayout, RoomGeometry, anchor_layout, anchor_list, anchor_positions,
+    as_layout, parse_anchor_list, ranges_by_anchor, rectangle_anchors, rectangle_geometry, room_geometry,
+)
+from .solvers import (
+    POSITION_GN_ITERATIONS, POSITION_SOLVER, SOLVERS, GaussNewtonSolver, LeastSquaresSolver, LinearSolver,
+    PairwiseCircleSolver, Solver,
+    get_solver, nearest_three_batch, nearest_three_position, nearest_three_positions, np, position_dict,
+    register_solver, solve_fix, solve_fixes, three_point_calculation,
+)
+from .ingest import (
+    ROOM_GEOMETRY_FIELDS, RoomGeometryCache, attach_position, position_fields, recompute_topic_positions,
+    stored_position,
+)
+from .tracking import POSITION_FILTER, KalmanTrack, TagTracker, kalman_dict
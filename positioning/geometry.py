@@ -0,0 +1,195 @@
+"""
+Anchor layouts and room geometry.
+
+A room can list its anchors explicitly:
+    "anchors": [{"id": "A0", "x": 0, "y": 0, "z": 96}, ...]
+in range-slot order (ranges[i] of a frame is the distance to anchors[i]),
+with any number of anchors and an optional mounting height z. Rooms without
+the list use the four corners A0..A3 of their width x height. When anchors
+have a z, measured ranges are projected onto the tag plane at the room's
+"tag_height_in" (default 0) before solving.
+
+AnchorLayout objects are shared per distinct layout (anchor_layout()), so
+what solvers precompute from the anchors is done once per room, not per fix.
+"""
+import hashlib
+import json
+import math
+from collections import namedtuple
+
+MIN_ANCHORS = 3
+MAX_ANCHORS = 64
+MAX_CACHED_LAYOUTS = 256
+
+_layouts = {}
+
+
+class AnchorLayout:
+    """
+    Anchor (x, y) points in range-slot order, their ids and optional heights,
+    plus geometry shared by every fix: pairwise anchor distances and `cache`,
+    where solvers keep what they precompute per layout (keyed by solver).
+    Indexing and len() behave like the list of points.
+    """
+
+    def __init__(self, points, ids, z):
+        self.points = points
+        self.ids = ids
+        self.z = z
+        self.slots = {anchor_id: i for i, anchor_id in enumerate(ids)}
+        self.distances = [[math.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2)) for x2, y2 in points]
+                          for x1, y1 in points]
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, i):
+        return self.points[i]
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def __reduce__(self):
+        # ingest workers get the geometry pickled per chunk; rebuild through
+        # anchor_layout() so each process keeps one shared copy per layout
+        return anchor_layout, (self.points, self.ids, self.z)
+
+
+def anchor_layout(points, ids=None, z=None):
+    """The shared AnchorLayout for these anchors (ids default to A0, A1, ...)."""
+    points = tuple((float(x), float(y)) for x, y in points)
+    ids = tuple(ids) if ids is not None else tuple(f"A{i}" for i in range(len(points)))
+    z = tuple(z) if z is not None else (None,) * len(points)
+    key = (points, ids, z)
+    layout = _layouts.get(key)
+    if layout is None:
+        if len(_layouts) >= MAX_CACHED_LAYOUTS:
+            _layouts.clear()
+        layout = _layouts[key] = AnchorLayout(points, ids, z)
+    return layout
+
+
+def as_layout(anchors):
+    """`anchors` as an AnchorLayout ([(x, y), ...] lists are looked up in the shared cache)."""
+    return anchors if isinstance(anchors, AnchorLayout) else anchor_layout(anchors)
+
+
+def rectangle_anchors(width, height):
+    """Anchor positions A0..A3 for a width x height room."""
+    return [
+        (0, 0),           # A0
+        (width, 0),       # A1
+        (width, height),  # A2
+        (0, height)       # A3
+    ]
+
+
+class RoomGeometry(namedtuple("RoomGeometry", "room_id width height layout tag_height anchors_key")):
+    """
+    What positioning needs to know about a room. anchors_key identifies an
+    explicit anchor list (None for the default corners) so stored fixes can
+    be matched against the layout they were computed for.
+    """
+    __slots__ = ()
+
+    def planar(self, ranges):
+        """Ranges projected onto the tag plane (unchanged unless anchors have a z)."""
+        if not any(z is not None for z in self.layout.z):
+            return ranges
+        projected = list(ranges)
+        for i, z in enumerate(self.layout.z[:len(projected)]):
+            r = projected[i]
+            if z is None or not r or r <= 0:
+                continue
+            dz = z - self.tag_height
+            # readings shorter than the height difference: directly below the anchor
+            projected[i] = math.sqrt(r * r - dz * dz) if r * r > dz * dz else 1e-6
+        return projected
+
+
+def rectangle_geometry(width, height, room_id=None):
+    """RoomGeometry of a width x height room with corner anchors A0..A3."""
+    return RoomGeometry(room_id, float(width), float(height),
+                        anchor_layout(rectangle_anchors(width, height)), 0.0, None)
+
+
+def room_geometry(room):
+    """RoomGeometry for a room document, or None if it has no valid size."""
+    if not room:
+        return None
+    width = float(room.get("width_in", 0) or 0)
+    height = float(room.get("height_in", 0) or 0)
+    if width <= 0 or height <= 0:
+        return None
+    anchors = room.get("anchors")
+    if not anchors:
+        return rectangle_geometry(width, height, str(room["_id"]))
+
+    tag_height = float(room.get("tag_height_in", 0) or 0)
+    layout = anchor_layout([(a["x"], a["y"]) for a in anchors], [a["id"] for a in anchors],
+                           [a.get("z") for a in anchors])
+    key = json.dumps([layout.points, layout.ids, layout.z, tag_height])
+    return RoomGeometry(str(room["_id"]), width, height, layout, tag_height,
+                        hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+
+def parse_anchor_list(value):
+    """
+    Validate a room's "anchors" (a list or its JSON string) and return it as
+    [{"id", "x", "y"[, "z"]}, ...]. Raises ValueError with a message for the client.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise ValueError("anchors must be a JSON list")
+    if not isinstance(value, list):
+        raise ValueError("anchors must be a list of {id, x, y, z?} objects")
+    if not MIN_ANCHORS <= len(value) <= MAX_ANCHORS:
+        raise ValueError(f"anchors must list between {MIN_ANCHORS} and {MAX_ANCHORS} anchors")
+
+    anchors = []
+    for i, entry in enumerate(value):
+        if not isinstance(entry, dict):
+            raise ValueError(f"anchors[{i}] must be an object")
+        anchor = {"id": str(entry.get("id") or f"A{i}")}
+        for field in ("x", "y", "z"):
+            if entry.get(field) is None:
+                if field == "z":
+                    continue
+                raise ValueError(f"anchors[{i}] is missing {field}")
+            try:
+                anchor[field] = float(entry[field])
+            except (TypeError, ValueError):
+                raise ValueError(f"anchors[{i}].{field} must be numeric inches")
+            if not math.isfinite(anchor[field]):
+                raise ValueError(f"anchors[{i}].{field} must be numeric inches")
+        anchors.append(anchor)
+
+    if len({a["id"] for a in anchors}) != len(anchors):
+        raise ValueError("anchor ids must be unique")
+    return anchors
+
+
+def anchor_list(geometry):
+    """The room's anchors as [{"id", "x", "y"[, "z"]}, ...] (the corners when none were given)."""
+    layout = geometry.layout
+    anchors = []
+    for anchor_id, (x, y), z in zip(layout.ids, layout.points, layout.z):
+        anchor = {"id": anchor_id, "x": x, "y": y}
+        if z is not None:
+            anchor["z"] = z
+        anchors.append(anchor)
+    return anchors
+
+
+def anchor_positions(geometry):
+    """{anchor_id: {"x", "y"[, "z"]}} as the visualize endpoints return it."""
+    return {anchor.pop("id"): anchor for anchor in anchor_list(geometry)}
+
+
+def ranges_by_anchor(ranges, geometry=None, missing=None):
+    """{anchor_id: range} for a frame (A0..A3 without a geometry); `missing` for absent slots."""
+    ids = geometry.layout.ids if geometry else ("A0", "A1", "A2", "A3")
+    return {anchor_id: ranges[i] if i < len(ranges) else missing for i, anchor_id in enumerate(ids)}
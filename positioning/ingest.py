@@ -0,0 +1,170 @@
+"""
+Positions computed at ingest and stored on range-frame records, plus the
+room geometry lookups the bridge and the server use for them.
+
+Records of UWB range frames carry the fix computed at ingest:
+    "position": {"x", "y", "x_normalized", "y_normalized", "selected_anchors",
+                 "room_id", "width_in", "height_in", "solver", "anchors_key"?}
+width_in/height_in are the room dimensions it was computed with, solver the
+POSITION_SOLVER that produced it and anchors_key the room's explicit anchor
+layout (absent for corner anchors), so readers can tell a stale fix (room
+resized, re-anchored or solver changed since) and recompute it instead.
+Time-series collections don't take per-record updates well, so there the
+stored fixes are left as they are and recomputed on read.
+"""
+import logging
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from mqtt_records import RANGES_BIN_FIELD, TIMESERIES_MODE, record_ranges
+
+from .geometry import MIN_ANCHORS, room_geometry
+from .solvers import POSITION_SOLVER, solve_fix, solve_fixes
+
+ROOM_GEOMETRY_FIELDS = {"width_in": 1, "height_in": 1, "anchors": 1, "tag_height_in": 1}
+
+log = logging.getLogger(__name__)
+
+
+class RoomGeometryCache:
+    """topic -> RoomGeometry from the rooms collection, refreshed every `ttl` seconds."""
+
+    def __init__(self, rooms_collection, ttl=30.0):
+        self.rooms = rooms_collection
+        self.ttl = ttl
+        self._cache = {}
+
+    def get(self, topic):
+        now = time.monotonic()
+        hit = self._cache.get(topic)
+        if hit and now - hit[0] < self.ttl:
+            return hit[1]
+        room = self.rooms.find_one({"mqtt_topic": topic}, ROOM_GEOMETRY_FIELDS)
+        geometry = room_geometry(room)
+        self._cache[topic] = (now, geometry)
+        return geometry
+
+    def invalidate(self, topic=None):
+        if topic is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(topic, None)
+
+
+def _solvable(ranges):
+    return isinstance(ranges, list) and len(ranges) >= MIN_ANCHORS
+
+
+def position_fields(ranges, geometry):
+    """The "position" subdocument stored on a record, or None if no fix is possible."""
+    if not geometry or not _solvable(ranges):
+        return None
+    return _position_doc(solve_fix(ranges, geometry), geometry)
+
+
+def _position_doc(fix, geometry):
+    if fix is None:
+        return None
+    x, y, used_slots = fix
+    doc = {
+        "x": x,
+        "y": y,
+        "x_normalized": x / geometry.width,
+        "y_normalized": y / geometry.height,
+        "selected_anchors": [geometry.layout.ids[i] for i in used_slots],
+        "room_id": geometry.room_id,
+        "width_in": geometry.width,
+        "height_in": geometry.height,
+        "solver": POSITION_SOLVER,
+    }
+    if geometry.anchors_key:
+        doc["anchors_key"] = geometry.anchors_key
+    return doc
+
+
+def attach_position(doc, geometry):
+    """Add the ingest-time "position" to a range-frame record in place."""
+    position = position_fields(record_ranges(doc), geometry)
+    if position:
+        doc["position"] = position
+    return doc
+
+
+def stored_position(record, geometry):
+    """
+    The ingest-time fix of a record as (x, y, used_slots) if it was computed
+    for this room geometry by the current solver, else None (caller recomputes).
+    Fixes stored before solvers were recorded came from "pairwise".
+    """
+    position = record.get("position")
+    if not position or position.get("width_in") != geometry.width or position.get("height_in") != geometry.height:
+        return None
+    if position.get("solver", "pairwise") != POSITION_SOLVER:
+        return None
+    if position.get("anchors_key") != geometry.anchors_key:
+        return None
+    slots = geometry.layout.slots
+    if not all(a in slots for a in position["selected_anchors"]):
+        return None
+    return position["x"], position["y"], [slots[a] for a in position["selected_anchors"]]
+
+
+def is_timeseries_collection(collection):
+    """Whether `collection` is a MongoDB time-series collection (MQTT_DATA_TIMESERIES if it can't be told)."""
+    try:
+        return "timeseries" in (collection.options() or {})
+    except Exception:
+        return TIMESERIES_MODE
+
+
+def recompute_topic_positions(collection, topic, room, topic_key="mqtt_topic", batch_size=1000):
+    """
+    Rewrite the stored positions of every range frame of `topic` for the
+    current geometry of `room` (e.g. after its dimensions changed).
+    Returns the number of updated records; nothing is rewritten on a
+    time-series collection (readers recompute the stale fixes instead).
+    """
+    query = {topic_key: topic, "$or": [{"ranges": {"$exists": True}}, {RANGES_BIN_FIELD: {"$exists": True}}]}
+    if is_timeseries_collection(collection):
+        stale = collection.count_documents(query)
+        if stale:
+            log.warning("Time-series collection: %d stored positions of topic %s are recomputed on read, not rewritten",
+                        stale, topic)
+        return 0
+
+    geometry = room_geometry(room)
+    updated = failed = 0
+    last_id = None
+    while True:
+        page = dict(query)
+        if last_id is not None:
+            page["_id"] = {"$gt": last_id}
+        batch = list(collection.find(page, {"ranges": 1, RANGES_BIN_FIELD: 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        ranges_list = [record_ranges(record) for record in batch]
+        solvable = [i for i, ranges in enumerate(ranges_list) if geometry and _solvable(ranges)]
+        fixes = dict(zip(solvable, solve_fixes([ranges_list[i] for i in solvable], geometry) if solvable else []))
+
+        ops = []
+        for i, record in enumerate(batch):
+            position = _position_doc(fixes.get(i), geometry)
+            if position:
+                ops.append(UpdateOne({"_id": record["_id"]}, {"$set": {"position": position}}))
+            else:
+                ops.append(UpdateOne({"_id": record["_id"]}, {"$unset": {"position": ""}}))
+        try:
+            collection.bulk_write(ops, ordered=False)
+            updated += len(ops)
+        except BulkWriteError as e:
+            errors = len(e.details.get("writeErrors", []))
+            failed += errors
+            updated += len(ops) - errors
+        last_id = batch[-1]["_id"]
+    if failed:
+        log.warning("%d stored positions of topic %s could not be rewritten; they are recomputed on read",
+                    failed, topic)
+    return updated
@@ -0,0 +1,420 @@
+"""
+Position solvers: ranges to anchors -> (x, y) fix.
+
+Every solver takes `ranges` (ranges[i] belongs to anchors[i]; non-positive
+ranges mean "no reading", slots past the last anchor are ignored) and
+`anchors` (an AnchorLayout, or a [(x, y), ...] list) and returns
+(x, y, used_anchor_slots) or None when the frame cannot be solved. Results
+are not clamped; solve_fix()/solve_fixes() clamp them to the room.
+
+    pairwise  average of the pairwise circle intersections of the three
+              nearest anchors (the original main.py algorithm; default)
+    linear    linearized trilateration against the first valid anchor,
+              solved from two rows (umaid_server.py's original)
+    lstsq     linearized least squares over every valid anchor; the
+              anchor-only part is precomputed per anchor subset and cached
+    gauss_newton
+              lstsq refined by POSITION_GN_ITERATIONS Gauss-Newton steps
+              on the actual range residuals
+
+POSITION_SOLVER picks the solver used by the server, the bridge and jobs.
+"""
+import math
+import os
+
+try:
+    import numpy as np
+except ImportError:  # optional: batch solving falls back to the scalar path
+    np = None
+
+from .geometry import as_layout, rectangle_geometry
+
+POSITION_SOLVER        = os.getenv("POSITION_SOLVER", "pairwise")
+POSITION_GN_ITERATIONS = int(os.getenv("POSITION_GN_ITERATIONS", "5"))
+
+
+def _valid_ids(ranges, anchors):
+    return [i for i, r in enumerate(ranges[:len(anchors)]) if r > 0]
+
+
+class Solver:
+    """Base class; subclasses set `name` and implement solve()."""
+    name = None
+
+    def solve(self, ranges, anchors):
+        raise NotImplementedError
+
+    def solve_batch(self, ranges_list, anchors):
+        """One solve() result per entry; subclasses may vectorize."""
+        return [self.solve(ranges, anchors) for ranges in ranges_list]
+
+
+# -------------------- Pairwise circle intersections --------------------
+def three_point_calculation(x1, y1, x2, y2, r1, r2, p2p=None):
+    """Same as main.py three_point method (p2p: the anchor distance, if precomputed)"""
+    temp_x = 0.0
+    temp_y = 0.0
+    # 圆心距离 (distance between circle centers)
+    if p2p is None:
+        p2p = math.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
+
+    # 判断是否相交 (check if circles intersect)
+    if r1 + r2 <= p2p:
+        temp_x = x1 + (x2 - x1) * r1 / (r1 + r2)
+        temp_y = y1 + (y2 - y1) * r1 / (r1 + r2)
+    else:
+        dr = p2p / 2 + (r1 * r1 - r2 * r2) / (2 * p2p)
+        temp_x = x1 + (x2 - x1) * dr / p2p
+        temp_y = y1 + (y2 - y1) * dr / p2p
+
+    return temp_x, temp_y
+
+
+_PAIRS = ((0, 1), (0, 2), (1, 2))
+
+
+def nearest_three_batch(ranges, anchors, width=None, height=None):
+    """
+    PairwiseCircleSolver for many frames at once (NumPy).
+
+    ranges:  N x K array of ranges; column i belongs to anchors[i], extra columns are ignored
+    anchors: M x 2 array of anchor (x, y)
+    Returns (x, y, selected, valid): float arrays of N, an N x 3 int array of
+    the anchor indices used (nearest first) and a bool array, False where a
+    frame has fewer than three positive ranges (its x/y are NaN). Results are
+    clamped to [0, width] x [0, height] when those are given.
+    """
+    anchors = np.asarray(anchors, dtype=np.float64)
+    m = len(anchors)
+    r = np.zeros((len(ranges), m), dtype=np.float64)
+    if len(ranges):
+        given = np.asarray(ranges, dtype=np.float64)[:, :m]
+        r[:, :given.shape[1]] = given
+    positive = r > 0
+    valid = positive.sum(axis=1) >= 3
+
+    # stable sort like list.sort: equal ranges keep anchor order; non-positive ranges last
+    order = np.argsort(np.where(positive, r, np.inf), axis=1, kind="stable")
+    selected = order[:, :3]
+    rows = np.arange(len(r))[:, None]
+    sel_r = r[rows, selected]
+    sel_xy = anchors[selected]  # N x 3 x 2
+
+    x_sum = np.zeros(len(r))
+    y_sum = np.zeros(len(r))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i, j in _PAIRS:
+            x1, y1 = sel_xy[:, i, 0], sel_xy[:, i, 1]
+            x2, y2 = sel_xy[:, j, 0], sel_xy[:, j, 1]
+            r1, r2 = sel_r[:, i], sel_r[:, j]
+            p2p = np.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
+            apart = r1 + r2 <= p2p
+            # same expressions (and evaluation order) as three_point_calculation
+            dr = p2p / 2 + (r1 * r1 - r2 * r2) / (2 * p2p)
+            x_sum += np.where(apart, x1 + (x2 - x1) * r1 / (r1 + r2), x1 + (x2 - x1) * dr / p2p)
+            y_sum += np.where(apart, y1 + (y2 - y1) * r1 / (r1 + r2), y1 + (y2 - y1) * dr / p2p)
+
+    x = x_sum / 3
+    y = y_sum / 3
+    if width is not None:
+        x = np.clip(x, 0.0, width)
+    if height is not None:
+        y = np.clip(y, 0.0, height)
+    x[~valid] = np.nan
+    y[~valid] = np.nan
+    return x, y, selected, valid
+
+
+class PairwiseCircleSolver(Solver):
+    name = "pairwise"
+
+    def solve(self, ranges, anchors):
+        anchors = as_layout(anchors)
+        distances = [(i, ranges[i]) for i in _valid_ids(ranges, anchors)]
+        if len(distances) < 3:
+            return None
+
+        distances.sort(key=lambda x: x[1])
+        selected_ids = [distances[i][0] for i in range(3)]
+
+        x_sum, y_sum, count = 0.0, 0.0, 0
+        for i in range(3):
+            for j in range(i + 1, 3):
+                a_id, b_id = selected_ids[i], selected_ids[j]
+                a_x, a_y = anchors[a_id]
+                b_x, b_y = anchors[b_id]
+                temp_x, temp_y = three_point_calculation(a_x, a_y, b_x, b_y, ranges[a_id], ranges[b_id],
+                                                         anchors.distances[a_id][b_id])
+                x_sum += temp_x
+                y_sum += temp_y
+                count += 1
+        return x_sum / count, y_sum / count, selected_ids
+
+    def solve_batch(self, ranges_list, anchors):
+        if np is None or not ranges_list:
+            return super().solve_batch(ranges_list, anchors)
+        anchors = as_layout(anchors)
+        m = len(anchors)
+        matrix = [(list(ranges[:m]) + [0] * m)[:m] for ranges in ranges_list]
+        x, y, selected, valid = nearest_three_batch(matrix, anchors.points)
+        return [(xi, yi, sel) if ok else None
+                for xi, yi, sel, ok in zip(x.tolist(), y.tolist(), selected.tolist(), valid.tolist())]
+
+
+# -------------------- Linearized trilateration --------------------
+class LinearSolver(Solver):
+    """
+    Linearized 2D trilateration using differences to the first valid anchor
+    (A0 normally) to remove squares:
+      For each other valid anchor i:
+        2*(xi - x0)*x + 2*(yi - y0)*y = (xi^2+yi^2 - di^2) - (x0^2+y0^2 - d0^2)
+    Solved from the first two rows that are not singular.
+    """
+    name = "linear"
+
+    def solve(self, ranges, anchors):
+        ids = _valid_ids(ranges, anchors)
+        if len(ids) < 3:
+            return None
+        ref = ids[0]
+        x0, y0 = anchors[ref]
+        r0 = float(ranges[ref])
+        eqs = []
+        for i in ids[1:]:
+            xi, yi = anchors[i]
+            ri = float(ranges[i])
+            eqs.append((2 * (xi - x0), 2 * (yi - y0), (xi * xi + yi * yi - ri * ri) - (x0 * x0 + y0 * y0 - r0 * r0), i))
+
+        for a in range(len(eqs)):
+            for b in range(a + 1, len(eqs)):
+                (A1, B1, C1, i1), (A2, B2, C2, i2) = eqs[a], eqs[b]
+                det = A1 * B2 - A2 * B1
+                if abs(det) < 1e-9:
+                    continue
+                return (C1 * B2 - C2 * B1) / det, (A1 * C2 - A2 * C1) / det, [ref, i1, i2]
+        return None
+
+
+# -------------------- Least squares over all anchors --------------------
+class LeastSquaresSolver(Solver):
+    """
+    The linearized system of LinearSolver, but over every valid anchor and
+    solved in the least-squares sense. With ref = first valid anchor and
+    k_i = xi^2 + yi^2:
+        A p = (k_i - k_ref) - (ri^2 - r_ref^2)
+        p   = P (k - k_ref) - P (r^2 - r_ref^2),   P = (A^T A)^-1 A^T
+    P and P (k - k_ref) only depend on the anchors, so they are computed
+    once per (anchor layout, valid subset) and a solve is a 2 x n
+    matrix-vector product. `iterations` > 0 refines the result with
+    Gauss-Newton steps on the residuals |p - a_i| - r_i.
+    """
+    name = "lstsq"
+    max_cached_subsets = 4096
+
+    def __init__(self, iterations=0):
+        self.iterations = iterations
+
+    def _subset(self, anchors, ids):
+        """(P_x, P_y, c_x, c_y) for anchors[ids], or None if they are collinear."""
+        subsets = anchors.cache.setdefault("lstsq", {})
+        key = tuple(ids)
+        if key in subsets:
+            return subsets[key]
+        x0, y0 = anchors[ids[0]]
+        k0 = x0 * x0 + y0 * y0
+        rows = []
+        for i in ids[1:]:
+            xi, yi = anchors[i]
+            rows.append((2 * (xi - x0), 2 * (yi - y0), xi * xi + yi * yi - k0))
+
+        saa = sum(a * a for a, _, _ in rows)
+        sab = sum(a * b for a, b, _ in rows)
+        sbb = sum(b * b for _, b, _ in rows)
+        det = saa * sbb - sab * sab
+        if det <= 1e-12 * (saa + sbb) ** 2:
+            subset = None
+        else:
+            p_x = [(sbb * a - sab * b) / det for a, b, _ in rows]
+            p_y = [(saa * b - sab * a) / det for a, b, _ in rows]
+            subset = (p_x, p_y,
+                      sum(p * k for p, (_, _, k) in zip(p_x, rows)),
+                      sum(p * k for p, (_, _, k) in zip(p_y, rows)))
+
+        if len(subsets) >= self.max_cached_subsets:
+            subsets.clear()
+        subsets[key] = subset
+        return subset
+
+    def solve(self, ranges, anchors):
+        anchors = as_layout(anchors)
+        ids = _valid_ids(ranges, anchors)
+        if len(ids) < 3:
+            return None
+        subset = self._subset(anchors, ids)
+        if subset is None:
+            return None
+        p_x, p_y, c_x, c_y = subset
+        r0 = float(ranges[ids[0]])
+        w = [float(ranges[i]) ** 2 - r0 * r0 for i in ids[1:]]
+        x = c_x - sum(p * wi for p, wi in zip(p_x, w))
+        y = c_y - sum(p * wi for p, wi in zip(p_y, w))
+        if self.iterations:
+            x, y = self._refine(x, y, [anchors[i] for i in ids], [float(ranges[i]) for i in ids])
+        return x, y, ids
+
+    def _refine(self, x, y, points, distances):
+        for _ in range(self.iterations):
+            jxx = jxy = jyy = gx = gy = 0.0
+            for (ax, ay), r in zip(points, distances):
+                dx, dy = x - ax, y - ay
+                d = math.sqrt(dx * dx + dy * dy)
+                if d < 1e-9:
+                    continue
+                jx, jy, f = dx / d, dy / d, d - r
+                jxx += jx * jx
+                jxy += jx * jy
+                jyy += jy * jy
+                gx += jx * f
+                gy += jy * f
+            det = jxx * jyy - jxy * jxy
+            if det < 1e-12:
+                break
+            step_x = (jyy * gx - jxy * gy) / det
+            step_y = (jxx * gy - jxy * gx) / det
+            x -= step_x
+            y -= step_y
+            if abs(step_x) < 1e-6 and abs(step_y) < 1e-6:
+                break
+        return x, y
+
+    def solve_batch(self, ranges_list, anchors):
+        if np is None or not ranges_list:
+            return super().solve_batch(ranges_list, anchors)
+        anchors = as_layout(anchors)
+        m = len(anchors)
+        r = np.array([(list(ranges[:m]) + [0] * m)[:m] for ranges in ranges_list], dtype=np.float64)
+        positive = r > 0
+        masks = positive.astype(np.int64) @ (1 << np.arange(m, dtype=np.int64))
+        results = [None] * len(r)
+
+        for mask in np.unique(masks).tolist():
+            ids = [i for i in range(m) if mask >> i & 1]
+            subset = self._subset(anchors, ids) if len(ids) >= 3 else None
+            if subset is None:
+                continue
+            p_x, p_y, c_x, c_y = subset
+            rows = np.flatnonzero(masks == mask)
+            sel = r[np.ix_(rows, ids)]
+            w = sel[:, 1:] ** 2 - sel[:, :1] ** 2
+            x = c_x - w @ np.asarray(p_x)
+            y = c_y - w @ np.asarray(p_y)
+            if self.iterations:
+                x, y = self._refine_batch(x, y, np.asarray([anchors[i] for i in ids], dtype=np.float64), sel)
+            for row, xi, yi in zip(rows.tolist(), x.tolist(), y.tolist()):
+                results[row] = (xi, yi, ids)
+        return results
+
+    def _refine_batch(self, x, y, points, distances):
+        """_refine for N frames sharing the same anchors (points: n x 2, distances: N x n)."""
+        active = np.ones(len(x), dtype=bool)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for _ in range(self.iterations):
+                dx = x[:, None] - points[None, :, 0]
+                dy = y[:, None] - points[None, :, 1]
+                d = np.sqrt(dx * dx + dy * dy)
+                near = d >= 1e-9
+                jx = np.where(near, dx / d, 0.0)
+                jy = np.where(near, dy / d, 0.0)
+                f = np.where(near, d - distances, 0.0)
+                jxx, jxy, jyy = (jx * jx).sum(1), (jx * jy).sum(1), (jy * jy).sum(1)
+                gx, gy = (jx * f).sum(1), (jy * f).sum(1)
+                det = jxx * jyy - jxy * jxy
+                active &= det >= 1e-12
+                step_x = np.where(active, (jyy * gx - jxy * gy) / det, 0.0)
+                step_y = np.where(active, (jxx * gy - jxy * gx) / det, 0.0)
+                x = x - step_x
+                y = y - step_y
+                active &= (np.abs(step_x) >= 1e-6) | (np.abs(step_y) >= 1e-6)
+                if not active.any():
+                    break
+        return x, y
+
+
+class GaussNewtonSolver(LeastSquaresSolver):
+    """LeastSquaresSolver refined with POSITION_GN_ITERATIONS Gauss-Newton steps."""
+    name = "gauss_newton"
+
+    def __init__(self, iterations=POSITION_GN_ITERATIONS):
+        super().__init__(iterations=iterations)
+
+
+# -------------------- Registry --------------------
+SOLVERS = {}
+
+
+def register_solver(solver):
+    """Make a Solver instance available to get_solver()/POSITION_SOLVER by its name."""
+    SOLVERS[solver.name] = solver
+    return solver
+
+
+register_solver(PairwiseCircleSolver())
+register_solver(LinearSolver())
+register_solver(LeastSquaresSolver())
+register_solver(GaussNewtonSolver())
+
+
+def get_solver(name=None):
+    """The solver registered as `name` (default POSITION_SOLVER)."""
+    name = name or POSITION_SOLVER
+    try:
+        return SOLVERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown position solver {name!r} (known: {', '.join(sorted(SOLVERS))})")
+
+
+def _clamped(fix, width, height):
+    if fix is None:
+        return None
+    x, y, used_ids = fix
+    if not (math.isfinite(x) and math.isfinite(y)):
+        return None
+    return max(0.0, min(width, x)), max(0.0, min(height, y)), list(used_ids)
+
+
+def solve_fix(ranges, geometry, solver=None):
+    """(x, y, used_slots) clamped to the room of a RoomGeometry, or None."""
+    fix = get_solver(solver).solve(geometry.planar(ranges), geometry.layout)
+    return _clamped(fix, geometry.width, geometry.height)
+
+
+def solve_fixes(ranges_list, geometry, solver=None):
+    """solve_fix for many frames (vectorized where the solver supports it)."""
+    fixes = get_solver(solver).solve_batch([geometry.planar(ranges) for ranges in ranges_list], geometry.layout)
+    return [_clamped(fix, geometry.width, geometry.height) for fix in fixes]
+
+
+def nearest_three_position(ranges, width, height):
+    """
+    Average the pairwise circle intersections of the three nearest anchors
+    (A0..A3 only) and clamp the result to the room.
+    Returns (x, y, selected_ids), or None with fewer than three valid ranges.
+    """
+    return solve_fix(ranges, rectangle_geometry(width, height), solver="pairwise")
+
+
+def nearest_three_positions(ranges_list, width, height):
+    """nearest_three_position over a list of range lists (NumPy batch when available)."""
+    return solve_fixes(ranges_list, rectangle_geometry(width, height), solver="pairwise")
+
+
+def position_dict(fix, geometry):
+    """The public "position" shape every endpoint returns for a fix (2-decimal x/y)."""
+    x, y, used_slots = fix
+    return {
+        "x": round(x, 2),
+        "y": round(y, 2),
+        "x_normalized": round(x / geometry.width, 4),
+        "y_normalized": round(y / geometry.height, 4),
+        "selected_anchors": [geometry.layout.ids[i] for i in used_slots]
+    }
@@ -0,0 +1,167 @@
+"""
+Per-tag Kalman filtering of fixes (POSITION_FILTER=kalman).
+
+Each (topic, tag) gets a constant-velocity filter, state [x, y, vx, vy] in
+room inches, updated with every fix newer than the last one it consumed; the
+server feeds it every stored frame of a tracked topic (see topics()).
+x and y are independent under this model, so the filter runs as two 2-state
+filters; the reported 4x4 covariance is their block combination.
+
+Between frames the state is predicted forward to the time it is read (at
+most KALMAN_MAX_PREDICT_S past the last frame), so a viewer on a long
+update_interval still gets a current estimate. Tracks restart after
+KALMAN_RESET_S without frames or when the room's size or anchors change, and are
+dropped after KALMAN_TRACK_TTL_S.
+"""
+import datetime
+import os
+import threading
+
+POSITION_FILTER      = os.getenv("POSITION_FILTER", "none").lower()
+KALMAN_ACCEL_STD     = float(os.getenv("KALMAN_ACCEL_STD", "20"))     # in/s^2, process noise
+KALMAN_MEAS_STD      = float(os.getenv("KALMAN_MEAS_STD", "12"))      # in, fix noise
+KALMAN_INIT_VEL_STD  = float(os.getenv("KALMAN_INIT_VEL_STD", "50"))  # in/s, new tracks
+KALMAN_MAX_PREDICT_S = float(os.getenv("KALMAN_MAX_PREDICT_S", "2"))
+KALMAN_RESET_S       = float(os.getenv("KALMAN_RESET_S", "10"))
+KALMAN_TRACK_TTL_S   = float(os.getenv("KALMAN_TRACK_TTL_S", "600"))
+
+
+def _predict(axis, dt, q):
+    """[p, v, P00, P01, P11] advanced by dt under white acceleration noise q."""
+    p, v, p00, p01, p11 = axis
+    dt2 = dt * dt
+    return [
+        p + v * dt,
+        v,
+        p00 + 2 * dt * p01 + dt2 * p11 + q * dt2 * dt2 / 4,
+        p01 + dt * p11 + q * dt2 * dt / 2,
+        p11 + q * dt2,
+    ]
+
+
+def _update(axis, z, r):
+    p, v, p00, p01, p11 = axis
+    s = p00 + r
+    k0, k1 = p00 / s, p01 / s
+    innovation = z - p
+    return [
+        p + k0 * innovation,
+        v + k1 * innovation,
+        (1 - k0) * p00,
+        (1 - k0) * p01,
+        p11 - k1 * p01,
+    ]
+
+
+class KalmanTrack:
+    """Constant-velocity filter of one tag; times are datetimes (naive UTC)."""
+
+    def __init__(self, x, y, ts, accel_std=KALMAN_ACCEL_STD, meas_std=KALMAN_MEAS_STD,
+                 init_vel_std=KALMAN_INIT_VEL_STD):
+        self.q = accel_std * accel_std
+        self.r = meas_std * meas_std
+        v0 = init_vel_std * init_vel_std
+        self.axes = [[x, 0.0, self.r, 0.0, v0], [y, 0.0, self.r, 0.0, v0]]
+        self.ts = ts
+        self.updates = 1
+
+    def update(self, x, y, ts):
+        dt = max(0.0, (ts - self.ts).total_seconds())
+        self.axes = [_update(_predict(axis, dt, self.q), z, self.r) for axis, z in zip(self.axes, (x, y))]
+        self.ts = ts
+        self.updates += 1
+
+    def state_at(self, at, max_predict_s=KALMAN_MAX_PREDICT_S):
+        """(x, y, vx, vy, covariance 4x4, predicted seconds) predicted to `at` without changing the track."""
+        dt = min(max(0.0, (at - self.ts).total_seconds()), max_predict_s)
+        (x, vx, x00, x01, x11), (y, vy, y00, y01, y11) = [_predict(axis, dt, self.q) for axis in self.axes]
+        covariance = [
+            [x00, 0.0, x01, 0.0],
+            [0.0, y00, 0.0, y01],
+            [x01, 0.0, x11, 0.0],
+            [0.0, y01, 0.0, y11],
+        ]
+        return x, y, vx, vy, covariance, dt
+
+
+class TagTracker:
+    """KalmanTracks by (topic, tag_id), shared by the REST and Socket.IO paths."""
+
+    def __init__(self, reset_s=KALMAN_RESET_S, ttl_s=KALMAN_TRACK_TTL_S):
+        self.reset_s = reset_s
+        self.ttl_s = ttl_s
+        self._tracks = {}  # key -> (geometry identity, KalmanTrack)
+        self._lock = threading.Lock()
+        self._swept_at = None
+
+    @staticmethod
+    def _identity(geometry):
+        # not the room id: rooms bound to the same topic share the tag's track
+        return geometry.width, geometry.height, geometry.anchors_key
+
+    def observe(self, key, geometry, fix, ts, now=None):
+        """
+        Feed the fix of a frame taken at `ts` (skipped unless newer than the
+        track's last one; fix None = no position in this frame) and return the
+        track's kalman_dict() at `now`, or None if the tag has no track.
+        """
+        now = now or datetime.datetime.utcnow()
+        if not isinstance(ts, datetime.datetime):
+            ts = now
+        identity = self._identity(geometry)
+        with self._lock:
+            self._sweep(now)
+            known, track = self._tracks.get(key, (None, None))
+            if known != identity or (track and (ts - track.ts).total_seconds() > self.reset_s):
+                track = None
+            if fix is not None:
+                if track is None:
+                    track = KalmanTrack(fix[0], fix[1], ts)
+                elif ts > track.ts:
+                    track.update(fix[0], fix[1], ts)
+            if track is None:
+                self._tracks.pop(key, None)
+                return None
+            self._tracks[key] = (identity, track)
+            state = track.state_at(now)
+            updates = track.updates
+        return kalman_dict(state, geometry, updates)
+
+    def _sweep(self, now):
+        if self._swept_at and (now - self._swept_at).total_seconds() < 60:
+            return
+        self._swept_at = now
+        for key, (_, track) in list(self._tracks.items()):
+            if (now - track.ts).total_seconds() > self.ttl_s:
+                del self._tracks[key]
+
+    def topics(self):
+        """Topics that have a live track (the frames to feed the tracker)."""
+        with self._lock:
+            return {key[0] for key in self._tracks}
+
+    def clear(self, topic=None):
+        with self._lock:
+            if topic is None:
+                self._tracks.clear()
+            else:
+                for key in [k for k in self._tracks if k[0] == topic]:
+                    del self._tracks[key]
+
+
+def kalman_dict(state, geometry, updates):
+    """The "kalman" block of a tag position: filtered x/y (clamped to the room), velocity and covariance."""
+    x, y, vx, vy, covariance, predicted_s = state
+    x = max(0.0, min(geometry.width, x))
+    y = max(0.0, min(geometry.height, y))
+    return {
+        "x": round(x, 2),
+        "y": round(y, 2),
+        "x_normalized": round(x / geometry.width, 4),
+        "y_normalized": round(y / geometry.height, 4),
+        "vx": round(vx, 2),
+        "vy": round(vy, 2),
+        "covariance": [[round(c, 3) for c in row] for row in covariance],
+        "predicted_s": round(predicted_s, 3),
+        "updates": updates
+    }
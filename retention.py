@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Retention and downsampling for raw UWB range data.
+
+Raw frames are kept RAW_RETENTION_DAYS via a TTL index on "ts" (0 = keep
+forever). Per-topic policies in the retention_policies collection,
+{"mqtt_topic": "1000087", "raw_days": 7}, can only shorten that; the rollup
+job enforces them after the data has been rolled up.
+
+The rollup job writes per-tag summaries before raw data expires:
+
+    uwb_rollup_1s / uwb_rollup_1m:
+    {
+        "mqtt_topic": "1000087", "tag_id": 0,
+        "ts": datetime,                  # bucket start
+        "count": 10,                     # frames in the bucket
+        "position_count": 10,            # frames that produced a position
+        "x_mean": 120.5, "y_mean": 80.1, # inches, None without a room
+        "range_min": [..], "range_max": [..]   # per anchor, ignoring 0 (no reading)
+    }
+
+The 1s tier is built from raw frames, the 1m tier from the 1s tier. Progress is
+kept in the rollup_state collection, so the job can be stopped and restarted.
+Each run re-summarises the last ROLLUP_RESCAN_S before its checkpoint, for
+frames stored a little late (pipeline backlog); writers that store frames
+much later (spill-log replays in taha.py) call mark_late_frames() and the
+next run re-summarises from the oldest of them. Per-topic policies only
+delete raw frames that settled rollups cover. The RAW_RETENTION_DAYS TTL
+index cannot wait for the job; keep it well above the longest outage.
+
+Run standalone (python retention.py) or in the API process with
+ROLLUP_IN_SERVER=1 (see final_server.initialize_server).
+"""
+import datetime
+import os
+import sys
+import threading
+
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
+
+from mqtt_records import (
+    MQTT_DATA_COLLECTION, TIMESERIES_MODE, TOPIC_KEY,
+    ensure_mqtt_data_collection, flatten_record, record_tag_ranges,
+)
+from positioning import ROOM_GEOMETRY_FIELDS, room_geometry, solve_fix, stored_position
+
+# -------------------- Config --------------------
+MONGO_URI                = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB                 = os.getenv("MONGO_DB", "auth_system")
+RAW_RETENTION_DAYS       = float(os.getenv("RAW_RETENTION_DAYS", "0"))        # 0 = keep forever
+ROLLUP_1S_RETENTION_DAYS = float(os.getenv("ROLLUP_1S_RETENTION_DAYS", "90"))
+ROLLUP_1M_RETENTION_DAYS = float(os.getenv("ROLLUP_1M_RETENTION_DAYS", "0"))  # 0 = keep forever
+ROLLUP_INTERVAL_S        = float(os.getenv("ROLLUP_INTERVAL_S", "60"))
+ROLLUP_LAG_S             = float(os.getenv("ROLLUP_LAG_S", "10"))   # leave room for late frames
+ROLLUP_CHUNK_S           = int(os.getenv("ROLLUP_CHUNK_S", "300"))  # raw window per query
+ROLLUP_RESCAN_S          = int(os.getenv("ROLLUP_RESCAN_S", "300")) # re-summarised behind the checkpoint
+ROLLUP_STATE_COLLECTION  = "rollup_state"
+
+# Storage tiers from finest to coarsest
+TIERS = [
+    {"name": "raw", "collection": None, "bucket_s": 0, "retention_days": RAW_RETENTION_DAYS},
+    {"name": "1s", "collection": "uwb_rollup_1s", "bucket_s": 1, "retention_days": ROLLUP_1S_RETENTION_DAYS},
+    {"name": "1m", "collection": "uwb_rollup_1m", "bucket_s": 60, "retention_days": ROLLUP_1M_RETENTION_DAYS},
+]
+
+
+# -------------------- Helpers --------------------
+def _floor(ts, seconds):
+    """Round a datetime down to a multiple of `seconds` since the epoch."""
+    epoch = datetime.datetime(1970, 1, 1)
+    offset = (ts - epoch).total_seconds()
+    return epoch + datetime.timedelta(seconds=int(offset // seconds) * seconds)
+
+def _merge(values, incoming, pick):
+    """Element-wise min/max of two range lists, treating None as missing."""
+    merged = list(values)
+    for i, v in enumerate(incoming):
+        if i >= len(merged):
+            merged.append(v)
+        elif v is not None:
+            merged[i] = v if merged[i] is None else pick(merged[i], v)
+    return merged
+
+def _valid(ranges):
+    return [r if r > 0 else None for r in ranges]
+
+def topic_raw_days(policies, mqtt_topic):
+    """Raw retention (days, 0 = forever) of a topic: the shorter of RAW_RETENTION_DAYS and its policy."""
+    policy = policies.find_one({"mqtt_topic": mqtt_topic}, {"raw_days": 1})
+    days = [d for d in (RAW_RETENTION_DAYS, (policy or {}).get("raw_days") or 0) if d > 0]
+    return min(days) if days else 0
+
+def pick_history_tier(window_start, resolution_s=0, now=None, raw_days=None):
+    """
+    Pick the storage tier for a history query starting at window_start.
+    Returns the coarsest tier whose bucket fits resolution_s and whose retention
+    still covers the window; if raw data for the window has expired, falls back
+    to the finest tier that still covers it. raw_days overrides the raw tier's
+    retention (a topic's policy, see topic_raw_days).
+    """
+    now = now or datetime.datetime.utcnow()
+    if window_start is not None and window_start.tzinfo is not None:
+        window_start = window_start.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    def covers(tier):
+        days = raw_days if tier["collection"] is None and raw_days is not None else tier["retention_days"]
+        return window_start is None or days <= 0 or window_start >= now - datetime.timedelta(days=days)
+
+    candidates = [t for t in TIERS if t["bucket_s"] <= resolution_s and covers(t)]
+    if candidates:
+        return candidates[-1]
+    covering = [t for t in TIERS if covers(t)]
+    return covering[0] if covering else TIERS[-1]
+
+def mark_late_frames(state_collection, batch, tier="1s"):
+    """
+    Record in rollup_state that frames of `batch` were stored after their ts
+    may already have been rolled up; the next run re-summarises from the
+    oldest one.
+    """
+    stamps = [doc["ts"] for doc in batch if isinstance(doc.get("ts"), datetime.datetime)]
+    if stamps:
+        state_collection.update_one({"_id": f"late_{tier}"},
+                                    {"$min": {"since": min(stamps)}, "$inc": {"marks": 1}}, upsert=True)
+
+def ensure_retention_indexes(db, raw_collection):
+    """TTL index on raw frames plus unique/TTL indexes on the rollup tiers."""
+    if RAW_RETENTION_DAYS <= 0:
+        # No expiry, but the rollup job still scans raw frames by ts
+        raw_collection.create_index([("ts", ASCENDING)])
+    else:
+        ttl = int(RAW_RETENTION_DAYS * 86400)
+        if TIMESERIES_MODE:
+            db.command("collMod", raw_collection.name, expireAfterSeconds=ttl)
+        else:
+            try:
+                raw_collection.create_index([("ts", ASCENDING)], expireAfterSeconds=ttl)
+            except OperationFailure:
+                # A plain "ts" index already exists; turn it into a TTL index
+                db.command("collMod", raw_collection.name,
+                           index={"keyPattern": {"ts": 1}, "expireAfterSeconds": ttl})
+
+    for tier in TIERS[1:]:
+        col = db[tier["collection"]]
+        col.create_index([("mqtt_topic", ASCENDING), ("tag_id", ASCENDING), ("ts", ASCENDING)], unique=True)
+        col.create_index([("mqtt_topic", ASCENDING), ("ts", DESCENDING)])
+        if tier["retention_days"] > 0:
+            col.create_index([("ts", ASCENDING)], expireAfterSeconds=int(tier["retention_days"] * 86400))
+
+
+# -------------------- Rollup job --------------------
+class RollupJob:
+    """Incrementally builds the 1s and 1m tiers and enforces per-topic retention."""
+
+    def __init__(self, db, raw_collection=None):
+        self.db = db
+        self.raw = raw_collection if raw_collection is not None else db[MQTT_DATA_COLLECTION]
+        self.rooms = db["rooms"]
+        self.state = db[ROLLUP_STATE_COLLECTION]
+        self.policies = db["retention_policies"]
+        self.tier_1s = db[TIERS[1]["collection"]]
+        self.tier_1m = db[TIERS[2]["collection"]]
+
+    def _through(self, name, default):
+        doc = self.state.find_one({"_id": name})
+        return doc["through"] if doc else default
+
+    def _advance(self, name, through):
+        self.state.update_one({"_id": name}, {"$set": {"through": through}}, upsert=True)
+
+    def _late(self, name):
+        return self.state.find_one({"_id": f"late_{name}"})
+
+    def _clear_late(self, late):
+        # unless frames were marked late again while this run re-summarised
+        if late:
+            self.state.delete_one({"_id": late["_id"], "marks": late["marks"]})
+
+    def _rescan_start(self, name, step, first):
+        """
+        (start, late mark) of a run: the checkpoint less ROLLUP_RESCAN_S (plus
+        `step`, what the tier below may have rewritten), the oldest frame marked
+        late, or `first` on the first run.
+        """
+        through = self._through(name, None)
+        late = self._late(name)
+        if through is None:
+            return first, late
+        start = through - datetime.timedelta(seconds=ROLLUP_RESCAN_S + step)
+        if late and late["since"] < start:
+            start = late["since"]
+        return start, late
+
+    def _settled(self):
+        """Raw frames before this are covered by rollups no run will redo."""
+        through = self._through("1s", None)
+        if through is None:
+            return None
+        settled = through - datetime.timedelta(seconds=ROLLUP_RESCAN_S)
+        late = self._late("1s")
+        return min(settled, late["since"]) if late else settled
+
+    def _room_geometry(self, cache, topic):
+        if topic not in cache:
+            cache[topic] = room_geometry(self.rooms.find_one({"mqtt_topic": topic}, ROOM_GEOMETRY_FIELDS))
+        return cache[topic]
+
+    def _first_raw_ts(self):
+        first = self.raw.find_one({}, {"ts": 1}, sort=[("ts", ASCENDING)])
+        return first["ts"] if first else None
+
+    def rollup_seconds(self, until):
+        """Summarise raw frames into 1-second buckets up to `until`."""
+        through = self._through("1s", None)
+        start, late = self._rescan_start("1s", 0, self._first_raw_ts() if through is None else None)
+        if start is None:
+            return 0
+        start = _floor(start, 1)
+        until = _floor(until, 1)
+        if start >= until:
+            return 0
+        rescanned_from = start
+        written = 0
+        rooms = {}
+
+        while start < until:
+            end = min(until, start + datetime.timedelta(seconds=ROLLUP_CHUNK_S))
+            buckets = {}
+            cursor = self.raw.find({"ts": {"$gte": start, "$lt": end}}, {"data": 0})
+            for record in cursor:
+                record = flatten_record(record)
+                tag_id, ranges = record_tag_ranges(record)
+                topic = record.get("mqtt_topic")
+                if tag_id is None or not ranges or topic is None:
+                    continue
+
+                key = (topic, tag_id, _floor(record["ts"], 1))
+                bucket = buckets.setdefault(key, {"count": 0, "position_count": 0, "x_sum": 0.0,
+                                                  "y_sum": 0.0, "range_min": [], "range_max": []})
+                bucket["count"] += 1
+                bucket["range_min"] = _merge(bucket["range_min"], _valid(ranges), min)
+                bucket["range_max"] = _merge(bucket["range_max"], _valid(ranges), max)
+
+                geometry = self._room_geometry(rooms, topic)
+                position = (stored_position(record, geometry) or solve_fix(ranges, geometry)) if geometry else None
+                if position:
+                    bucket["x_sum"] += position[0]
+                    bucket["y_sum"] += position[1]
+                    bucket["position_count"] += 1
+
+            written += self._write(self.tier_1s, buckets)
+            if through is None or end > through:
+                self._advance("1s", end)
+            start = end
+
+        if late:
+            # 1s buckets before the 1m checkpoint changed: fold those minutes again
+            mark_late_frames(self.state, [{"ts": rescanned_from}], "1m")
+            self._clear_late(late)
+        return written
+
+    def rollup_minutes(self):
+        """Fold complete minutes of the 1s tier into 1-minute buckets, ROLLUP_CHUNK_S at a time."""
+        until = _floor(self._through("1s", datetime.datetime(1970, 1, 1)), 60)
+        through = self._through("1m", None)
+        first = self.tier_1s.find_one({}, {"ts": 1}, sort=[("ts", ASCENDING)]) if through is None else None
+        start, late = self._rescan_start("1m", 60, first["ts"] if first else None)
+        if start is None:
+            return 0
+        start = _floor(start, 60)
+        if start >= until:
+            return 0
+        step = datetime.timedelta(seconds=max(60, ROLLUP_CHUNK_S // 60 * 60))
+        written = 0
+
+        while start < until:
+            end = min(until, start + step)
+            buckets = {}
+            for doc in self.tier_1s.find({"ts": {"$gte": start, "$lt": end}}):
+                key = (doc["mqtt_topic"], doc["tag_id"], _floor(doc["ts"], 60))
+                bucket = buckets.setdefault(key, {"count": 0, "position_count": 0, "x_sum": 0.0,
+                                                  "y_sum": 0.0, "range_min": [], "range_max": []})
+                bucket["count"] += doc["count"]
+                bucket["range_min"] = _merge(bucket["range_min"], doc.get("range_min", []), min)
+                bucket["range_max"] = _merge(bucket["range_max"], doc.get("range_max", []), max)
+                if doc.get("position_count"):
+                    bucket["x_sum"] += doc["x_mean"] * doc["position_count"]
+                    bucket["y_sum"] += doc["y_mean"] * doc["position_count"]
+                    bucket["position_count"] += doc["position_count"]
+
+            written += self._write(self.tier_1m, buckets)
+            if through is None or end > through:
+                self._advance("1m", end)
+            start = end
+
+        self._clear_late(late)
+        return written
+
+    def _write(self, collection, buckets):
+        ops = []
+        for (topic, tag_id, ts), b in buckets.items():
+            n = b["position_count"]
+            ops.append(UpdateOne(
+                {"mqtt_topic": topic, "tag_id": tag_id, "ts": ts},
+                {"$set": {
+                    "count": b["count"],
+                    "position_count": n,
+                    "x_mean": b["x_sum"] / n if n else None,
+                    "y_mean": b["y_sum"] / n if n else None,
+                    "range_min": b["range_min"],
+                    "range_max": b["range_max"],
+                }},
+                upsert=True
+            ))
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    def enforce_topic_policies(self, now):
+        """Delete raw frames of topics whose policy is shorter than the TTL, once rolled up."""
+        rolled_up = self._settled()
+        if rolled_up is None:
+            return 0
+        deleted = 0
+        for policy in self.policies.find({"raw_days": {"$gt": 0}}):
+            cutoff = min(now - datetime.timedelta(days=policy["raw_days"]), rolled_up)
+            try:
+                result = self.raw.delete_many({TOPIC_KEY: policy["mqtt_topic"], "ts": {"$lt": cutoff}})
+                deleted += result.deleted_count
+            except OperationFailure as e:
+                print(f"[RETENTION] could not apply policy for {policy['mqtt_topic']}: {e}", file=sys.stderr)
+        return deleted
+
+    def run_once(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        until = now - datetime.timedelta(seconds=ROLLUP_LAG_S)
+        return {
+            "1s": self.rollup_seconds(until),
+            "1m": self.rollup_minutes(),
+            "deleted": self.enforce_topic_policies(now),
+        }
+
+    def run_forever(self, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                counts = self.run_once()
+                if any(counts.values()):
+                    print(f"[ROLLUP] {counts}")
+            except Exception as e:
+                print(f"[ROLLUP ERROR] {e}", file=sys.stderr)
+            stop_event.wait(ROLLUP_INTERVAL_S)
+
+
+def start_rollup_thread(db, raw_collection=None):
+    """Run the rollup job in a daemon thread of the current process."""
+    job = RollupJob(db, raw_collection)
+    thread = threading.Thread(target=job.run_forever, name="uwb-rollup", daemon=True)
+    thread.start()
+    return job
+
+
+if __name__ == "__main__":
+    mongo_client = MongoClient(MONGO_URI)
+    db = mongo_client[MONGO_DB]
+    raw = ensure_mqtt_data_collection(db, MQTT_DATA_COLLECTION)
+    ensure_retention_indexes(db, raw)
+    print(f"Rolling up {MONGO_DB}.{raw.name} every {ROLLUP_INTERVAL_S:g}s "
+          f"(raw retention: {RAW_RETENTION_DAYS:g} days, 0 = forever)")
+    try:
+        RollupJob(db, raw).run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mongo_client.close()
@@ -0,0 +1,76 @@
+"""
+Message queue for running several Socket.IO server processes side by side.
+
+With SOCKETIO_MESSAGE_QUEUE set, every emit is published to the queue and
+delivered by each node to its own clients, so a broadcast from one node
+reaches viewers connected anywhere. Supported URLs:
+
+    redis://host:6379/0, rediss://...   Redis pub/sub (needs the redis package)
+    amqp://..., kafka://..., zmq+tcp://  the other Flask-SocketIO backends
+    file:///path/to/bus.log             FileBusManager below: an append-only
+                                        file every node tails. Local stand-in
+                                        for tests and single-host setups.
+
+Clients using HTTP long-polling must keep hitting the node that holds their
+session: put nodes behind nginx with `ip_hash` (or have clients connect with
+transports=['websocket'] and set SOCKETIO_TRANSPORTS=websocket).
+"""
+import os
+import time
+
+from socketio import PubSubManager
+
+
+class FileBusManager(PubSubManager):
+    """
+    Socket.IO client manager publishing through a shared append-only file.
+    Each message is one JSON line written with a single O_APPEND write;
+    listeners start at the current end of the file and poll for new lines.
+    """
+    name = "file"
+
+    def __init__(self, path, channel="flask-socketio", write_only=False, logger=None, poll_interval=0.02):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.poll_interval = poll_interval
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _publish(self, data):
+        line = self.json.dumps({"channel": self.channel, "data": data}) + "\n"
+        os.write(self._fd, line.encode("utf-8"))
+
+    def _sleep(self):
+        if self.server is not None:
+            self.server.sleep(self.poll_interval)
+        else:
+            time.sleep(self.poll_interval)
+
+    def _listen(self):
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pending = b""
+            while True:
+                chunk = f.readline()
+                if not chunk:
+                    self._sleep()
+                    continue
+                pending += chunk
+                if not pending.endswith(b"\n"):
+                    continue  # another node is mid-write
+                line, pending = pending, b""
+                try:
+                    message = self.json.loads(line.decode("utf-8"))
+                except ValueError:
+                    continue
+                if message.get("channel") == self.channel:
+                    yield message["data"]
+
+
+def socketio_queue_options(url, channel="flask-socketio"):
+    """SocketIO(...) keyword arguments for a SOCKETIO_MESSAGE_QUEUE url ({} when unset)."""
+    if not url:
+        return {}
+    if url.startswith("file://"):
+        return {"client_manager": FileBusManager(url[len("file://"):], channel=channel)}
+    return {"message_queue": url, "channel": channel}
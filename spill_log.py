@@ -0,0 +1,151 @@
+"""
+Local segmented append-only log used by the MQTT bridge (taha.py) to hold
+documents while MongoDB is slow or unreachable.
+
+Segment files spill-<n>.log in the spill directory hold records of
+
+    <u32 little-endian payload length><u32 crc32 of payload><BSON payload>
+
+A torn record at the end of a segment (crash mid-write) fails its length/CRC
+check and is ignored. Every document gets an _id before it is written, so a
+replay that is interrupted and retried only produces duplicate-key errors
+instead of duplicate rows.
+
+fsync policy:
+    "always"   - fsync after every append
+    "interval" - fsync at most every `fsync_interval` seconds (default)
+    "never"    - leave it to the OS
+"""
+import os
+import struct
+import threading
+import time
+import zlib
+
+import bson
+from bson import ObjectId
+
+_HEADER = struct.Struct("<II")
+
+
+class SpillLog:
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, max_bytes=4 * 1024 * 1024 * 1024,
+                 fsync="interval", fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_bytes = 0
+        self._last_sync = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        existing = self._segments()
+        self._next_seq = (self._seq(existing[-1]) + 1) if existing else 1
+        self._bytes = sum(os.path.getsize(p) for p in existing)  # left over from a previous run
+
+    # -------------------- Segments --------------------
+    @staticmethod
+    def _seq(path):
+        return int(os.path.basename(path)[len("spill-"):-len(".log")])
+
+    def _segments(self):
+        names = [n for n in os.listdir(self.directory) if n.startswith("spill-") and n.endswith(".log")]
+        return sorted((os.path.join(self.directory, n) for n in names), key=self._seq)
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f"spill-{self._next_seq:08d}.log")
+        self._next_seq += 1
+        self._file = open(path, "ab")
+        self._file_bytes = 0
+
+    def _seal(self):
+        """Close the active segment so replay can read it."""
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def size_bytes(self):
+        return self._bytes
+
+    def pending(self):
+        """True if any spilled documents are waiting for replay."""
+        return self._bytes > 0
+
+    # -------------------- Write --------------------
+    def append(self, docs):
+        """Append documents; returns how many were written (0 if the log is full)."""
+        with self._lock:
+            if self._bytes >= self.max_bytes:
+                self.dropped += len(docs)
+                return 0
+            if self._file is None or self._file_bytes >= self.segment_bytes:
+                self._seal()
+                self._open_segment()
+
+            for doc in docs:
+                doc.setdefault("_id", ObjectId())
+                payload = bson.encode(doc)
+                self._file.write(_HEADER.pack(len(payload), zlib.crc32(payload)))
+                self._file.write(payload)
+                self._file_bytes += _HEADER.size + len(payload)
+                self._bytes += _HEADER.size + len(payload)
+
+            self._file.flush()
+            now = time.monotonic()
+            if self.fsync == "always" or (self.fsync == "interval" and now - self._last_sync >= self.fsync_interval):
+                os.fsync(self._file.fileno())
+                self._last_sync = now
+            return len(docs)
+
+    # -------------------- Replay --------------------
+    @staticmethod
+    def _read_segment(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        view = memoryview(data)
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size
+            payload = view[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break  # torn tail
+            yield bson.decode(payload)
+            offset = start + length
+
+    def replay(self, write_batch, batch_size=500):
+        """
+        Feed spilled documents to write_batch(list_of_docs) oldest first and
+        delete each segment once all of its documents were written. Stops at
+        the first exception from write_batch, which is re-raised.
+        Returns the number of replayed documents.
+        """
+        with self._lock:
+            self._seal()
+            segments = self._segments()
+
+        replayed = 0
+        for path in segments:
+            batch = []
+            for doc in self._read_segment(path):
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    write_batch(batch)
+                    replayed += len(batch)
+                    batch = []
+            if batch:
+                write_batch(batch)
+                replayed += len(batch)
+            with self._lock:
+                self._bytes -= os.path.getsize(path)
+                os.remove(path)
+        return replayed
+
+    def close(self):
+        with self._lock:
+            self._seal()
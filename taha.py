@@ -1,13 +1,21 @@
 # mqtt_to_mongo.py
-import os, sys, json, signal, base64
-from datetime import datetime, timezone
+import os, sys, json, signal, queue, threading, time, zlib
+from datetime import datetime
 
 import paho.mqtt.client as mqtt
 from pymongo import MongoClient
-from bson.binary import Binary
-from datetime import datetime, timedelta, timezone
+from pymongo.errors import BulkWriteError
+
+from ingest_pipeline import IngestPipeline, decode_message, start_worker_pool
+from latest_state import LATEST_STATE_COLLECTION, LATEST_STATE_SHARED, LatestState
+from mqtt_records import (
+    MQTT_DATA_COLLECTION, TOPIC_KEY, IngestFilter, TopicSequencer, ensure_mqtt_data_collection,
+    is_range_frame, stamp_stored,
+)
+from positioning import RoomGeometryCache, attach_position
+from retention import ROLLUP_STATE_COLLECTION, mark_late_frames
+from spill_log import SpillLog
 
-PKT = timezone(timedelta(hours=5))
 
 
 
@@ -21,15 +29,334 @@ MQTT_CLIENT_ID  = os.getenv("MQTT_CLIENT_ID", "mqtt-to-mongo")
 MQTT_QOS        = int(os.getenv("MQTT_QOS", "0"))
 INCLUDE_SYS     = os.getenv("INCLUDE_SYS", "0").lower() in ("1","true","yes")
 
+# Subscriptions: "enrolled" subscribes only to the 7-digit topics in
+# enrolled_devices (re-read every SUBSCRIPTION_REFRESH_S, subscribing/
+# unsubscribing just the difference); "all" keeps the old "#" subscription.
+# To scale out, run BRIDGE_INSTANCES bridges with BRIDGE_INSTANCE_INDEX
+# 0..N-1 (each owns the topics with crc32(topic) % N == index and drops
+# messages of other topics, also under SUBSCRIBE_MODE=all), or give them the
+# same MQTT_SHARE_GROUP so the broker load-balances $share/<group>/<topic>.
+SUBSCRIBE_MODE  = os.getenv("SUBSCRIBE_MODE", "enrolled").lower()
+SUBSCRIPTION_REFRESH_S = float(os.getenv("SUBSCRIPTION_REFRESH_S", "30"))
+# Last enrolled topic set read, used when MongoDB is unreachable at startup
+# (without one the bridge subscribes to every topic until enrollments load)
+SUBSCRIPTION_CACHE = os.getenv("SUBSCRIPTION_CACHE", "./enrolled_topics.json")
+BRIDGE_INSTANCES= max(1, int(os.getenv("BRIDGE_INSTANCES", "1")))
+BRIDGE_INSTANCE_INDEX = int(os.getenv("BRIDGE_INSTANCE_INDEX", "0"))
+MQTT_SHARE_GROUP= os.getenv("MQTT_SHARE_GROUP", "")
+if not 0 <= BRIDGE_INSTANCE_INDEX < BRIDGE_INSTANCES:
+    sys.exit(f"BRIDGE_INSTANCE_INDEX must be between 0 and {BRIDGE_INSTANCES - 1} "
+             f"(BRIDGE_INSTANCES={BRIDGE_INSTANCES}), got {BRIDGE_INSTANCE_INDEX}")
+if BRIDGE_INSTANCES > 1 and not MQTT_SHARE_GROUP and "MQTT_CLIENT_ID" not in os.environ:
+    MQTT_CLIENT_ID = f"{MQTT_CLIENT_ID}-{BRIDGE_INSTANCE_INDEX}"  # broker kicks duplicate client ids
+
+# Write batching: flush when BATCH_MAX_DOCS are buffered or the oldest buffered
+# doc is BATCH_MAX_AGE_MS old, whichever comes first.
+BATCH_MAX_DOCS  = int(os.getenv("BATCH_MAX_DOCS", "500"))
+BATCH_MAX_AGE_MS= int(os.getenv("BATCH_MAX_AGE_MS", "50"))
+QUEUE_MAX_DOCS  = int(os.getenv("QUEUE_MAX_DOCS", "50000"))
+
+# Compute and store tag positions at ingest (rooms are looked up by topic and cached)
+INGEST_POSITIONS= os.getenv("INGEST_POSITIONS", "1").lower() in ("1","true","yes")
+ROOM_CACHE_TTL  = float(os.getenv("ROOM_CACHE_TTL", "30"))
+
+# Staged ingest (see ingest_pipeline.py): on_message only enqueues, a pool of
+# PIPELINE_WORKERS processes decodes payloads and computes positions, the
+# batch writer stores them. PIPELINE_WORKERS=0 decodes inline in on_message.
+# PIPELINE_STATS_S prints per-stage counters (0 = off).
+PIPELINE_WORKERS= int(os.getenv("PIPELINE_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+RECV_QUEUE_MAX  = int(os.getenv("RECV_QUEUE_MAX", "20000"))
+DECODE_CHUNK    = int(os.getenv("DECODE_CHUNK", "200"))
+DECODE_CHUNK_AGE_MS = int(os.getenv("DECODE_CHUNK_AGE_MS", "20"))
+PIPELINE_STATS_S= float(os.getenv("PIPELINE_STATS_S", "60"))
+
+# Write-ahead spill log: batches that cannot be written (Mongo down, or slower
+# than SPILL_SLOW_MS) and docs that overflow the queue go to local segment
+# files and are replayed in bulk every SPILL_RETRY_S once Mongo answers again.
+# SPILL_FSYNC: always | interval | never
+SPILL_ENABLED   = os.getenv("SPILL_ENABLED", "1").lower() in ("1","true","yes")
+SPILL_DIR       = os.getenv("SPILL_DIR", "./spill")
+SPILL_SEGMENT_MB= int(os.getenv("SPILL_SEGMENT_MB", "64"))
+SPILL_MAX_MB    = int(os.getenv("SPILL_MAX_MB", "4096"))
+SPILL_FSYNC     = os.getenv("SPILL_FSYNC", "interval").lower()
+SPILL_FSYNC_INTERVAL_S = float(os.getenv("SPILL_FSYNC_INTERVAL_S", "1"))
+SPILL_RETRY_S   = float(os.getenv("SPILL_RETRY_S", "5"))
+SPILL_SLOW_MS   = int(os.getenv("SPILL_SLOW_MS", "2000"))
+
 MONGO_URI       = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 MONGO_DB        = os.getenv("MONGO_DB", "auth_system")
-MONGO_COLLECTION= os.getenv("MONGO_COLLECTION", "mqtt_data")
+MONGO_COLLECTION= os.getenv("MONGO_COLLECTION", MQTT_DATA_COLLECTION)
+MONGO_TIMEOUT_MS= int(os.getenv("MONGO_TIMEOUT_MS", "5000"))
+
+# Fork the decode workers first: they must not inherit the MongoClient or
+# the writer/paho threads started below
+decode_pool = start_worker_pool(PIPELINE_WORKERS) if PIPELINE_WORKERS > 0 else None
 
 # -------------------- Mongo --------------------
-mongo_client = MongoClient(MONGO_URI)
-col = mongo_client[MONGO_DB][MONGO_COLLECTION]
-col.create_index("ts")
-col.create_index("topic")
+# Short timeouts so an unreachable server is detected quickly and batches spill
+mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+                           socketTimeoutMS=MONGO_TIMEOUT_MS * 2)
+try:
+    col = ensure_mqtt_data_collection(mongo_client[MONGO_DB], MONGO_COLLECTION)  # time-series if MQTT_DATA_TIMESERIES=1
+    col.create_index([(TOPIC_KEY, 1), ("ts", -1)])
+except Exception as e:
+    if not SPILL_ENABLED:
+        raise
+    print(f"⚠ Warning: MongoDB not reachable at startup ({e}); spilling to {SPILL_DIR}", file=sys.stderr)
+    col = mongo_client[MONGO_DB][MONGO_COLLECTION]
+
+class MongoBatchWriter:
+    """
+    Bounded in-memory buffer drained by a flusher thread with insert_many.
+    put() never blocks the paho network thread; when the queue is full the
+    doc goes to the spill log (or is dropped and counted without one).
+    `prepare` (optional) is called once on each batch in the flusher thread
+    right before it is inserted; batches that go straight to the spill log
+    skip it and are replayed as they are. `on_written` (optional) gets each
+    batch after insert_many succeeded, replays included, so side writes such
+    as the shared latest state never block a spill while MongoDB is down.
+    `on_replayed` (optional) gets each spilled batch before it is replayed;
+    if it raises, the replay is retried later.
+
+    With a spill log, a batch whose insert fails with anything but a
+    BulkWriteError (or takes longer than slow_ms) is appended to the log and
+    the writer switches to spilling every batch until a replay of the log
+    succeeds; replay is attempted every retry_s.
+    """
+
+    def __init__(self, collection, max_docs=500, max_age_ms=50, max_queue=50000, prepare=None,
+                 spill=None, retry_s=5.0, slow_ms=2000, on_written=None, on_replayed=None):
+        self.collection = collection
+        self.prepare = prepare
+        self.on_written = on_written
+        self.on_replayed = on_replayed
+        self.spill = spill
+        self.retry_s = retry_s
+        self.slow = slow_ms / 1000.0 if slow_ms > 0 else None
+        self.max_docs = max(1, max_docs)
+        self.max_age = max(0, max_age_ms) / 1000.0
+        self.dropped = 0
+        self.written = 0
+        self.spilled = 0
+        self.replayed = 0
+        self._healthy = not (spill and spill.pending())
+        self._next_retry = time.monotonic()
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mongo-flusher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, doc) -> bool:
+        try:
+            self._queue.put_nowait(doc)
+            return True
+        except queue.Full:
+            if self.spill and self.spill.append([doc]):
+                self.spilled += 1
+                return True
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                print(f"[BUFFER FULL] dropped {self.dropped} docs so far", file=sys.stderr)
+            return False
+
+    def close(self, timeout=None):
+        """Stop the flush loop after draining whatever is still buffered."""
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self.spill:
+            self.spill.close()
+
+    def _prepare(self, batch):
+        if self.prepare:
+            try:
+                self.prepare(batch)
+            except Exception as e:
+                print(f"[PREPARE ERROR] {e}", file=sys.stderr)
+
+    def _write(self, batch):
+        """_insert, then hand the stored batch to on_written."""
+        self._insert(batch)
+        if self.on_written:
+            try:
+                self.on_written(batch)
+            except Exception as e:
+                print(f"[WRITTEN HOOK ERROR] {e}", file=sys.stderr)
+
+    def _insert(self, batch):
+        """
+        insert_many the batch. Per-document rejections are logged and
+        counted; duplicate keys (a replayed doc that already made it in)
+        count as written. Connection/timeout errors propagate.
+        """
+        stamp_stored(batch)
+        try:
+            result = self.collection.insert_many(batch, ordered=False)
+            self.written += len(result.inserted_ids)
+        except BulkWriteError as e:
+            details = e.details or {}
+            errors = details.get("writeErrors", [])
+            duplicates = sum(1 for err in errors if err.get("code") == 11000)
+            self.written += details.get("nInserted", 0) + duplicates
+            if len(errors) > duplicates:
+                print(f"[MONGO ERROR] bulk insert: {len(errors) - duplicates} of {len(batch)} docs failed",
+                      file=sys.stderr)
+
+    def _replay(self, batch):
+        if self.on_replayed:
+            self.on_replayed(batch)
+        self._write(batch)
+
+    def _to_spill(self, batch):
+        written = self.spill.append(batch)
+        self.spilled += written
+        if written < len(batch):
+            self.dropped += len(batch) - written
+            print(f"[SPILL FULL] dropped {len(batch)} docs ({self.spill.max_bytes >> 20} MB cap)", file=sys.stderr)
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        if self.spill and not self._healthy:
+            self._to_spill(batch)
+            return
+
+        self._prepare(batch)
+        started = time.monotonic()
+        try:
+            self._write(batch)
+        except Exception as e:
+            if not self.spill:
+                print(f"[MONGO ERROR] {e} ({len(batch)} docs lost)", file=sys.stderr)
+                return
+            print(f"[MONGO ERROR] {e}; spilling to {self.spill.directory}", file=sys.stderr)
+            self._to_spill(batch)
+            self._mark_unhealthy()
+            return
+
+        if self.spill and self.slow and time.monotonic() - started > self.slow:
+            print(f"[MONGO SLOW] insert of {len(batch)} docs took {time.monotonic() - started:.1f}s; "
+                  f"spilling for {self.retry_s:.0f}s", file=sys.stderr)
+            self._mark_unhealthy()
+
+    def _mark_unhealthy(self):
+        self._healthy = False
+        self._next_retry = time.monotonic() + self.retry_s
+
+    def _maybe_replay(self):
+        """Replay the spill log if it has data and the retry interval has passed."""
+        if time.monotonic() < self._next_retry:
+            return
+        self._next_retry = time.monotonic() + self.retry_s
+        if self._healthy and not self.spill.pending():
+            return
+        try:
+            replayed = self.spill.replay(self._replay, self.max_docs)
+        except Exception as e:
+            print(f"[SPILL] replay deferred: {e}", file=sys.stderr)
+            self._healthy = False
+            return
+        self.replayed += replayed
+        self._healthy = True
+        if replayed:
+            print(f"[SPILL] replayed {replayed} docs into MongoDB")
+
+    def stats(self):
+        return {
+            "write_queue": self._queue.qsize(),
+            "written": self.written,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+        }
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            if batch:
+                wait = max(0.0, deadline - time.monotonic())
+            else:
+                wait = 0.1
+            try:
+                doc = self._queue.get(timeout=wait)
+                if not batch:
+                    deadline = time.monotonic() + self.max_age
+                batch.append(doc)
+            except queue.Empty:
+                pass
+
+            if batch and (len(batch) >= self.max_docs or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+
+            if self.spill:
+                self._maybe_replay()
+
+            if self._stopping.is_set() and self._queue.empty():
+                self._flush(batch)
+                return
+
+room_cache = RoomGeometryCache(mongo_client[MONGO_DB]["rooms"], ROOM_CACHE_TTL)
+
+def _add_positions(batch):
+    """Store each range frame's position, resolving topic -> room through room_cache."""
+    for doc in batch:
+        if is_range_frame(doc):
+            topic = doc["meta"]["mqtt_topic"] if "meta" in doc else doc["mqtt_topic"]
+            attach_position(doc, room_cache.get(topic))
+
+# Shared latest-state store the API servers read current tag positions from
+latest_state = LatestState(mongo_client[MONGO_DB][LATEST_STATE_COLLECTION]) if LATEST_STATE_SHARED else None
+
+def _prepare_batch(batch):
+    if INGEST_POSITIONS and PIPELINE_WORKERS == 0:
+        _add_positions(batch)
+
+rollup_state = mongo_client[MONGO_DB][ROLLUP_STATE_COLLECTION]
+
+spill = SpillLog(SPILL_DIR, SPILL_SEGMENT_MB << 20, SPILL_MAX_MB << 20,
+                 SPILL_FSYNC, SPILL_FSYNC_INTERVAL_S) if SPILL_ENABLED else None
+# With the pipeline, positions are attached in the worker processes instead
+writer = MongoBatchWriter(col, BATCH_MAX_DOCS, BATCH_MAX_AGE_MS, QUEUE_MAX_DOCS,
+                          prepare=_prepare_batch,
+                          on_written=latest_state.update if latest_state else None,
+                          # replayed frames may predate the rollup checkpoint (see retention.py)
+                          on_replayed=lambda batch: mark_late_frames(rollup_state, batch),
+                          spill=spill, retry_s=SPILL_RETRY_S, slow_ms=SPILL_SLOW_MS)
+writer.start()
+
+sequencer = TopicSequencer()
+
+# Duplicate / over-rate frame filter (INGEST_DEDUP_WINDOW_S, INGEST_MAX_RATE_HZ)
+ingest_filter = IngestFilter()
+
+pipeline = None
+if PIPELINE_WORKERS > 0:
+    pipeline = IngestPipeline(writer, PIPELINE_WORKERS,
+                              geometry_for=room_cache.get if INGEST_POSITIONS else None,
+                              accept=ingest_filter.accept if ingest_filter.enabled else None,
+                              recv_max=RECV_QUEUE_MAX, chunk_size=DECODE_CHUNK,
+                              chunk_age_ms=DECODE_CHUNK_AGE_MS, pool=decode_pool)
+    pipeline.start()
+
+def _report_stats(interval):
+    """Print per-stage counters and rates every `interval` seconds."""
+    last, last_t = {}, time.monotonic()
+    while True:
+        time.sleep(interval)
+        now = time.monotonic()
+        current = dict(pipeline.stats() if pipeline else {}, **ingest_filter.stats(), **writer.stats())
+        rates = {k: (current[k] - last.get(k, 0)) / (now - last_t)
+                 for k in ("received", "decoded", "written") if k in current}
+        print("[STATS] " + " ".join(f"{k}={v}" for k, v in current.items()) + " | "
+              + " ".join(f"{k}/s={v:.0f}" for k, v in rates.items()))
+        last, last_t = current, now
+
+if PIPELINE_STATS_S > 0:
+    threading.Thread(target=_report_stats, args=(PIPELINE_STATS_S,), name="ingest-stats", daemon=True).start()
 
 # -------------------- Helpers --------------------
 def _rc_value(x):
@@ -47,23 +374,17 @@ def _rc_name(x):
         except Exception:
             return str(x)
 
-def _bytes_to_data(b: bytes) -> tuple[str, bytes]:
-    """
-    Returns (data_string, raw_bytes).
-    JSON -> compact string; UTF-8 -> text; otherwise base64 (prefixed).
-    """
-    if not b:
-        return "", b
-    try:
-        # Try JSON first
-        parsed = json.loads(b.decode("utf-8"))
-        return json.dumps(parsed, separators=(",", ":")), b
-    except Exception:
-        pass
-    try:
-        return b.decode("utf-8"), b
-    except Exception:
-        return "base64:" + base64.b64encode(b).decode("ascii"), b
+def _is_7_digit_topic(topic) -> bool:
+    return isinstance(topic, str) and len(topic) == 7 and topic.isdigit() and topic[0] != "0"
+
+def _owns_topic(topic: str) -> bool:
+    """Hash partition of topics across bridge instances (stable across processes)."""
+    if MQTT_SHARE_GROUP or BRIDGE_INSTANCES == 1:
+        return True
+    return zlib.crc32(topic.encode()) % BRIDGE_INSTANCES == BRIDGE_INSTANCE_INDEX
+
+def _subscription_filter(topic: str) -> str:
+    return f"$share/{MQTT_SHARE_GROUP}/{topic}" if MQTT_SHARE_GROUP else topic
 
 # -------------------- MQTT Client (Paho v2 / MQTT v5) --------------------
 client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
@@ -73,6 +394,128 @@ client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
 if MQTT_USER:
     client.username_pw_set(MQTT_USER, MQTT_PASS)
 
+class TopicSubscriptions:
+    """
+    Keeps the client subscribed to the enrolled topics this instance owns.
+    refresh() re-reads enrolled_devices and (un)subscribes only the topics
+    that changed; resubscribe_all() restores everything after a reconnect.
+
+    Each topic set read is saved to `cache_path`. Until the first read
+    succeeds, the saved set is used, or without one the WILDCARD filter
+    (on_message keeps the 7-digit topics this instance owns); it is
+    narrowed to the enrolled topics once they can be read.
+    """
+
+    CHUNK = 100     # topic filters per SUBSCRIBE/UNSUBSCRIBE packet
+    WILDCARD = "+"  # device topics are single-level
+
+    def __init__(self, client, enrollments, qos=0, cache_path=None):
+        self.client = client
+        self.enrollments = enrollments
+        self.qos = qos
+        self.cache_path = cache_path
+        self.desired = set()
+        self.subscribed = set()
+        self.wildcard = False        # subscribe to WILDCARD (no topic set known yet)
+        self._wildcard_on = False
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._connected = False
+
+    def _load(self):
+        topics = self.enrollments.distinct("mqtt_topic")
+        return {t for t in topics if _is_7_digit_topic(t) and _owns_topic(t)}
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                return {t for t in json.load(f) if _is_7_digit_topic(t) and _owns_topic(t)}
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def _write_cache(self, topics):
+        if not self.cache_path or (self._loaded and topics == self.desired):
+            return
+        try:
+            tmp = f"{self.cache_path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(sorted(topics), f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            print(f"[SUBSCRIBE] could not save topic cache {self.cache_path}: {e}", file=sys.stderr)
+
+    def _subscribe(self, topics):
+        topics = sorted(topics)
+        for i in range(0, len(topics), self.CHUNK):
+            self.client.subscribe([(_subscription_filter(t), self.qos) for t in topics[i:i + self.CHUNK]])
+
+    def _unsubscribe(self, topics):
+        topics = sorted(topics)
+        for i in range(0, len(topics), self.CHUNK):
+            self.client.unsubscribe([_subscription_filter(t) for t in topics[i:i + self.CHUNK]])
+
+    def refresh(self):
+        wildcard = False
+        try:
+            desired = self._load()
+            self._write_cache(desired)
+            self._loaded = True
+        except Exception as e:
+            if self._loaded:
+                print(f"[SUBSCRIBE] could not read enrolled topics ({e}); keeping {len(self.desired)}",
+                      file=sys.stderr)
+                return
+            desired = self._read_cache() if self.cache_path else None
+            wildcard = desired is None
+            print(f"[SUBSCRIBE] could not read enrolled topics ({e}); "
+                  + ("subscribing to all topics" if wildcard else f"using {len(desired)} cached topics"),
+                  file=sys.stderr)
+            desired = desired or set()
+        with self._lock:
+            self.desired = desired
+            self.wildcard = wildcard
+            if not self._connected:
+                return
+            added = desired - self.subscribed
+            removed = self.subscribed - desired
+            if added:
+                self._subscribe(added)
+            # narrow only once the enrolled topics are subscribed
+            self._sync_wildcard()
+            if removed:
+                self._unsubscribe(removed)
+            self.subscribed = set(desired)
+        if added or removed:
+            print(f"[SUBSCRIBE] +{len(added)} -{len(removed)} topics ({len(desired)} total)")
+
+    def _sync_wildcard(self):
+        if self.wildcard and not self._wildcard_on:
+            self.client.subscribe([(_subscription_filter(self.WILDCARD), self.qos)])
+        elif not self.wildcard and self._wildcard_on:
+            self.client.unsubscribe([_subscription_filter(self.WILDCARD)])
+            print("[SUBSCRIBE] enrolled topics loaded; dropped the all-topics subscription")
+        self._wildcard_on = self.wildcard
+
+    def resubscribe_all(self):
+        with self._lock:
+            self._connected = True
+            self.subscribed = set(self.desired)
+            self._subscribe(self.subscribed)
+            self._wildcard_on = False
+            self._sync_wildcard()
+
+    def disconnected(self):
+        with self._lock:
+            self._connected = False
+
+    def run_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            self.refresh()
+
+subscriptions = TopicSubscriptions(client, mongo_client[MONGO_DB]["enrolled_devices"], MQTT_QOS,
+                                   SUBSCRIPTION_CACHE or None)
+
 def on_connect(client, userdata, flags, reason_code, properties):
     rc_val  = _rc_value(reason_code)
     rc_name = _rc_name(reason_code)
@@ -83,12 +526,22 @@ def on_connect(client, userdata, flags, reason_code, properties):
             client.disconnect()
         return
 
-    subs = [("#", MQTT_QOS)]
+    subs = [("#", MQTT_QOS)] if SUBSCRIBE_MODE == "all" else []
     if INCLUDE_SYS:
         subs.append(("$SYS/#", MQTT_QOS))
-
-    client.subscribe(subs)
-    pretty = ", ".join(t for t,_ in subs)
+    if subs:
+        client.subscribe(subs)
+
+    if SUBSCRIBE_MODE == "all":
+        pretty = ", ".join(t for t,_ in subs)
+    else:
+        subscriptions.resubscribe_all()
+        pretty = "all topics (enrollments not loaded yet)" if subscriptions.wildcard \
+            else f"{len(subscriptions.subscribed)} enrolled topics"
+        if MQTT_SHARE_GROUP:
+            pretty += f" (shared group {MQTT_SHARE_GROUP})"
+        elif BRIDGE_INSTANCES > 1:
+            pretty += f" (partition {BRIDGE_INSTANCE_INDEX}/{BRIDGE_INSTANCES})"
     print(f"[CONNECTED] {rc_name}; subscribed to {pretty}")
 
 
@@ -97,30 +550,35 @@ def on_connect(client, userdata, flags, reason_code, properties):
 
 
 def on_message(client, userdata, msg: mqtt.MQTTMessage):
-    data_str, raw = _bytes_to_data(msg.payload or b"")
+    # "#" (and a stale subscription mid-refresh) also delivers other instances' topics
+    if not _owns_topic(msg.topic):
+        return
+    if subscriptions.wildcard and not _is_7_digit_topic(msg.topic):
+        return
 
-    # Get actual UTC time
-    ts_utc = datetime.utcnow()
+    # Receive time in true UTC; seq orders frames of a topic even within one clock tick
+    ts = datetime.utcnow()
+    seq = sequencer.next(msg.topic)
 
-    # Add 5 hours for Pakistan Time
-    ts_pk = ts_utc + timedelta(hours=5)
+    if pipeline:
+        # Decode + positions happen in the worker pool; just enqueue
+        pipeline.submit(msg.topic, msg.payload, ts, seq)
+        return
 
-    doc = {
-        "ts": ts_pk,      # save Pakistan time directly as UTC
-        "topic": msg.topic,
-        "data": data_str,
-    }
+    # Canonical mqtt_data shape (see mqtt_records); typed tag_id/ranges
+    # are added for UWB range frames so readers don't re-parse `data`
+    doc = decode_message(msg.topic, msg.payload, ts, seq)
+    if not ingest_filter.accept(doc):
+        return
 
-    try:
-        col.insert_one(doc)
-        print(doc)
-    except Exception as e:
-        print(f"[MONGO ERROR] {e}", file=sys.stderr)
+    # Hand off to the flusher thread; never block the paho network loop on Mongo
+    writer.put(doc)
 
 
         
 
 def on_disconnect(client, userdata, reason_code, properties):
+    subscriptions.disconnected()
     print(f"[DISCONNECTED] {_rc_name(reason_code)}")
 
 client.on_connect = on_connect
@@ -128,6 +586,10 @@ client.on_message = on_message
 client.on_disconnect = on_disconnect
 
 client.reconnect_delay_set(min_delay=1, max_delay=60)
+if SUBSCRIBE_MODE != "all":
+    subscriptions.refresh()  # initial topic set, before the first on_connect
+    threading.Thread(target=subscriptions.run_forever, args=(SUBSCRIPTION_REFRESH_S,),
+                     name="subscription-refresh", daemon=True).start()
 client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
 client.loop_start()
 
@@ -138,6 +600,13 @@ def _stop(*_):
         client.loop_stop()
         client.disconnect()
     finally:
+        # Drain queued messages through the stages before closing the Mongo connection
+        if pipeline:
+            pipeline.close()
+        writer.close()
+        print(f"Flushed {writer.written} docs ({writer.replayed} replayed from spill, "
+              f"{writer.spilled} spilled, {writer.dropped} dropped; "
+              f"{ingest_filter.duplicates} duplicates, {ingest_filter.rate_limited} rate-limited)")
         mongo_client.close()
     sys.exit(0)
 
@@ -150,6 +619,5 @@ print(f"Bridging MQTT {MQTT_BROKER}:{MQTT_PORT} -> MongoDB {MONGO_URI} ({MONGO_D
 try:
     signal.pause()
 except AttributeError:
-    import time
     while True:
         time.sleep(1)
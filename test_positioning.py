@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Parity Test for the Batch Positioning Solvers
+
+Checks that the batch (NumPy) path of each vectorized solver, used by the
+history endpoints and bulk recompute, gives the same fixes as its scalar
+path for random and edge-case frames, and that the least-squares solvers
+recover the exact position from noise-free ranges, for corner-anchored
+rooms and an explicit eight-anchor layout. Also checks that the per-tag
+Kalman filter tracks a tag moving at constant velocity more closely than
+the raw fixes and predicts its position between frames.
+"""
+import datetime
+import math
+import random
+import sys
+
+import positioning
+from positioning import TagTracker, rectangle_geometry, room_geometry, solve_fix, solve_fixes
+
+# Configuration
+FRAMES = 20000
+ROOMS = [(300.0, 250.0), (800.0, 600.0), (120.0, 120.0)]
+# 600 x 400 room with anchors on the walls and a pillar, in range-slot order
+WIDE_ROOM = {
+    "_id": "wide", "width_in": 600.0, "height_in": 400.0,
+    "anchors": [{"id": "NW", "x": 0, "y": 0}, {"id": "N", "x": 300, "y": 0}, {"id": "NE", "x": 600, "y": 0},
+                {"id": "E", "x": 600, "y": 200}, {"id": "SE", "x": 600, "y": 400}, {"id": "S", "x": 300, "y": 400},
+                {"id": "SW", "x": 0, "y": 400}, {"id": "P", "x": 250, "y": 180}],
+}
+# solver -> tolerance (inches); Gauss-Newton amplifies summation-order
+# differences on inconsistent frames
+SOLVERS = {"pairwise": 1e-9, "lstsq": 1e-9, "gauss_newton": 1e-6}
+SEED = 7
+
+EDGE_CASES = [
+    [10, 10, 10, 10],          # ties: anchor order decides
+    [0, 0, 0, 5],              # too few ranges
+    [5, 5, 0, 0],
+    [1000, 1000, 1000, 1000],  # circles do not intersect
+    [0, 40, 50, 60, 9, 9, 9, 9],  # slots past A3 are ignored
+    [-1, 30, 40, 50],          # non-positive ranges are skipped
+    [12.5, 80.25, 99.0, 3.75],
+]
+
+
+def random_frame(rng):
+    slots = rng.choice([4, 8])
+    return [rng.choice([0, rng.randint(1, 900), rng.uniform(0.5, 900.0)]) for _ in range(slots)]
+
+
+def geometries():
+    return [rectangle_geometry(width, height) for width, height in ROOMS] + [room_geometry(WIDE_ROOM)]
+
+
+def label(geometry):
+    return f'{geometry.width} x {geometry.height} ({len(geometry.layout)} anchors)'
+
+
+def compare(frames, geometry, solver, tolerance):
+    """Returns the mismatching (frame, scalar, batch) triples."""
+    scalar = [solve_fix(frame, geometry, solver=solver) for frame in frames]
+    batch = solve_fixes(frames, geometry, solver=solver)
+    mismatches = []
+    for frame, s, b in zip(frames, scalar, batch):
+        if s is None or b is None:
+            if s is not b:
+                mismatches.append((frame, s, b))
+        elif abs(s[0] - b[0]) > tolerance or abs(s[1] - b[1]) > tolerance or list(s[2]) != list(b[2]):
+            mismatches.append((frame, s, b))
+    return mismatches
+
+
+def exact_errors(rng, geometry, solver, count=1000):
+    """Largest error of `solver` on noise-free ranges from random points in the room."""
+    worst = 0.0
+    for _ in range(count):
+        x, y = rng.uniform(0, geometry.width), rng.uniform(0, geometry.height)
+        fix = solve_fix([math.hypot(x - ax, y - ay) for ax, ay in geometry.layout], geometry, solver=solver)
+        worst = max(worst, math.hypot(fix[0] - x, fix[1] - y))
+    return worst
+
+
+def kalman_track(rng, steps=200, dt=0.1, noise=12.0):
+    """(raw RMS error, filtered RMS error, final velocity, prediction error) for a tag walking at 30, -20 in/s."""
+    geometry = rectangle_geometry(800.0, 600.0)
+    tracker = TagTracker()
+    start = datetime.datetime(2026, 1, 1)
+    raw_sq = filtered_sq = 0.0
+    state = None
+    for k in range(steps):
+        t = k * dt
+        x, y = 100 + 30 * t, 500 - 20 * t
+        fix = (x + rng.gauss(0, noise), y + rng.gauss(0, noise), [0, 1, 2])
+        ts = start + datetime.timedelta(seconds=t)
+        state = tracker.observe(("topic", 1), geometry, fix, ts, ts)
+        if k >= steps // 2:  # after convergence
+            raw_sq += (fix[0] - x) ** 2 + (fix[1] - y) ** 2
+            filtered_sq += (state["x"] - x) ** 2 + (state["y"] - y) ** 2
+    n = steps - steps // 2
+    # half a second after the last frame, no new fix
+    t = (steps - 1) * dt + 0.5
+    ahead = tracker.observe(("topic", 1), geometry, None, ts, start + datetime.timedelta(seconds=t))
+    prediction_error = math.hypot(ahead["x"] - (100 + 30 * t), ahead["y"] - (500 - 20 * t))
+    return math.sqrt(raw_sq / n), math.sqrt(filtered_sq / n), (state["vx"], state["vy"]), prediction_error
+
+
+def kalman_shared_rooms():
+    """(updates with two rooms of one size alternating on a topic, updates after one is resized)."""
+    tracker = TagTracker()
+    start = datetime.datetime(2026, 1, 1)
+    rooms = [rectangle_geometry(300.0, 300.0, "r1"), rectangle_geometry(300.0, 300.0, "r2")]
+    for k in range(4):
+        ts = start + datetime.timedelta(seconds=k)
+        shared = tracker.observe(("topic", 1), rooms[k % 2], (100.0 + k, 100.0, [0, 1, 2]), ts, ts)
+    ts = start + datetime.timedelta(seconds=4)
+    resized = tracker.observe(("topic", 1), rectangle_geometry(400.0, 300.0, "r2"), (104.0, 100.0, [0, 1, 2]), ts, ts)
+    return shared["updates"], resized["updates"]
+
+
+def main():
+    print('='*60)
+    print('📐 Positioning solvers and tracking')
+    print('='*60)
+    failed = 0
+    rng = random.Random(SEED)
+    for solver in ("lstsq", "gauss_newton"):
+        for geometry in geometries():
+            worst = exact_errors(rng, geometry, solver)
+            if worst > 1e-6:
+                failed += 1
+                print(f'❌ {solver} {label(geometry)}: exact ranges off by up to {worst:.3g} in')
+            else:
+                print(f'✅ {solver} {label(geometry)}: exact ranges recovered')
+
+    raw, filtered, (vx, vy), ahead = kalman_track(rng)
+    if filtered < raw and abs(vx - 30) < 5 and abs(vy + 20) < 5 and ahead < raw:
+        print(f'✅ kalman: RMS error {filtered:.1f} in vs {raw:.1f} raw, v=({vx}, {vy}), 0.5 s ahead off by {ahead:.1f} in')
+    else:
+        failed += 1
+        print(f'❌ kalman: RMS error {filtered:.1f} in vs {raw:.1f} raw, v=({vx}, {vy}), 0.5 s ahead off by {ahead:.1f} in')
+
+    shared, resized = kalman_shared_rooms()
+    if shared == 4 and resized == 1:
+        print('✅ kalman: rooms on one topic share the track, a resize restarts it')
+    else:
+        failed += 1
+        print(f'❌ kalman: {shared} updates across rooms (want 4), {resized} after resize (want 1)')
+
+    if positioning.np is None:
+        print('⚠️  NumPy not installed: batch solving uses the scalar path, nothing to compare')
+        return 1 if failed else 0
+
+    frames = EDGE_CASES + [random_frame(rng) for _ in range(FRAMES)]
+    for solver, tolerance in SOLVERS.items():
+        for geometry in geometries():
+            mismatches = compare(frames, geometry, solver, tolerance)
+            if mismatches:
+                failed += 1
+                print(f'❌ {solver} {label(geometry)}: {len(mismatches)} of {len(frames)} frames differ')
+                for frame, s, b in mismatches[:5]:
+                    print(f'   {frame}: scalar={s} batch={b}')
+            else:
+                print(f'✅ {solver} {label(geometry)}: {len(frames)} frames match')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
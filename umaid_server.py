@@ -9,6 +9,8 @@ import uuid
 import socket
 import re
 import math  # === NEW
+
+from positioning import get_solver
 # (no external deps beyond stdlib)
 
 # ====== CONFIG ======
@@ -88,44 +90,6 @@ def _anchors_from_room(room):
         "A3": (0.0, H),
     }
 
-def _solve_xy_from_four(anchors, d):
-    """
-    Linearized 2D trilateration using differences to A0 to remove squares:
-      For i in {A1,A2,A3}:
-        2*(xi - x0)*x + 2*(yi - y0)*y = (xi^2+yi^2 - di^2) - (x0^2+y0^2 - d0^2)
-    Use two best-conditioned rows (A1 & A2). If singular, fallback to A1 & A3.
-    """
-    (x0,y0) = anchors["A0"]
-    r0 = float(d["A0"])
-    eqs = []
-    for key in ["A1","A2","A3"]:
-        (xi, yi) = anchors[key]
-        ri = float(d[key])
-        A = 2*(xi - x0)
-        B = 2*(yi - y0)
-        C = (xi*xi + yi*yi - ri*ri) - (x0*x0 + y0*y0 - r0*r0)
-        eqs.append((A,B,C,key))
-
-    def solve_two(e1, e2):
-        (A1,B1,C1,_) = e1
-        (A2,B2,C2,_) = e2
-        det = A1*B2 - A2*B1
-        if abs(det) < 1e-9:
-            return None
-        x = (C1*B2 - C2*B1) / det
-        y = (A1*C2 - A2*C1) / det
-        return (x,y)
-
-    # try A1 & A2
-    sol = solve_two(eqs[0], eqs[1])
-    if sol is None:
-        # fallback: A1 & A3
-        sol = solve_two(eqs[0], eqs[2])
-    if sol is None:
-        # last fallback: A2 & A3
-        sol = solve_two(eqs[1], eqs[2])
-    return sol
-
 def _get_latest_ranges_from_mongo(device_uuid):
     """
     Expects documents like:
@@ -466,7 +430,10 @@ def visualize():
         if v <= 0 or v > max_allowed:
             return jsonify({"msg":f"Range {k} invalid (0..{max_allowed:.1f} inches)"}), 400
 
-    xy = _solve_xy_from_four(anchors, ranges)
+    # least squares over all four anchors (positioning.LeastSquaresSolver)
+    keys = ["A0","A1","A2","A3"]
+    fix = get_solver("lstsq").solve([ranges[k] for k in keys], [anchors[k] for k in keys])
+    xy = fix[:2] if fix else None
     if xy is None or any(math.isnan(t) or math.isinf(t) for t in xy):
         return jsonify({"msg":"Unable to compute position"}), 422
 
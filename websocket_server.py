@@ -2,21 +2,41 @@
 """
 WebSocket Server for UWB Real-Time Visualization
 This script runs the Flask-SocketIO server on port 8000
+
+Worker model (SOCKETIO_ASYNC_MODE):
+  threading  one OS thread per connection; fine for development / a few viewers
+  eventlet   one process, one greenlet per connection; production setting
+  gevent     same with gevent (pip install gevent gevent-websocket)
+Broadcasters (one per watched topic/room, not per viewer) run as background
+tasks of the selected mode and sleep cooperatively. Keep CPU-heavy work such as
+history backfills out of this process (ROLLUP_IN_SERVER=0, bridge-side
+positions) so a green server is not blocked by it.
+
+Scale-out: start one instance per port (WS_PORT) with the same
+SOCKETIO_MESSAGE_QUEUE (redis://... in production, file:///... on a single
+host) and balance them with nginx `ip_hash` (sticky sessions, needed for the
+long-polling transport). See socketio_bus.py.
 """
-from final_server import app, socketio, initialize_server
+import os
+
+from final_server import app, socketio, initialize_server, NODE_ID, SOCKETIO_ASYNC_MODE, SOCKETIO_MESSAGE_QUEUE
+
+WS_PORT = int(os.getenv("WS_PORT", "8000"))
 
 if __name__ == '__main__':
     initialize_server()
     print("="*60)
     print("🛰️  UWB WebSocket Server")
     print("="*60)
-    print("Server running on: http://0.0.0.0:8000")
-    print("WebSocket URL: ws://15.204.231.252:8000")
+    print(f"Server running on: http://0.0.0.0:{WS_PORT}")
+    print(f"WebSocket URL: ws://15.204.231.252:{WS_PORT}")
+    print(f"Async mode: {SOCKETIO_ASYNC_MODE}")
+    print(f"Message queue: {SOCKETIO_MESSAGE_QUEUE or 'none (single node)'}  node {NODE_ID[:8]}")
     print("="*60)
     socketio.run(
         app, 
         host='0.0.0.0', 
-        port=8000, 
+        port=WS_PORT, 
         allow_unsafe_werkzeug=True, 
         debug=False
     )
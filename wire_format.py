@@ -0,0 +1,112 @@
+"""
+Response encodings for the hot read paths (position updates, /api/visualize,
+history and latest pages). JSON stays the default; clients can ask for
+
+    msgpack   - the same document as MessagePack
+    columnar  - MessagePack where lists of row objects (history "data") and
+                maps of objects (tag_positions) are turned into columns:
+                {"_columns": {field: [values...]}, "_length": n} plus "_keys"
+                for maps. Cheap to load into typed arrays / DataFrames.
+
+REST picks the format from the Accept header (negotiate()); Socket.IO clients
+pass format=... in the handshake query or auth. msgpack is optional: without
+it every request is answered with JSON.
+"""
+try:
+    import msgpack
+except ImportError:  # optional: binary formats are disabled
+    msgpack = None
+
+JSON_MIMETYPE     = "application/json"
+MSGPACK_MIMETYPE  = "application/msgpack"
+COLUMNAR_MIMETYPE = "application/vnd.uwb.columnar+msgpack"
+
+FORMATS = ("json", "msgpack", "columnar")
+MIMETYPES = {"json": JSON_MIMETYPE, "msgpack": MSGPACK_MIMETYPE, "columnar": COLUMNAR_MIMETYPE}
+_BY_MIMETYPE = {
+    MSGPACK_MIMETYPE: "msgpack",
+    "application/x-msgpack": "msgpack",
+    COLUMNAR_MIMETYPE: "columnar",
+}
+
+
+def available(fmt) -> bool:
+    return fmt == "json" or (fmt in FORMATS and msgpack is not None)
+
+
+def negotiate(accept_header) -> str:
+    """Best supported format for an Accept header ("json" unless a binary type is preferred)."""
+    if not accept_header or msgpack is None:
+        return "json"
+    best, best_q = "json", 0.0
+    for item in accept_header.split(","):
+        parts = [p.strip() for p in item.split(";")]
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        fmt = _BY_MIMETYPE.get(parts[0].lower())
+        if parts[0].lower() in (JSON_MIMETYPE, "*/*") and q > best_q:
+            best, best_q = "json", q  # equal weights: the type listed first wins
+        elif fmt and q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+def _is_rows(value):
+    return isinstance(value, list) and value and all(isinstance(v, dict) for v in value)
+
+
+def _is_row_map(value):
+    return isinstance(value, dict) and value and all(isinstance(v, dict) for v in value.values())
+
+
+def _columns(rows):
+    names = []
+    for row in rows:
+        for name in row:
+            if name not in names:
+                names.append(name)
+    return {name: [row.get(name) for row in rows] for name in names}
+
+
+def columnar(payload):
+    """Copy of payload with row lists / row maps (one level down) turned into columns."""
+    if not isinstance(payload, dict):
+        return payload
+    out = {}
+    for key, value in payload.items():
+        if _is_rows(value):
+            out[key] = {"_columns": _columns(value), "_length": len(value)}
+        elif _is_row_map(value) and key != "filters":
+            out[key] = {"_keys": list(value), "_columns": _columns(list(value.values())), "_length": len(value)}
+        else:
+            out[key] = value
+    return out
+
+
+def _str_keys(payload):
+    """Row maps keyed like JSON output (tag ids can be ints)."""
+    if not isinstance(payload, dict):
+        return payload
+    return {key: {str(k): v for k, v in value.items()} if _is_row_map(value) else value
+            for key, value in payload.items()}
+
+
+def _default(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)  # ObjectId, Decimal128, ...
+
+
+def encode(payload, fmt):
+    """bytes for a binary format (payload returned unchanged for "json")."""
+    if fmt == "json":
+        return payload
+    payload = _str_keys(payload)
+    if fmt == "columnar":
+        payload = columnar(payload)
+    return msgpack.packb(payload, default=_default, use_bin_type=True)
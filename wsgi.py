@@ -1,3 +1,14 @@
+"""
+WSGI entry point, e.g.
+
+    SOCKETIO_ASYNC_MODE=eventlet gunicorn -k eventlet -w 1 -b 0.0.0.0:8001 wsgi:app
+
+Socket.IO sessions live in the worker that accepted them, so run one worker
+per gunicorn instance and scale out with more instances (ports/hosts) that
+share SOCKETIO_MESSAGE_QUEUE. Behind nginx give the upstream `ip_hash` so
+long-polling requests stick to their node, or set
+SOCKETIO_TRANSPORTS=websocket when every client connects with websockets only.
+"""
 from final_server import app
 
 if __name__ == "__main__":